@@ -0,0 +1,133 @@
+"""
+Описание: Простой in-process кэш (LRU + TTL) и склейка одновременных вызовов (single-flight)
+для снижения числа обращений к БД и API маркетплейсов.
+Дата изменения: 2026-10-15
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Словарь с ограничением размера (LRU-вытеснение) и временем жизни записей.
+
+    Важно:
+    - рассчитан на один event loop (без блокировок), как и весь бот
+    - время считается по time.monotonic(), перевод системных часов не влияет
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 60.0):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение, если оно есть и не протухло, иначе default."""
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Кладёт значение в кэш; при переполнении вытесняет самые старые записи."""
+        t = self.ttl if ttl is None else float(ttl)
+        self._data[key] = (time.monotonic() + t, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        """Удаляет запись (инвалидация после изменения данных)."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Склейка одинаковых одновременных вызовов: пока задача по ключу выполняется,
+    остальные вызывающие ждут её результат, а не запускают ту же работу повторно.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, "asyncio.Task[Any]"] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        # shield: отмена одного ожидающего не должна отменять общую задачу
+        return await asyncio.shield(task)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+
+async def cached_call(
+    cache: TTLCache,
+    key: Hashable,
+    factory: Callable[[], Awaitable[Any]],
+    force_refresh: bool = False,
+) -> Any:
+    """Значение из кэша либо результат factory() (кладётся в кэш)."""
+    if not force_refresh:
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+    value = await factory()
+    cache.set(key, value)
+    return value
+
+
+# Балансы маркетплейсов по ключу (tg_id, "wb" | "ozon"): минута устаревания
+# вместо запроса к API на каждый /check_api и /profit
+balance_cache = TTLCache(maxsize=10_000, ttl=60.0)
+
+
+def invalidate_balances(tg_id: int) -> None:
+    """Сбрасывает закэшированные балансы пользователя (после смены ключей)."""
+    for mp in ("wb", "ozon"):
+        balance_cache.pop((tg_id, mp))
+
+
+# Обёртки WildberriesAPI/OzonAPI по ключу (tg_id, "wb" | "ozon"): заголовки и настройки
+# собираются один раз, пока ключи пользователя не меняются
+api_wrappers = TTLCache(maxsize=10_000, ttl=3600.0)
+
+
+def invalidate_api_wrappers(tg_id: int) -> None:
+    """Сбрасывает закэшированные обёртки API пользователя (после смены ключей)."""
+    for mp in ("wb", "ozon"):
+        api_wrappers.pop((tg_id, mp))
+
+
+# Юнит-экономика товаров по ключу (tg_id, marketplace): отчёты одного цикла планировщика
+# не перечитывают её из БД
+cost_prices_cache = TTLCache(maxsize=10_000, ttl=60.0)
+
+
+def invalidate_cost_prices(tg_id: int, marketplace: Optional[str] = None) -> None:
+    """Сбрасывает кэш себестоимости пользователя (после изменения товаров)."""
+    for mp in ((marketplace,) if marketplace else ("wb", "ozon")):
+        cost_prices_cache.pop((tg_id, mp))
@@ -20,6 +20,9 @@ class Settings(BaseSettings):
         validation_alias=AliasChoices('db_url', 'database_url')
     )
 
+    # --- FSM storage (если redis_url пуст — состояния хранятся в памяти процесса) ---
+    redis_url: str = Field(default="")  # например redis://localhost:6379/0
+
     # --- Logging & Time ---
     log_level: str = Field(default="INFO")
     timezone: str = Field(default="Europe/Moscow")
@@ -34,10 +37,20 @@ class Settings(BaseSettings):
     admin_user: str = Field(default="admin")
     admin_pass: str = Field(default="admin")
 
+    # --- Telegram Webhook (если webhook_url пуст — работаем через long polling) ---
+    webhook_url: str = Field(default="")  # публичный https-адрес, например https://bot.example.com
+    webhook_path: str = Field(default="/tg")
+    webhook_host: str = Field(default="0.0.0.0")
+    webhook_port: int = Field(default=8081)
+    webhook_secret: str = Field(default="")
+
     # --- API Settings (Шаг 2) ---
     api_retry_attempts: int = Field(default=3)
     temp_files_path: str = Field(default="./temp")
 
+    # --- Event loop (USE_UVLOOP=1 — uvloop вместо стандартного asyncio-цикла, кроме Windows) ---
+    use_uvloop: bool = Field(default=False)
+
     model_config = SettingsConfigDict(
         env_file=".env", 
         env_file_encoding="utf-8",
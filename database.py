@@ -30,6 +30,7 @@ from sqlalchemy import (
     func,
     text,
 )
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
@@ -41,10 +42,27 @@ logger = logging.getLogger(__name__)
 # Engine / Session
 # -----------------------------------------------------------------------------
 
+# Пул соединений под конкурентный проход планировщика (USER_WORKERS воркеров,
+# каждый открывает свои короткие сессии через db_functions)
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+
+
+def _pool_kwargs(url: str) -> dict:
+    """
+    Размер пула задаётся только для серверных БД (PostgreSQL/MySQL).
+    SQLite (файл или память) работает на NullPool/StaticPool, которые pool_size/max_overflow не принимают.
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+
+
 engine = create_async_engine(
     url=config.db_url,
     echo=False,
     pool_pre_ping=True,
+    **_pool_kwargs(config.db_url),
 )
 
 async_session = async_sessionmaker(engine, expire_on_commit=False)
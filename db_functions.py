@@ -4,12 +4,12 @@
 Дата изменения: 2026-01-22
 Изменения:
 - Приведены в полное соответствие с текущими моделями database.py:
-  * Order: используется поле order_date (вместо несуществующего created_at)
+  * Order: дата заказа хранится в поле created_at (как в модели database.py)
   * KeywordTrack: используется поле user_id (вместо несуществующего user_tg_id)
   * KeywordHistory: используются поля check_date и position (без user_id/checked_at)
 - UPSERT сделан кросс-СУБД (SQLite/PostgreSQL) через выбор диалекта engine.dialect.name.
 - is_order_new теперь корректно учитывает user_tg_id (tg_id) и предотвращает коллизии между пользователями.
-- save_order/bulk_save_orders: единая нормализация и запись в Order.order_date.
+- save_order/bulk_save_orders: единая нормализация и запись в Order.created_at.
 - bulk_update_products/update_product_cost: безопасные upsert-операции, защита от затирания cost/extra нулями.
 - Функции работы с keywords исправлены под реальные поля моделей.
 - Повышена устойчивость: rollback, логирование контекста, мягкие дефолты.
@@ -19,15 +19,22 @@ from __future__ import annotations
 
 import logging
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set
 
 from sqlalchemy import select, update, func, delete, and_, or_
 from sqlalchemy.sql import Insert
 
+from cache import TTLCache, invalidate_api_wrappers, invalidate_balances, invalidate_cost_prices
 from database import async_session, engine, User, Order, Product, KeywordTrack, KeywordHistory
 
 logger = logging.getLogger(__name__)
 
+# Пользователи, уже прошедшие register_user (чтобы не ходить в БД на каждое нажатие кнопки)
+_registered_users = TTLCache(maxsize=10_000, ttl=3600.0)
+
+# Ключи/настройки пользователей (get_user_keys); сбрасываются при любом изменении профиля
+_keys_cache = TTLCache(maxsize=10_000, ttl=30.0)
+
 
 # =============================================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (нормализация и безопасность)
@@ -117,10 +124,11 @@ def _supports_on_conflict() -> bool:
 # РАБОТА С ПОЛЬЗОВАТЕЛЯМИ
 # =============================================================================
 
-async def register_user(tg_id: int) -> None:
+async def register_user(tg_id: int) -> bool:
     """
     Регистрирует нового пользователя или гарантирует, что у существующего
     заполнены дефолтные значения (не затирая токены/ключи).
+    Возвращает True при успехе.
     """
     async with async_session() as session:
         try:
@@ -157,9 +165,22 @@ async def register_user(tg_id: int) -> None:
             )
 
             await session.commit()
+            _registered_users.set(tg_id, True)
+            return True
         except Exception as e:
             logger.error(f"Ошибка register_user (tg_id={tg_id}): {e}")
             await session.rollback()
+            return False
+
+
+async def ensure_user_registered(tg_id: int) -> None:
+    """
+    Лёгкая версия register_user для обработчиков кнопок/меню:
+    если пользователь уже регистрировался в течение часа — БД не трогаем.
+    """
+    if tg_id in _registered_users:
+        return
+    await register_user(tg_id)
 
 
 async def get_user_tax_rate(tg_id: int) -> float:
@@ -176,11 +197,23 @@ async def get_user_tax_rate(tg_id: int) -> float:
             return 0.06
 
 
+def invalidate_keys(tg_id: int) -> None:
+    """Сбрасывает кэш get_user_keys, балансов и обёрток API пользователя (после изменения ключей/настроек)."""
+    _keys_cache.pop(tg_id)
+    invalidate_balances(tg_id)
+    invalidate_api_wrappers(tg_id)
+
+
 async def get_user_keys(tg_id: int) -> Dict[str, Any]:
     """
     Возвращает ключи и настройки пользователя для работы с API.
     Важно: ключи могут быть пустыми строками — считаем их как "нет".
+    Результат кэшируется на 30 секунд (см. invalidate_keys).
     """
+    cached = _keys_cache.get(tg_id)
+    if cached is not None:
+        return dict(cached)
+
     async with async_session() as session:
         try:
             result = await session.execute(select(User).where(User.tg_id == tg_id))
@@ -192,7 +225,7 @@ async def get_user_keys(tg_id: int) -> Dict[str, Any]:
             ozon_client_id = (user.ozon_client_id or "").strip() if user.ozon_client_id is not None else ""
             ozon_api_key = (user.ozon_api_key or "").strip() if user.ozon_api_key is not None else ""
 
-            return {
+            keys = {
                 "wb_token": wb_token if wb_token else None,
                 "ozon_client_id": ozon_client_id if ozon_client_id else None,
                 "ozon_api_key": ozon_api_key if ozon_api_key else None,
@@ -200,6 +233,8 @@ async def get_user_keys(tg_id: int) -> Dict[str, Any]:
                 "tax_default": float(user.tax_rate_default) if user.tax_rate_default is not None else 0.06,
                 "notifications_enabled": bool(user.notifications_enabled) if user.notifications_enabled is not None else True,
             }
+            _keys_cache.set(tg_id, keys)
+            return dict(keys)
         except Exception as e:
             logger.error(f"Ошибка get_user_keys (tg_id={tg_id}): {e}")
             return {}
@@ -240,6 +275,7 @@ async def update_user_profile(tg_id: int, **kwargs) -> bool:
         try:
             await session.execute(update(User).where(User.tg_id == tg_id).values(**kwargs))
             await session.commit()
+            invalidate_keys(tg_id)
             return True
         except Exception as e:
             logger.error(f"Ошибка update_user_profile (tg_id={tg_id}, keys={list(kwargs.keys())}): {e}")
@@ -289,6 +325,7 @@ async def update_wb_token(tg_id: int, token: str) -> bool:
                 update(User).where(User.tg_id == tg_id).values(wb_token=clean)
             )
             await session.commit()
+            invalidate_keys(tg_id)
             return True
         except Exception as e:
             logger.error(f"Ошибка update_wb_token (tg_id={tg_id}): {e}")
@@ -314,6 +351,7 @@ async def update_ozon_keys(tg_id: int, client_id: str, api_key: str) -> bool:
                 .values(ozon_client_id=cid, ozon_api_key=key)
             )
             await session.commit()
+            invalidate_keys(tg_id)
             return True
         except Exception as e:
             logger.error(f"Ошибка update_ozon_keys (tg_id={tg_id}): {e}")
@@ -387,6 +425,7 @@ async def update_product_cost(
                         prod.cost_price = new_cost
 
             await session.commit()
+            invalidate_cost_prices(user_tg_id, clean_market)
             return True
         except Exception as e:
             logger.error(
@@ -401,13 +440,25 @@ async def bulk_update_products(user_tg_id: int, products_list: List[Dict[str, An
     Массовое обновление/вставка товаров (upsert).
     Ожидает список словарей, где минимум: marketplace, article, name (name может быть пустым).
     Поддерживает поля: cost_price, extra_costs, tax_rate.
+    Возвращает общее число записанных товаров.
+    """
+    counts = await bulk_update_products_by_marketplace(user_tg_id, products_list)
+    return sum(counts.values())
+
+
+async def bulk_update_products_by_marketplace(
+    user_tg_id: int, products_list: List[Dict[str, Any]]
+) -> Dict[str, int]:
+    """
+    То же, что bulk_update_products (одна транзакция на весь список), но возвращает
+    число записанных товаров по маркетплейсам: {"wb": N, "ozon": M}. При ошибке — {}.
     """
     if not products_list:
-        return 0
+        return {}
 
     async with async_session() as session:
         try:
-            count = 0
+            counts: Dict[str, int] = {}
 
             for p in products_list:
                 if not isinstance(p, dict):
@@ -480,15 +531,16 @@ async def bulk_update_products(user_tg_id: int, products_list: List[Dict[str, An
                             prod.extra_costs = extra_costs
                         prod.tax_rate = tax_rate
 
-                count += 1
+                counts[clean_market] = counts.get(clean_market, 0) + 1
 
             await session.commit()
-            logger.info(f"User {user_tg_id}: синхронизировано {count} товаров.")
-            return count
+            invalidate_cost_prices(user_tg_id)
+            logger.info(f"User {user_tg_id}: синхронизировано {sum(counts.values())} товаров.")
+            return counts
         except Exception as e:
             logger.error(f"Ошибка bulk_update_products (user={user_tg_id}): {e}")
             await session.rollback()
-            return 0
+            return {}
 
 
 async def get_user_products(user_tg_id: int) -> List[Product]:
@@ -557,7 +609,7 @@ async def save_order(
                     amount=_safe_float(amount, 0.0),
                     item_name=_safe_str(item_name, max_len=255, default="Н/Д"),
                     user_id=user_tg_id,
-                    order_date=order_date or datetime.now(),
+                    created_at=order_date or datetime.now(),
                 ).on_conflict_do_nothing()
                 await session.execute(stmt)
             else:
@@ -577,7 +629,7 @@ async def save_order(
                             amount=_safe_float(amount, 0.0),
                             item_name=_safe_str(item_name, 255, "Н/Д"),
                             user_id=user_tg_id,
-                            order_date=order_date or datetime.now(),
+                            created_at=order_date or datetime.now(),
                         )
                     )
 
@@ -587,9 +639,16 @@ async def save_order(
             await session.rollback()
 
 
-async def bulk_save_orders(orders_data: List[Dict[str, Any]]) -> None:
+# Строк заказа в одном INSERT (6 параметров на строку, лимит параметров SQLite — 999)
+_ORDERS_INSERT_CHUNK = 150
+
+
+async def bulk_save_orders(orders_data: List[Dict[str, Any]]) -> Set[str]:
     """
-    Массовое сохранение заказов.
+    Массовое сохранение заказов: INSERT ... ON CONFLICT DO NOTHING RETURNING order_id.
+    Проверка «новый ли заказ» совмещена с записью — возвращает order_id реально вставленных
+    (ранее отсутствовавших) заказов; именно по ним нужно слать уведомления.
+    При ошибке БД возвращает пустое множество.
 
     Ожидаемый формат элемента списка:
     {
@@ -602,60 +661,72 @@ async def bulk_save_orders(orders_data: List[Dict[str, Any]]) -> None:
     }
     """
     if not orders_data:
-        return
+        return set()
+
+    rows: Dict[tuple, Dict[str, Any]] = {}
+    for o in orders_data:
+        if not isinstance(o, dict):
+            continue
+
+        oid = _safe_str(o.get("order_id"), max_len=128, default="")
+        mp = _norm_marketplace(o.get("marketplace"))
+        uid = o.get("user_id")
+
+        if not oid or not mp or uid is None:
+            continue
+
+        # повтор заказа во входном списке вставляем один раз (первый выигрывает)
+        rows.setdefault(
+            (oid, mp, int(uid)),
+            {
+                "order_id": oid,
+                "marketplace": mp,
+                "amount": _safe_float(o.get("amount"), 0.0),
+                "item_name": _safe_str(o.get("item_name", "Н/Д"), max_len=255, default="Н/Д"),
+                "user_id": int(uid),
+                # совместимость входов: order_date/created_at; в модели поле created_at
+                "created_at": o.get("order_date") or o.get("created_at") or datetime.now(),
+            },
+        )
+
+    if not rows:
+        return set()
+
+    values = list(rows.values())
+    inserted: Set[str] = set()
 
     async with async_session() as session:
         try:
-            for o in orders_data:
-                if not isinstance(o, dict):
-                    continue
-
-                oid = _safe_str(o.get("order_id"), max_len=128, default="")
-                mp = _norm_marketplace(o.get("marketplace"))
-                uid = o.get("user_id")
-
-                if not oid or not mp or uid is None:
-                    continue
-
-                amount = _safe_float(o.get("amount"), 0.0)
-                item_name = _safe_str(o.get("item_name", "Н/Д"), max_len=255, default="Н/Д")
-                odt = o.get("order_date") or o.get("created_at") or datetime.now()  # совместимость входов
-
-                if _supports_on_conflict():
-                    stmt = _insert_stmt(Order).values(
-                        order_id=oid,
-                        marketplace=mp,
-                        amount=amount,
-                        item_name=item_name,
-                        user_id=int(uid),
-                        order_date=odt,
-                    ).on_conflict_do_nothing()
-                    await session.execute(stmt)
-                else:
-                    # Фоллбек: manual do-nothing
+            if _supports_on_conflict():
+                for i in range(0, len(values), _ORDERS_INSERT_CHUNK):
+                    stmt = (
+                        _insert_stmt(Order)
+                        .values(values[i : i + _ORDERS_INSERT_CHUNK])
+                        .on_conflict_do_nothing(index_elements=["order_id", "marketplace", "user_id"])
+                        .returning(Order.order_id)
+                    )
+                    res = await session.execute(stmt)
+                    inserted.update(res.scalars().all())
+            else:
+                # Фоллбек: manual do-nothing
+                for row in values:
                     res = await session.execute(
                         select(Order.id).where(
-                            Order.order_id == oid,
-                            Order.marketplace == mp,
-                            Order.user_id == int(uid),
+                            Order.order_id == row["order_id"],
+                            Order.marketplace == row["marketplace"],
+                            Order.user_id == row["user_id"],
                         )
                     )
                     if res.scalar_one_or_none() is None:
-                        session.add(
-                            Order(
-                                order_id=oid,
-                                marketplace=mp,
-                                amount=amount,
-                                item_name=item_name,
-                                user_id=int(uid),
-                                order_date=odt,
-                            )
-                        )
+                        session.add(Order(**row))
+                        inserted.add(row["order_id"])
 
             await session.commit()
+            return inserted
         except Exception as e:
             logger.error(f"Ошибка bulk_save_orders: {e}")
             await session.rollback()
+            return set()
 
 
 async def get_orders_stats(user_tg_id: int, days: int = 1) -> List[Order]:
@@ -667,9 +738,9 @@ async def get_orders_stats(user_tg_id: int, days: int = 1) -> List[Order]:
                 select(Order)
                 .where(
                     Order.user_id == user_tg_id,
-                    Order.order_date >= date_limit,
+                    Order.created_at >= date_limit,
                 )
-                .order_by(Order.order_date.desc())
+                .order_by(Order.created_at.desc())
             )
             return list(result.scalars().all())
         except Exception as e:
@@ -728,7 +799,7 @@ async def get_orders_summary_by_marketplace(user_tg_id: int, days: int = 7) -> D
                 )
                 .where(
                     Order.user_id == user_tg_id,
-                    Order.order_date >= date_limit,
+                    Order.created_at >= date_limit,
                 )
                 .group_by(Order.marketplace)
             )
@@ -0,0 +1,66 @@
+"""
+Описание: Безопасные приведения типов для горячих циклов планировщика (поля заказов WB/Ozon).
+Модуль полностью аннотирован и совместим с mypyc: его можно скомпилировать в C-расширение
+командой `mypyc fast_helpers.py` (нужен пакет mypy). Скомпилированный модуль (.so/.pyd)
+импортируется вместо этого файла автоматически; без компиляции работает как обычный Python.
+Дата изменения: 2026-10-15
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict
+
+
+def safe_str(value: Any, max_len: int = 255, default: str = "Н/Д") -> str:
+    """Безопасное приведение к строке."""
+    s = str(value).strip() if value is not None else default
+    if not s:
+        s = default
+    return s[:max_len]
+
+
+def first(d: Dict[str, Any], *keys: str, default: Any = None) -> Any:
+    """Первое «истинное» значение по ключам в порядке приоритета (как цепочка d.get(a) or d.get(b))."""
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return v
+    return default
+
+
+def safe_float(value: Any, default: float = 0.0) -> float:
+    """Безопасное приведение к float."""
+    try:
+        if value is None:
+            return default
+        if isinstance(value, str):
+            v = value.strip().replace(" ", "").replace(",", ".")
+            if v == "":
+                return default
+            return float(v)
+        return float(value)
+    except Exception:
+        return default
+
+
+def wb_price_to_rub(value: Any) -> float:
+    """
+    WB может отдавать цену:
+    - в копейках (int)
+    - в рублях (float)
+    - строкой
+
+    Логика:
+    - если значение похоже на "копейки" (большое число), делим на 100
+    - иначе считаем рублями
+    """
+    v = safe_float(value, 0.0)
+    if v <= 0:
+        return 0.0
+
+    # Частый кейс WB: цена в копейках (например 129900 = 1299.00)
+    # Порог 50000: уменьшает риск неверного деления для "рублевых" значений.
+    if v >= 50000:
+        return v / 100.0
+
+    return v
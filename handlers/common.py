@@ -1,10 +1,13 @@
 import logging
+import os
+import tempfile
 from aiogram import Router, F, Bot
 from aiogram.filters import CommandStart, StateFilter
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 
 # Импортируем наши модули
+from config import config
 import keyboards as kb
 import db_functions as dbf
 # Импортируем классы API для работы с балансом
@@ -106,13 +109,14 @@ async def handle_download_template(callback: CallbackQuery):
     user_id = callback.from_user.id
     await callback.answer("Генерирую файл...")
     
+    tmp_path = None
     try:
         products = await dbf.get_user_products(user_id)
-        file_io = await excel.create_products_template(products)
-        input_file = BufferedInputFile(
-            file_io.getvalue(), 
-            filename=f"products_{user_id}.xlsx"
-        )
+        # Пишем во временный файл и отправляем с диска — без лишней копии bytes в памяти
+        fd, tmp_path = tempfile.mkstemp(suffix=".xlsx", dir=config.temp_files_path)
+        os.close(fd)
+        await excel.save_products_template(products, tmp_path)
+        input_file = FSInputFile(tmp_path, filename=f"products_{user_id}.xlsx")
         await callback.message.answer_document(
             input_file,
             caption="📥 Заполни колонку <b>Себестоимость</b> и пришли файл обратно."
@@ -120,31 +124,44 @@ async def handle_download_template(callback: CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка при выгрузке Excel: {e}")
         await callback.message.answer("❌ Не удалось создать файл.")
-
-@router.message(F.document)
+    finally:
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+@router.message(F.document, StateFilter(None))
 async def handle_document_upload(message: Message, bot: Bot):
     """Прием Excel файла от пользователя."""
     if not message.document.file_name.endswith(('.xlsx', '.xls')):
         return
 
-    wait_msg = await message.answer("⏳ Обрабатываю файл...")
-    try:
-        file_info = await bot.get_file(message.document.file_id)
-        file_content = await bot.download_file(file_info.file_path)
-        parsed_data = await excel.parse_products_excel(file_content.read())
-        
-        if not parsed_data:
-            await wait_msg.edit_text("❌ Ошибка в структуре файла. Проверь заголовки.")
-            return
-
-        count = await dbf.bulk_update_products(message.from_user.id, parsed_data)
-        await wait_msg.edit_text(
-            f"✅ Успешно!\nОбновлено товаров: <b>{count}</b>.\n"
-            f"Теперь отчеты будут учитывать себестоимость."
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке Excel: {e}")
-        await wait_msg.edit_text("❌ Произошла ошибка при обработке файла.")
+    # Если все слоты заняты — сразу показываем, что файл в очереди
+    queued = excel.XLSX_SEMAPHORE.locked()
+    wait_msg = await message.answer("⏳ Файл в очереди на обработку..." if queued else "⏳ Обрабатываю файл...")
+
+    async with excel.XLSX_SEMAPHORE:
+        try:
+            if queued:
+                await wait_msg.edit_text("⏳ Обрабатываю файл...")
+
+            file_info = await bot.get_file(message.document.file_id)
+            file_content = await bot.download_file(file_info.file_path)
+            parsed_data = await excel.parse_products_excel(file_content.read())
+
+            if not parsed_data:
+                await wait_msg.edit_text("❌ Ошибка в структуре файла. Проверь заголовки.")
+                return
+
+            count = await dbf.bulk_update_products(message.from_user.id, parsed_data)
+            await wait_msg.edit_text(
+                f"✅ Успешно!\nОбновлено товаров: <b>{count}</b>.\n"
+                f"Теперь отчеты будут учитывать себестоимость."
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке Excel: {e}")
+            await wait_msg.edit_text("❌ Произошла ошибка при обработке файла.")
 
 # --- ОБЩИЕ ОБРАБОТЧИКИ ---
 
@@ -1,5 +1,7 @@
+import asyncio
 import io
 import logging
+import os
 from typing import List, Dict, Any, Optional, Tuple
 
 import pandas as pd
@@ -35,6 +37,26 @@ TAX_ALIASES = (
 
 REQUIRED_COLS = (COL_MP, COL_ART, COL_COST)
 
+# Ограничение одновременных разборов Excel (CPU + память под DataFrame).
+# Общий для всех обработчиков загрузки файлов.
+XLSX_SEMAPHORE = asyncio.Semaphore(max(2, (os.cpu_count() or 2) // 2))
+
+# Синонимы маркетплейсов -> канон ('wb' / 'ozon')
+MARKETPLACE_ALIASES = {
+    "wb": "wb",
+    "wildberries": "wb",
+    "w": "wb",
+    "вайлдберриз": "wb",
+    "вайлдберис": "wb",
+    "ozon": "ozon",
+    "o3": "ozon",
+    "o": "ozon",
+    "озон": "ozon",
+}
+
+# Порядок ключей строки товара для dbf.bulk_update_products
+PRODUCT_KEYS = ("marketplace", "article", "name", "cost_price", "extra_costs", "tax_rate")
+
 
 # -----------------------------------------------------------------------------
 # Helpers
@@ -97,11 +119,8 @@ def _normalize_marketplace(value: Any) -> str:
     Нормализуем маркетплейс к 'wb' или 'ozon'.
     """
     s = _safe_str(value, 32, "").lower()
-    if s in ("wb", "wildberries", "w", "вайлдберриз", "вайлдберис"):
-        return "wb"
-    if s in ("ozon", "o3", "o", "озон"):
-        return "ozon"
-    return s  # если что-то нестандартное — пусть пройдёт дальше, dbf всё равно нормализует
+    # если что-то нестандартное — пусть пройдёт дальше, dbf всё равно нормализует
+    return MARKETPLACE_ALIASES.get(s, s)
 
 
 def _normalize_tax_rate(value: Any, default: float = 0.06) -> float:
@@ -129,10 +148,9 @@ def _normalize_tax_rate(value: Any, default: float = 0.06) -> float:
 # Public API
 # -----------------------------------------------------------------------------
 
-async def create_products_template(products_data: list) -> io.BytesIO:
+def _build_template_df(products_data: list) -> pd.DataFrame:
     """
-    Генерирует Excel-файл шаблона в памяти.
-    Принимает список объектов Product (или похожих объектов) из БД.
+    Собирает DataFrame шаблона из списка объектов Product (или похожих объектов) из БД.
 
     Важно:
     - Артикул сохраняем как строку (чтобы не терять ведущие нули).
@@ -158,15 +176,22 @@ async def create_products_template(products_data: list) -> io.BytesIO:
             {COL_MP: "OZON", COL_ART: "SKU-999", COL_NAME: "Пример товара 2", COL_COST: 300.0, "Налог (0.06 = 6%)": 0.07, "Доп_расходы": 30.0},
         ]
 
-    df = pd.DataFrame(rows)
+    return pd.DataFrame(rows)
+
+
+async def save_products_template(products_data: list, path: str) -> str:
+    """
+    Генерирует Excel-файл шаблона и пишет его сразу в файл на диске.
+    Принимает список объектов Product (или похожих объектов) из БД.
+    Файл затем отправляется через FSInputFile и не копируется целиком в память.
+    Возвращает path.
+    """
+    df = _build_template_df(products_data)
 
-    output = io.BytesIO()
     try:
-        # Используем openpyxl (обычно уже есть, и он стабильнее в проде, чем xlsxwriter)
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        with pd.ExcelWriter(path, engine="openpyxl") as writer:
             df.to_excel(writer, index=False, sheet_name="Products")
-        output.seek(0)
-        return output
+        return path
     except Exception as e:
         logger.error(f"Критическая ошибка при создании Excel: {e}")
         raise
@@ -176,6 +201,14 @@ async def parse_products_excel(file_content: bytes) -> Optional[List[Dict[str, A
     """
     Парсит Excel от пользователя и возвращает список словарей
     для dbf.bulk_update_products().
+    Разбор CPU-bound, поэтому выполняется в отдельном потоке и не блокирует event loop.
+    """
+    return await asyncio.to_thread(_parse_products_excel_sync, file_content)
+
+
+def _parse_products_excel_sync(file_content: bytes) -> Optional[List[Dict[str, Any]]]:
+    """
+    Синхронная часть parse_products_excel.
 
     Поддерживаем 2 формата колонок:
     A) settings.py:
@@ -212,8 +245,10 @@ async def parse_products_excel(file_content: bytes) -> Optional[List[Dict[str, A
         df.dropna(subset=[COL_ART], inplace=True)
 
         # Нормализация marketplace/article
-        df[COL_MP] = df[COL_MP].astype(str).map(_normalize_marketplace)
-        df[COL_ART] = df[COL_ART].astype(str).map(lambda x: _safe_str(x, 128, "")).map(lambda x: x.strip())
+        # (векторно через .str вместо поэлементных lambda)
+        mp_col = df[COL_MP].astype(str).str.strip().str[:32].str.lower()
+        df[COL_MP] = mp_col.map(MARKETPLACE_ALIASES).fillna(mp_col)
+        df[COL_ART] = df[COL_ART].astype(str).str.strip().str[:128].str.strip()
 
         # Числовые поля
         df[COL_COST] = pd.to_numeric(df[COL_COST], errors="coerce").fillna(0)
@@ -235,25 +270,32 @@ async def parse_products_excel(file_content: bytes) -> Optional[List[Dict[str, A
 
         # name (опционально)
         if COL_NAME in df.columns:
-            df["_name"] = df[COL_NAME].astype(str).map(lambda v: _safe_str(v, 255, ""))
+            df["_name"] = df[COL_NAME].astype(str).str.strip().str[:255]
         else:
             df["_name"] = ""
 
+        # Идём по колонкам (без iterrows, который создаёт Series на каждую строку);
+        # marketplace/article уже нормализованы векторно выше
         result: List[Dict[str, Any]] = []
-        for _, row in df.iterrows():
-            mp = _safe_str(row.get(COL_MP), 32, "").lower()
-            art = _safe_str(row.get(COL_ART), 128, "")
+        for mp, art, name, cost, extra, tax in zip(
+            df[COL_MP].tolist(),
+            df[COL_ART].tolist(),
+            df["_name"].tolist(),
+            df[COL_COST].tolist(),
+            df["_extra_costs"].tolist(),
+            df["_tax_rate"].tolist(),
+        ):
             if not mp or not art:
                 continue
 
-            result.append({
-                "marketplace": mp,
-                "article": art,
-                "name": _safe_str(row.get("_name", ""), 255, "") or f"Товар {art}",
-                "cost_price": float(_safe_float(row.get(COL_COST), 0.0)),
-                "extra_costs": float(_safe_float(row.get("_extra_costs"), 0.0)),
-                "tax_rate": float(_safe_float(row.get("_tax_rate"), 0.06)),
-            })
+            result.append(dict(zip(PRODUCT_KEYS, (
+                mp,
+                art,
+                _safe_str(name, 255, "") or f"Товар {art}",
+                float(_safe_float(cost, 0.0)),
+                float(_safe_float(extra, 0.0)),
+                float(_safe_float(tax, 0.06)),
+            ))))
 
         return result if result else None
 
@@ -1,21 +1,26 @@
 import logging
 import io
+import os
 import asyncio
-from typing import Any, Dict, List, Optional
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 
 from sqlalchemy import select
 
 import keyboards as kb
 import db_functions as dbf
+from config import config
 from states import SetupKeys
 from wb_api import WildberriesAPI
 from ozon_api import OzonAPI
 from database import async_session, Product
+from .excel_handlers import XLSX_SEMAPHORE
 
 router = Router(name="settings_router")
 logger = logging.getLogger(__name__)
@@ -33,6 +38,9 @@ COL_EXTRA = "Доп_расходы"
 
 REQUIRED_COLUMNS = {COL_MARKETPLACE, COL_ARTICLE, COL_COST}
 
+# Порядок ключей строки товара для dbf.bulk_update_products
+_PRODUCT_KEYS = ("marketplace", "article", "name", "cost_price", "tax_rate", "extra_costs")
+
 
 def _safe_str(value: Any, max_len: int = 255, default: str = "") -> str:
     s = str(value).strip() if value is not None else default
@@ -66,6 +74,51 @@ def _looks_like_products_template(file_name: str) -> bool:
     return name.startswith("products_") or name == "products.xlsx" or name == "products.xls"
 
 
+def _parse_products_excel(content: bytes) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Синхронный разбор Excel с товарами (CPU-bound, выполняется в отдельном потоке).
+    Возвращает (products, missing_columns).
+    """
+    df = pd.read_excel(io.BytesIO(content))
+
+    # Нормализация заголовков
+    df.columns = [str(c).strip() for c in df.columns]
+
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        return [], missing
+
+    # Нормализация строковых колонок — векторно через .str, а не _safe_str на каждую строку
+    markets = df[COL_MARKETPLACE].fillna("").astype(str).str.strip().str.lower().str[:32]
+    articles = df[COL_ARTICLE].fillna("").astype(str).str.strip().str[:128]
+    valid = (markets != "") & (articles != "")
+    df = df[valid]
+
+    # Колонки забираем целиком, без iterrows (он создаёт Series на каждую строку)
+    n = len(df)
+    names = (
+        df[COL_NAME].fillna("").astype(str).str.strip().str[:255].tolist()
+        if COL_NAME in df.columns else [""] * n
+    )
+    costs = df[COL_COST].tolist()
+    taxes = df[COL_TAX].tolist() if COL_TAX in df.columns else [0.06] * n
+    extras = df[COL_EXTRA].tolist() if COL_EXTRA in df.columns else [0.0] * n
+
+    products: List[Dict[str, Any]] = [None] * n  # type: ignore[list-item]
+    for i, row in enumerate(zip(markets[valid].tolist(), articles[valid].tolist(), names, costs, taxes, extras)):
+        market, article, name, cost, tax, extra = row
+        products[i] = dict(zip(_PRODUCT_KEYS, (
+            market,
+            article,
+            name,
+            _safe_float(cost, 0.0),
+            _safe_float(tax, 0.06),
+            _safe_float(extra, 0.0),
+        )))
+
+    return products, []
+
+
 # =========================================================
 # РАЗДЕЛ 1: ЮНИТ-ЭКОНОМИКА (МОИ ТОВАРЫ / EXCEL)
 # =========================================================
@@ -73,7 +126,7 @@ def _looks_like_products_template(file_name: str) -> bool:
 @router.message(F.text == "📦 Мои товары")
 async def show_products_menu(message: Message):
     """Отображает меню управления товарами и себестоимостью."""
-    await dbf.register_user(message.from_user.id)
+    await dbf.ensure_user_registered(message.from_user.id)
 
     text = (
         "<b>📦 Управление товарами</b>\n\n"
@@ -103,6 +156,7 @@ async def cb_download_products(callback: CallbackQuery):
 
     temp_msg = await callback.message.answer("⏳ Генерирую файл...")
 
+    tmp_path = None
     try:
         rows: List[Dict[str, Any]] = []
         for p in products:
@@ -116,11 +170,14 @@ async def cb_download_products(callback: CallbackQuery):
             })
 
         df = pd.DataFrame(rows)
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
+
+        # Пишем во временный файл и отправляем с диска — без лишней копии bytes в памяти
+        fd, tmp_path = tempfile.mkstemp(suffix=".xlsx", dir=config.temp_files_path)
+        os.close(fd)
+        with pd.ExcelWriter(tmp_path, engine="openpyxl") as writer:
             df.to_excel(writer, index=False, sheet_name="Products")
 
-        document = BufferedInputFile(output.getvalue(), filename=f"products_{tg_id}.xlsx")
+        document = FSInputFile(tmp_path, filename=f"products_{tg_id}.xlsx")
 
         await callback.message.answer_document(
             document,
@@ -132,6 +189,11 @@ async def cb_download_products(callback: CallbackQuery):
         logger.error(f"Ошибка создания Excel (tg_id={tg_id}): {e}")
         await temp_msg.edit_text("❌ Ошибка при создании файла.")
     finally:
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
         await callback.answer()
 
 
@@ -142,7 +204,7 @@ async def cb_sync_products(callback: CallbackQuery):
     Использует методы get_all_products() и dbf.bulk_update_products().
     """
     tg_id = callback.from_user.id
-    await dbf.register_user(tg_id)
+    await dbf.ensure_user_registered(tg_id)
 
     status_msg = await callback.message.answer("🔄 Синхронизирую товары... Это может занять время.")
 
@@ -152,29 +214,29 @@ async def cb_sync_products(callback: CallbackQuery):
         await callback.answer()
         return
 
-    async def sync_wb() -> int:
+    async def fetch_wb() -> List[Dict[str, Any]]:
         if keys.get("wb_token"):
             try:
                 wb = WildberriesAPI(keys["wb_token"])
-                products = await wb.get_all_products()  # ожидаем список dict
-                if products:
-                    return int(await dbf.bulk_update_products(tg_id, products))
+                return await wb.get_all_products() or []  # ожидаем список dict
             except Exception as e:
                 logger.error(f"WB sync error (tg_id={tg_id}): {e}")
-        return 0
+        return []
 
-    async def sync_ozon() -> int:
+    async def fetch_ozon() -> List[Dict[str, Any]]:
         if keys.get("ozon_api_key") and keys.get("ozon_client_id"):
             try:
                 ozon = OzonAPI(keys["ozon_client_id"], keys["ozon_api_key"])
-                products = await ozon.get_all_products()
-                if products:
-                    return int(await dbf.bulk_update_products(tg_id, products))
+                return await ozon.get_all_products() or []
             except Exception as e:
                 logger.error(f"Ozon sync error (tg_id={tg_id}): {e}")
-        return 0
+        return []
+
+    wb_products, oz_products = await asyncio.gather(fetch_wb(), fetch_ozon())
 
-    wb_count, oz_count = await asyncio.gather(sync_wb(), sync_ozon())
+    # Один upsert (одна транзакция/commit) на оба маркетплейса; в отчёте — реально записанные товары
+    counts = await dbf.bulk_update_products_by_marketplace(tg_id, wb_products + oz_products)
+    wb_count, oz_count = counts.get("wb", 0), counts.get("ozon", 0)
 
     await status_msg.edit_text(
         "✅ <b>Синхронизация завершена!</b>\n\n"
@@ -186,7 +248,7 @@ async def cb_sync_products(callback: CallbackQuery):
     await callback.answer()
 
 
-@router.message(F.document)
+@router.message(F.document, StateFilter(None))
 async def handle_products_excel(message: Message):
     """
     Массовое обновление/добавление себестоимости из присланного Excel.
@@ -213,18 +275,26 @@ async def handle_products_excel(message: Message):
         )
         return
 
-    status_msg = await message.answer("⏳ Обрабатываю Excel...")
+    # Если все слоты заняты — сразу показываем, что файл в очереди
+    queued = XLSX_SEMAPHORE.locked()
+    status_msg = await message.answer("⏳ Файл в очереди на обработку..." if queued else "⏳ Обрабатываю Excel...")
+
+    # Ограничиваем число одновременных разборов (память под DataFrame + CPU)
+    async with XLSX_SEMAPHORE:
+        await _process_products_excel(message, doc.file_id, status_msg, queued)
+
 
+async def _process_products_excel(message: Message, file_id: str, status_msg: Message, queued: bool) -> None:
+    """Скачивание, разбор и upsert присланного Excel (вызывается под XLSX_SEMAPHORE)."""
     try:
-        file = await message.bot.get_file(doc.file_id)
+        if queued:
+            await status_msg.edit_text("⏳ Обрабатываю Excel...")
+
+        file = await message.bot.get_file(file_id)
         downloaded = await message.bot.download_file(file.file_path)
         content = downloaded.read()
-        df = pd.read_excel(io.BytesIO(content))
-
-        # Нормализация заголовков
-        df.columns = [str(c).strip() for c in df.columns]
 
-        missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+        products, missing = await asyncio.to_thread(_parse_products_excel, content)
         if missing:
             await status_msg.edit_text(
                 "❌ В файле не найдены обязательные колонки:\n"
@@ -235,27 +305,6 @@ async def handle_products_excel(message: Message):
             )
             return
 
-        products: List[Dict[str, Any]] = []
-        for _, row in df.iterrows():
-            market = _safe_str(row.get(COL_MARKETPLACE), 32, "").lower()
-            article = _safe_str(row.get(COL_ARTICLE), 128, "")
-            if not market or not article:
-                continue
-
-            name = _safe_str(row.get(COL_NAME), 255, "") if COL_NAME in df.columns else ""
-            cost = _safe_float(row.get(COL_COST), 0.0)
-            tax = _safe_float(row.get(COL_TAX), 0.06) if COL_TAX in df.columns else 0.06
-            extra = _safe_float(row.get(COL_EXTRA), 0.0) if COL_EXTRA in df.columns else 0.0
-
-            products.append({
-                "marketplace": market,
-                "article": article,
-                "name": name,
-                "cost_price": cost,
-                "tax_rate": tax,
-                "extra_costs": extra,
-            })
-
         if not products:
             await status_msg.edit_text("❌ В файле нет корректных строк для обновления.")
             return
@@ -280,7 +329,7 @@ async def handle_products_excel(message: Message):
 
 @router.message(F.text == "⚙️ Настройки API")
 async def show_settings_menu(message: Message):
-    await dbf.register_user(message.from_user.id)
+    await dbf.ensure_user_registered(message.from_user.id)
     await message.answer(
         "⚙️ <b>Настройки API</b>\nВыберите площадку для подключения:",
         reply_markup=kb.get_settings_inline_menu(),
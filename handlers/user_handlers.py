@@ -1,10 +1,16 @@
 import logging
 import asyncio
+from contextlib import suppress
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
+from typing import Dict, Optional, Tuple
+import httpx
 import db_functions as dbf
 import reports as report_gen 
+import keyboards as kb
+from cache import SingleFlight, api_wrappers, balance_cache, cached_call
 from ozon_api import OzonAPI
 from wb_api import WildberriesAPI
 
@@ -12,12 +18,38 @@ from wb_api import WildberriesAPI
 router = Router(name="user_router")
 logger = logging.getLogger(__name__)
 
+# Повторные нажатия /check_api и /profit, пока предыдущий запуск ещё идёт,
+# ждут его результат вместо нового похода в WB/Ozon
+_inflight_check = SingleFlight()
+_inflight_profit = SingleFlight()
+
 @router.message(Command("check_api"))
-async def cmd_check_api(message: Message):
+async def cmd_check_api(
+    message: Message,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+):
     """
     Команда для комплексной проверки статуса API и вывода текущих балансов.
+    wb_client/ozon_client — общие HTTP-клиенты из ApiClientsMiddleware.
+    """
+    await _run_check_api(message, message.from_user.id, wb_client, ozon_client)
+
+
+async def _run_check_api(
+    message: Message,
+    user_id: int,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+    reply_to_edit: Optional[Message] = None,
+    force_refresh: bool = False,
+):
+    """
+    Общая логика /check_api.
+    user_id передается явно: у callback.message автор — сам бот.
+    reply_to_edit — сообщение, которое редактируем вместо отправки нового «ожидания».
+    force_refresh — запросить балансы заново, минуя кэш.
     """
-    user_id = message.from_user.id
     keys = await dbf.get_user_keys(user_id)
     
     # Исправлена логика проверки ключей (согласно именам в БД)
@@ -25,128 +57,292 @@ async def cmd_check_api(message: Message):
         await message.answer("❌ У вас не привязаны API ключи.\nИспользуйте кнопку ⚙️ Настройки.")
         return
 
-    wait_msg = await message.answer("🔄 Проверяю статус API и запрашиваю балансы...")
-    
-    results_text = []
-
-    # --- Секция Wildberries ---
-    if keys.get('wb_token'):
-        try:
-            wb = WildberriesAPI(keys['wb_token'])
-            # Параллельный запуск проверки и баланса
-            is_valid_task = wb.validate_token()
-            balance_task = wb.get_balance()
-            
-            is_valid, balance = await asyncio.gather(is_valid_task, balance_task)
-            
-            wb_report = await report_gen.generate_api_check_report("Wildberries", is_valid, balance)
-            results_text.append(wb_report)
-        except Exception as e:
-            logger.error(f"WB check error: {e}")
-            results_text.append("🟣 <b>Wildberries:</b> ❌ Ошибка подключения")
+    wait_text = "🔄 Проверяю статус API и запрашиваю балансы..."
+    if reply_to_edit is not None:
+        # Повторное нажатие «🔄» во время проверки правит сообщение тем же текстом — Telegram
+        # отвечает «message is not modified»; это не должно мешать присоединиться к текущему запуску
+        wait_msg = reply_to_edit
+        with suppress(TelegramBadRequest):
+            await reply_to_edit.edit_text(wait_text)
     else:
-        results_text.append("🟣 <b>Wildberries:</b> ⚪ Не настроен")
+        wait_msg = await message.answer(wait_text)
 
-    # --- Секция Ozon ---
-    # Исправлены названия ключей: ozon_client_id и ozon_api_key
-    if keys.get('ozon_client_id') and keys.get('ozon_api_key'):
-        try:
-            ozon = OzonAPI(keys['ozon_client_id'], keys['ozon_api_key'])
-            # В OzonAPI мы используем check_connection, который возвращает (bool, dict)
-            is_valid, _ = await ozon.check_connection()
-            balance = await ozon.get_balance() if is_valid else 0.0
-            
-            ozon_report = await report_gen.generate_api_check_report("Ozon", is_valid, balance)
-            results_text.append(ozon_report)
-        except Exception as e:
-            logger.error(f"Ozon check error: {e}")
-            results_text.append("🔵 <b>Ozon:</b> ❌ Ошибка подключения")
-    else:
-        results_text.append("🔵 <b>Ozon:</b> ⚪ Не настроен")
+    # force_refresh в ключе: принудительное обновление не склеивается с запуском по кэшу
+    text = await _inflight_check.run(
+        (user_id, force_refresh),
+        lambda: _build_check_api_report(user_id, keys, wb_client, ozon_client, force_refresh),
+    )
+    try:
+        await wait_msg.edit_text(text, parse_mode="HTML")
+    except TelegramBadRequest as e:
+        # склеенные нажатия выставляют один и тот же итог — второй правке нечего менять
+        if "message is not modified" not in str(e):
+            raise
+
+
+async def _build_check_api_report(
+    user_id: int,
+    keys: dict,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+    force_refresh: bool = False,
+) -> str:
+    """Текст отчета /check_api по обоим маркетплейсам."""
+    if not (_has_wb(keys) and _has_ozon(keys)):
+        # Настроен один маркетплейс: ненастроенная ветка возвращается сразу, gather не нужен
+        wb_text = await _check_wb(user_id, keys, wb_client, force_refresh)
+        ozon_text = await _check_ozon(user_id, keys, ozon_client, force_refresh)
+        return f"{wb_text}\n\n{ozon_text}"
+
+    # WB и Ozon — независимые хосты, проверяем параллельно
+    results = await asyncio.gather(
+        _check_wb(user_id, keys, wb_client, force_refresh),
+        _check_ozon(user_id, keys, ozon_client, force_refresh),
+        return_exceptions=True,
+    )
+    fallbacks = (
+        "🟣 <b>Wildberries:</b> ❌ Ошибка подключения",
+        "🔵 <b>Ozon:</b> ❌ Ошибка подключения",
+    )
+    results_text = [
+        fallback if isinstance(res, BaseException) else res
+        for res, fallback in zip(results, fallbacks)
+    ]
+    return "\n\n".join(results_text)
+
+
+def _get_wb(
+    user_id: int, token: str, wb_client: Optional[httpx.AsyncClient] = None
+) -> WildberriesAPI:
+    """Обёртка WB пользователя из кэша; пересоздаётся при смене токена или HTTP-клиента."""
+    wb = api_wrappers.get((user_id, "wb"))
+    if wb is None or wb.token != str(token).strip() or wb.client is not wb_client:
+        wb = WildberriesAPI(token, client=wb_client)
+        api_wrappers.set((user_id, "wb"), wb)
+    return wb
 
-    await wait_msg.edit_text("\n\n".join(results_text), parse_mode="HTML")
+
+def _get_ozon(
+    user_id: int, client_id: str, api_key: str, ozon_client: Optional[httpx.AsyncClient] = None
+) -> OzonAPI:
+    """Обёртка Ozon пользователя из кэша; пересоздаётся при смене ключей или HTTP-клиента."""
+    ozon = api_wrappers.get((user_id, "ozon"))
+    if (
+        ozon is None
+        or ozon.client_id != str(client_id).strip()
+        or ozon.api_key != str(api_key).strip()
+        or ozon.client is not ozon_client
+    ):
+        ozon = OzonAPI(client_id, api_key, client=ozon_client)
+        api_wrappers.set((user_id, "ozon"), ozon)
+    return ozon
+
+
+def _has_wb(keys: dict) -> bool:
+    return bool(keys.get('wb_token'))
+
+
+def _has_ozon(keys: dict) -> bool:
+    return bool(keys.get('ozon_client_id') and keys.get('ozon_api_key'))
+
+
+async def _check_wb(
+    user_id: int,
+    keys: dict,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    force_refresh: bool = False,
+) -> str:
+    """Статус и баланс Wildberries для /check_api."""
+    if not _has_wb(keys):
+        return "🟣 <b>Wildberries:</b> ⚪ Не настроен"
+    try:
+        wb = _get_wb(user_id, keys['wb_token'], wb_client)
+        # Параллельный запуск проверки и баланса
+        is_valid, balance = await asyncio.gather(
+            wb.validate_token(),
+            cached_call(balance_cache, (user_id, "wb"), wb.get_balance, force_refresh),
+        )
+        return await report_gen.generate_api_check_report("Wildberries", is_valid, balance)
+    except Exception as e:
+        logger.error(f"WB check error: {e}")
+        return "🟣 <b>Wildberries:</b> ❌ Ошибка подключения"
+
+
+async def _check_ozon(
+    user_id: int,
+    keys: dict,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+    force_refresh: bool = False,
+) -> str:
+    """Статус и баланс Ozon для /check_api."""
+    # Исправлены названия ключей: ozon_client_id и ozon_api_key
+    if not _has_ozon(keys):
+        return "🔵 <b>Ozon:</b> ⚪ Не настроен"
+    try:
+        ozon = _get_ozon(user_id, keys['ozon_client_id'], keys['ozon_api_key'], ozon_client)
+        # В OzonAPI мы используем check_connection, который возвращает (bool, balance)
+        is_valid, _ = await ozon.check_connection()
+        balance = (
+            await cached_call(balance_cache, (user_id, "ozon"), ozon.get_balance, force_refresh)
+            if is_valid else 0.0
+        )
+        return await report_gen.generate_api_check_report("Ozon", is_valid, balance)
+    except Exception as e:
+        logger.error(f"Ozon check error: {e}")
+        return "🔵 <b>Ozon:</b> ❌ Ошибка подключения"
 
 @router.message(Command("profit"))
 async def cmd_profit(message: Message):
     """
     Меню выбора периода для аналитического отчета.
     """
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="Вчера", callback_query_data="profit_1"),
-            InlineKeyboardButton(text="7 дней", callback_query_data="profit_7")
-        ],
-        [
-            InlineKeyboardButton(text="30 дней", callback_query_data="profit_30"),
-            InlineKeyboardButton(text="🔄 Проверить балансы", callback_query_data="check_api_cb")
-        ]
-    ])
     await message.answer(
         "📊 <b>Аналитика прибыли</b>\n\n"
         "Расчет включает себестоимость, логистику и налоги.\n"
         "Выберите период:", 
-        reply_markup=kb, 
+        reply_markup=kb.PROFIT_MENU, 
         parse_mode="HTML"
     )
 
-@router.callback_query(F.data.startswith("profit_"))
-async def process_profit_report(callback: CallbackQuery):
+@router.callback_query(kb.ProfitCb.filter())
+async def process_profit_report(
+    callback: CallbackQuery,
+    callback_data: kb.ProfitCb,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+):
     """
     Сбор данных и генерация консолидированного отчета по прибыли.
     """
-    days = int(callback.data.split("_")[1])
+    days = callback_data.days
     user_id = callback.from_user.id
     
-    await callback.message.edit_text(f"⏳ Собираю данные за {days} дн. Подождите...")
+    # Плейсхолдер отправляем параллельно со сбором данных, а не перед ним
+    placeholder_task = asyncio.create_task(
+        callback.message.edit_text(f"⏳ Собираю данные за {days} дн. Подождите...")
+    )
     
+    report_text: Optional[str] = None
+    try:
+        report_text = await _inflight_profit.run(
+            (user_id, days), lambda: _build_profit_report(user_id, days, wb_client, ozon_client)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка консолидированной аналитики: {e}", exc_info=True)
+
+    # Плейсхолдер дожидаемся ровно один раз, до итоговой правки
+    await _await_placeholder(placeholder_task)
+    error_text = "❌ Ошибка при расчете. Проверьте корректность API ключей."
+    try:
+        if report_text is not None:
+            await callback.message.edit_text(report_text, parse_mode="HTML")
+        else:
+            await callback.message.edit_text(error_text)
+    except Exception as e:
+        # повторное нажатие склеивается с текущим расчётом и выставляет тот же отчёт — это не ошибка
+        if not (isinstance(e, TelegramBadRequest) and "message is not modified" in str(e)):
+            logger.error(f"Ошибка отправки отчета по прибыли: {e}")
+            if report_text is not None:
+                with suppress(Exception):
+                    await callback.message.edit_text(error_text)
+
+    await callback.answer()
+
+
+async def _await_placeholder(task: asyncio.Task) -> None:
+    """
+    Дожидается правки-плейсхолдера, чтобы итоговая правка не обогнала её.
+    Плейсхолдер косметический: любая его ошибка (сеть, RetryAfter, BadRequest) гасится.
+    """
+    with suppress(Exception):
+        await task
+
+
+async def _build_profit_report(
+    user_id: int,
+    days: int,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+) -> str:
+    """Консолидированный отчет по прибыли WB+Ozon за период (текст сообщения)."""
     user_keys = await dbf.get_user_keys(user_id)
     all_orders = {'fbs': [], 'fbo': []} # Используем структуру словаря
     total_balance = 0.0
 
-    try:
-        # Сбор данных WB
-        if user_keys.get('wb_token'):
-            wb = WildberriesAPI(user_keys['wb_token'])
-            wb_data = await wb.get_all_orders(days=days)
-            all_orders['fbs'].extend(wb_data.get('fbs', []))
-            all_orders['fbo'].extend(wb_data.get('fbo', []))
-            total_balance += await wb.get_balance()
-
-        # Сбор данных Ozon
-        if user_keys.get('ozon_client_id') and user_keys.get('ozon_api_key'):
-            ozon = OzonAPI(user_keys['ozon_client_id'], user_keys['ozon_api_key'])
-            oz_data = await ozon.get_all_orders(days=days)
-            all_orders['fbs'].extend(oz_data.get('fbs', []))
-            all_orders['fbo'].extend(oz_data.get('fbo', []))
-            total_balance += await ozon.get_balance()
-
-        if not all_orders['fbs'] and not all_orders['fbo']:
-            await callback.message.edit_text(f"❌ За последние {days} дн. данных о заказах не найдено.")
-            return
-
-        # Генерация текста через единый модуль отчетов
-        report_text = await report_gen.generate_daily_report_text(
-            "Общий (WB+Ozon)", 
-            all_orders, 
-            user_tg_id=user_id, 
-            balance=total_balance
+    if _has_wb(user_keys) and _has_ozon(user_keys):
+        # Сбор данных WB и Ozon параллельно
+        collected = await asyncio.gather(
+            _collect_wb_profit_data(user_id, user_keys, days, wb_client),
+            _collect_ozon_profit_data(user_id, user_keys, days, ozon_client),
         )
-        
-        # Корректируем заголовок периода
-        period_label = "Вчера" if days == 1 else f"{days} дн."
-        report_text = report_text.replace("Вчера", period_label)
-        
-        await callback.message.edit_text(report_text, parse_mode="HTML")
+    else:
+        # Один маркетплейс (или ни одного): ненастроенная ветка возвращается сразу
+        collected = [
+            await _collect_wb_profit_data(user_id, user_keys, days, wb_client),
+            await _collect_ozon_profit_data(user_id, user_keys, days, ozon_client),
+        ]
+    for mp_data, mp_balance in collected:
+        all_orders['fbs'].extend(mp_data.get('fbs', []))
+        all_orders['fbo'].extend(mp_data.get('fbo', []))
+        total_balance += mp_balance
 
-    except Exception as e:
-        logger.error(f"Ошибка консолидированной аналитики: {e}", exc_info=True)
-        await callback.message.edit_text("❌ Ошибка при расчете. Проверьте корректность API ключей.")
-    
-    await callback.answer()
+    if not all_orders['fbs'] and not all_orders['fbo']:
+        return f"❌ За последние {days} дн. данных о заказах не найдено."
+
+    # Генерация текста через единый модуль отчетов (за 1 день — заголовок со вчерашней датой)
+    return await report_gen.generate_daily_report_text(
+        "Общий (WB+Ozon)", 
+        all_orders, 
+        user_tg_id=user_id, 
+        balance=total_balance,
+        period_label=None if days == 1 else f"{days} дн.",
+    )
 
-@router.callback_query(F.data == "check_api_cb")
-async def callback_check_api(callback: CallbackQuery):
-    """Триггер проверки API из инлайн-кнопок."""
+
+async def _collect_wb_profit_data(
+    user_id: int, user_keys: dict, days: int, wb_client: Optional[httpx.AsyncClient] = None
+) -> Tuple[Dict[str, list], float]:
+    """Заказы и баланс WB за период; если токена нет — пустые данные."""
+    if not _has_wb(user_keys):
+        return {}, 0.0
+    wb = _get_wb(user_id, user_keys['wb_token'], wb_client)
+    wb_data, wb_balance = await asyncio.gather(
+        wb.get_all_orders(days=days),
+        cached_call(balance_cache, (user_id, "wb"), wb.get_balance),
+    )
+    return wb_data, wb_balance
+
+
+async def _collect_ozon_profit_data(
+    user_id: int, user_keys: dict, days: int, ozon_client: Optional[httpx.AsyncClient] = None
+) -> Tuple[Dict[str, list], float]:
+    """Заказы и баланс Ozon за период; если ключей нет — пустые данные."""
+    if not _has_ozon(user_keys):
+        return {}, 0.0
+    ozon = _get_ozon(user_id, user_keys['ozon_client_id'], user_keys['ozon_api_key'], ozon_client)
+    oz_data, oz_balance = await asyncio.gather(
+        ozon.get_all_orders(days=days),
+        cached_call(balance_cache, (user_id, "ozon"), ozon.get_balance),
+    )
+    return oz_data, oz_balance
+
+
+# Собственный callback кнопки «🔄» из меню /profit: check_api_cb занят проверкой
+# ключей в настройках (settings.router)
+@router.callback_query(F.data == "refresh_balances_cb")
+async def callback_check_api(
+    callback: CallbackQuery,
+    wb_client: Optional[httpx.AsyncClient] = None,
+    ozon_client: Optional[httpx.AsyncClient] = None,
+):
+    """Триггер проверки API из инлайн-кнопок (кнопка «🔄» — балансы без кэша)."""
+    # Отвечаем на callback сразу, до долгих запросов к API
     await callback.answer()
-    # Перенаправляем логику на существующую функцию
-    await cmd_check_api(callback.message)
\ No newline at end of file
+    await _run_check_api(
+        callback.message,
+        callback.from_user.id,
+        wb_client=wb_client,
+        ozon_client=ozon_client,
+        reply_to_edit=callback.message,
+        force_refresh=True,
+    )
@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     InlineKeyboardMarkup, 
     InlineKeyboardButton, 
@@ -6,7 +9,7 @@ from aiogram.types import (
     WebAppInfo
 )
 
-def get_permanent_menu():
+def _build_permanent_menu():
     """
     Главное нижнее меню (Reply Keyboard).
     Обеспечивает быстрый доступ к основным функциям.
@@ -32,7 +35,7 @@ def get_permanent_menu():
         is_persistent=True
     )
 
-def get_finance_periods_menu():
+def _build_finance_periods_menu():
     """
     Меню выбора периода для финансового отчета (Чистая прибыль).
     Используется в хендлере show_finance_menu.
@@ -50,6 +53,7 @@ def get_finance_periods_menu():
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@lru_cache(maxsize=32)
 def get_products_inline_menu(webapp_url: str = None):
     """
     Инлайн-меню раздела управления товарами (Юнит-экономика).
@@ -71,7 +75,7 @@ def get_products_inline_menu(webapp_url: str = None):
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_orders_menu():
+def _build_orders_menu():
     """
     Меню выбора маркетплейса для просмотра текущих заказов (мониторинг).
     """
@@ -86,7 +90,7 @@ def get_orders_menu():
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_settings_inline_menu():
+def _build_settings_inline_menu():
     """
     Меню настроек и финансовой проверки.
     """
@@ -109,14 +113,64 @@ def get_settings_inline_menu():
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_cancel_kb():
+class ProfitCb(CallbackData, prefix="pr"):
+    """Кнопки периода отчета по прибыли: pr:<days>."""
+    days: int
+
+
+def _build_profit_menu():
+    """
+    Меню выбора периода для консолидированного отчета по прибыли (/profit).
+    """
+    buttons = [
+        [
+            InlineKeyboardButton(text="Вчера", callback_data=ProfitCb(days=1).pack()),
+            InlineKeyboardButton(text="7 дней", callback_data=ProfitCb(days=7).pack())
+        ],
+        [
+            InlineKeyboardButton(text="30 дней", callback_data=ProfitCb(days=30).pack()),
+            InlineKeyboardButton(text="🔄 Проверить балансы", callback_data="refresh_balances_cb")
+        ]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def _build_cancel_kb():
     """Кнопка отмены для состояний ожидания."""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")]
     ])
 
-def get_back_to_main():
+def _build_back_to_main():
     """Универсальная кнопка возврата."""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Вернуться в меню", callback_data="main_menu")]
-    ])
\ No newline at end of file
+    ])
+
+
+# Клавиатуры статичны: собираем один раз при импорте, хендлеры получают готовый объект
+PERMANENT_MENU = _build_permanent_menu()
+FINANCE_PERIODS_MENU = _build_finance_periods_menu()
+ORDERS_MENU = _build_orders_menu()
+SETTINGS_INLINE_MENU = _build_settings_inline_menu()
+PROFIT_MENU = _build_profit_menu()
+CANCEL_KB = _build_cancel_kb()
+BACK_TO_MAIN = _build_back_to_main()
+
+
+def get_permanent_menu():
+    return PERMANENT_MENU
+
+def get_finance_periods_menu():
+    return FINANCE_PERIODS_MENU
+
+def get_orders_menu():
+    return ORDERS_MENU
+
+def get_settings_inline_menu():
+    return SETTINGS_INLINE_MENU
+
+def get_cancel_kb():
+    return CANCEL_KB
+
+def get_back_to_main():
+    return BACK_TO_MAIN
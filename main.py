@@ -14,38 +14,48 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from typing import Optional
 
 import uvicorn
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from pytz import timezone
+from redis.asyncio import Redis
 
 from config import config
 from database import init_db
 
-from handlers import common, reports, settings
+from handlers import common, reports, settings, user_handlers
 
-# ВАЖНО: убедись, что используешь один файл задач.
-# В проекте у тебя есть scheduler_tasks.py и scheduler_task.py.
-# Этот main.py импортирует scheduler_tasks.py как и было ранее.
+# Фоновые задачи живут только в scheduler_tasks.py
 from scheduler_tasks import (
     check_new_orders_task,
     send_morning_report,
     check_low_stock_task,
+    set_wb_http_client,
 )
 
 from admin_panel import app as admin_app
+from middlewares import ApiClientsMiddleware
+from ozon_api import get_shared_client as get_ozon_client
+from wb_api import get_shared_client as get_wb_client
 
 
-def setup_logging() -> None:
+def setup_logging() -> QueueListener:
     """
     Комплексная настройка логирования с ротацией файлов.
+    Запись в консоль/файл выполняет фоновый поток QueueListener: event loop только кладёт
+    записи в очередь и не блокируется на диске. Listener нужно остановить при завершении.
     """
     root_logger = logging.getLogger()
 
@@ -59,7 +69,6 @@ def setup_logging() -> None:
     # 1) Консоль
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    root_logger.addHandler(console_handler)
 
     # 2) Файл (макс 5МБ, храним 5 последних копий)
     file_handler = RotatingFileHandler(
@@ -69,7 +78,12 @@ def setup_logging() -> None:
         encoding="utf-8",
     )
     file_handler.setFormatter(formatter)
-    root_logger.addHandler(file_handler)
+
+    # 3) Корневой логгер пишет только в очередь, реальный вывод — в потоке listener
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
 
     # Уменьшаем уровень шума от сторонних библиотек
     logging.getLogger("aiogram.event").setLevel(logging.WARNING)
@@ -77,6 +91,8 @@ def setup_logging() -> None:
     logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
     logging.getLogger("apscheduler").setLevel(logging.INFO)
 
+    return listener
+
 
 def _build_scheduler(tz_name: str) -> AsyncIOScheduler:
     """
@@ -143,6 +159,17 @@ def _schedule_jobs(scheduler: AsyncIOScheduler, bot: Bot) -> None:
     )
 
 
+def _build_fsm_storage() -> BaseStorage:
+    """
+    Хранилище FSM: Redis, если задан REDIS_URL (состояния переживают рестарт,
+    можно запускать несколько экземпляров бота), иначе память процесса.
+    """
+    if config.redis_url:
+        logging.info("FSM storage: Redis")
+        return RedisStorage(redis=Redis.from_url(config.redis_url, decode_responses=False))
+    return MemoryStorage()
+
+
 async def _start_admin_panel() -> Optional[asyncio.Task]:
     """
     Запускает FastAPI админку (uvicorn) в фоне.
@@ -177,11 +204,40 @@ async def _start_admin_panel() -> Optional[asyncio.Task]:
         return None
 
 
+async def _start_webhook(dp: Dispatcher, bot: Bot) -> web.AppRunner:
+    """
+    Поднимает aiohttp-сервер для приёма апдейтов Telegram (webhook) в том же event loop
+    и регистрирует webhook. Telegram сам присылает апдейты — без цикла long polling.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.webhook_secret or None,
+    ).register(app, path=config.webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=config.webhook_host, port=config.webhook_port)
+    await site.start()
+
+    webhook_url = config.webhook_url.rstrip("/") + config.webhook_path
+    await bot.set_webhook(
+        webhook_url,
+        drop_pending_updates=True,
+        allowed_updates=dp.resolve_used_update_types(),
+        secret_token=config.webhook_secret or None,
+    )
+    logging.info(f"Webhook: {webhook_url} (слушаем {config.webhook_host}:{config.webhook_port})")
+    return runner
+
+
 async def main() -> None:
     """
     Главная точка входа. Запускает Telegram Bot, APScheduler и FastAPI-админку.
     """
-    setup_logging()
+    log_listener = setup_logging()
     logging.info("=== СТАРТ ПРИЛОЖЕНИЯ MARKETPLACE BOT ===")
 
     # Шаг 1: Инициализация БД
@@ -194,16 +250,23 @@ async def main() -> None:
         token=config.bot_token.get_secret_value(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher(storage=MemoryStorage())
+    storage = _build_fsm_storage()
+    dp = Dispatcher(storage=storage)
 
     # Регистрируем роутеры
     dp.include_router(common.router)
     dp.include_router(reports.router)
     dp.include_router(settings.router)
+    # /check_api, /profit и кнопки периода прибыли
+    dp.include_router(user_handlers.router)
 
-    # Если у тебя есть middlewares.py — сюда можно подключить:
-    # from middlewares import SomeMiddleware
-    # dp.message.middleware(SomeMiddleware())
+    # Общие HTTP-клиенты WB/Ozon (переиспользование TCP+TLS соединений между вызовами)
+    # Общие клиенты модулей wb_api/ozon_api — их же используют задачи планировщика
+    wb_client = get_wb_client()
+    ozon_client = get_ozon_client()
+    dp.update.middleware(ApiClientsMiddleware(wb_client, ozon_client))
+    # Задачи планировщика ходят в WB через тот же пул соединений
+    set_wb_http_client(wb_client)
 
     # Шаг 3: Планировщик
     scheduler = _build_scheduler(config.timezone)
@@ -215,12 +278,18 @@ async def main() -> None:
     # Шаг 4: Админка FastAPI в фоне
     web_task: Optional[asyncio.Task] = await _start_admin_panel()
 
-    # Шаг 5: Запуск Long Polling
-    await bot.delete_webhook(drop_pending_updates=True)
+    # Шаг 5: Приём апдейтов — webhook (если задан WEBHOOK_URL) или Long Polling
+    webhook_runner: Optional[web.AppRunner] = None
 
     try:
-        logging.info("Бот вышел в онлайн и готов к работе.")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if config.webhook_url:
+            webhook_runner = await _start_webhook(dp, bot)
+            logging.info("Бот вышел в онлайн и готов к работе (webhook).")
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logging.info("Бот вышел в онлайн и готов к работе.")
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except (asyncio.CancelledError, KeyboardInterrupt, SystemExit):
         logging.info("Остановка по сигналу/прерыванию.")
     except Exception as e:
@@ -235,6 +304,13 @@ async def main() -> None:
         except Exception as e:
             logging.error(f"Ошибка остановки APScheduler: {e}")
 
+        # Останавливаем приём webhook
+        if webhook_runner is not None:
+            try:
+                await webhook_runner.cleanup()
+            except Exception as e:
+                logging.error(f"Ошибка остановки webhook-сервера: {e}")
+
         # Останавливаем веб задачу
         if web_task is not None:
             try:
@@ -249,12 +325,36 @@ async def main() -> None:
         except Exception as e:
             logging.error(f"Ошибка закрытия сессии бота: {e}")
 
+        # Закрываем хранилище FSM (соединение с Redis)
+        try:
+            await storage.close()
+        except Exception as e:
+            logging.error(f"Ошибка закрытия FSM storage: {e}")
+
+        # Закрываем общие HTTP-клиенты маркетплейсов
+        for http_client in (wb_client, ozon_client):
+            try:
+                await http_client.aclose()
+            except Exception as e:
+                logging.error(f"Ошибка закрытия HTTP-клиента: {e}")
+
         logging.info("Приложение полностью остановлено.")
 
+        # Сбрасываем оставшиеся в очереди записи логов и останавливаем поток записи
+        log_listener.stop()
+
 
 if __name__ == "__main__":
     if sys.platform == "win32":
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    elif config.use_uvloop:
+        # Цикл меняется для всего процесса (aiogram, APScheduler, драйвер БД) — только по явному флагу
+        try:
+            import uvloop
+
+            uvloop.install()
+        except ImportError:
+            logging.warning("USE_UVLOOP включен, но uvloop не установлен — используется стандартный цикл.")
 
     try:
         asyncio.run(main())
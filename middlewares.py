@@ -1,5 +1,5 @@
 import logging
-from typing import Any, Awaitable, Callable, Dict
+from typing import Any, Awaitable, Callable, Dict, Optional
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
@@ -10,10 +10,38 @@ from states import SetupKeys
 # Настройка логгера
 logger = logging.getLogger(__name__)
 
+# Состояния, в которых пользователь присылает API токены — их текст не логируем
+SENSITIVE_STATES = (
+    SetupKeys.waiting_for_wb_token,
+    SetupKeys.waiting_for_ozon_api_key,
+)
+
+
+def _user_info(data: Dict[str, Any]) -> str:
+    """Строка вида 'ID:123 | @username' для логов."""
+    user = data.get("event_from_user")
+    user_id = user.id if user else "Unknown"
+    username = f"@{user.username}" if user and user.username else "no_username"
+    return f"ID:{user_id} | {username}"
+
+
+async def get_cached_state(data: Dict[str, Any], state: Optional[FSMContext]) -> Optional[str]:
+    """
+    Текущее состояние FSM: берём уже прочитанное UserActionLogger (data["_fsm_state"]),
+    иначе читаем из хранилища. Актуально до первого set_state/clear в хендлере.
+    """
+    if "_fsm_state" in data:
+        return data["_fsm_state"]
+    current_state = await state.get_state() if state else None
+    data["_fsm_state"] = current_state
+    return current_state
+
+
 class UserActionLogger(BaseMiddleware):
     """
     Middleware для логирования действий пользователей и безопасности данных.
     Автоматически маскирует API ключи и защищает чувствительную информацию.
+    Если уровень INFO отключен, никакой работы по форматированию не делает.
     """
     async def __call__(
         self,
@@ -21,45 +49,32 @@ class UserActionLogger(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        # Извлекаем информацию о пользователе и состоянии
-        user = data.get("event_from_user")
-        state: FSMContext = data.get("state")
-        
-        user_id = user.id if user else "Unknown"
-        username = f"@{user.username}" if user and user.username else "no_username"
-        user_info = f"ID:{user_id} | {username}"
+        if logger.isEnabledFor(logging.INFO):
+            if isinstance(event, Message):
+                # Получаем текущее состояние FSM
+                current_state = await get_cached_state(data, data.get("state"))
+                
+                # 1. Защита API токенов / 2. Логирование сообщений
+                if current_state in SENSITIVE_STATES:
+                    content = "[SENSITIVE_DATA_MASKED]"
+                elif event.document:
+                    # Маскируем имя файла, если это загрузка Excel с себестоимостью
+                    content = f"[DOCUMENT: {event.document.file_name}]"
+                else:
+                    content = event.text or f"[{event.content_type}]"
+                
+                logger.info("👤 MSG [%s]: %s", _user_info(data), content)
 
-        if isinstance(event, Message):
-            # Получаем текущее состояние FSM
-            current_state = await state.get_state() if state else None
-            
-            # 1. Защита API токенов
-            sensitive_states = [
-                SetupKeys.waiting_for_wb_token, 
-                SetupKeys.waiting_for_ozon_api_key
-            ]
-            
-            # 2. Логирование сообщений
-            if current_state in sensitive_states:
-                content = "[SENSITIVE_DATA_MASKED]"
-            elif event.document:
-                # Маскируем имя файла, если это загрузка Excel с себестоимостью
-                content = f"[DOCUMENT: {event.document.file_name}]"
-            else:
-                content = event.text or f"[{event.content_type}]"
-            
-            logger.info(f"👤 MSG [{user_info}]: {content}")
-
-        elif isinstance(event, CallbackQuery):
-            # 3. Логирование нажатий кнопок
-            logger.info(f"🔘 BTN [{user_info}]: data='{event.data}'")
+            elif isinstance(event, CallbackQuery):
+                # 3. Логирование нажатий кнопок
+                logger.info("🔘 BTN [%s]: data='%s'", _user_info(data), event.data)
 
         # Передаем управление дальше по цепочке
         try:
             return await handler(event, data)
         except Exception as e:
             # Централизованное логирование ошибок выполнения хендлеров
-            logger.error(f"❌ ERROR [{user_info}]: {e}", exc_info=True)
+            logger.error(f"❌ ERROR [{_user_info(data)}]: {e}", exc_info=True)
             raise e
 
 # Дополнительный полезный Middleware для Шага 2
@@ -75,4 +90,25 @@ class DatabaseSessionMiddleware(BaseMiddleware):
         data: Dict[str, Any]
     ) -> Any:
         # Здесь можно внедрить зависимости, которые понадобятся в каждом хендлере
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
+
+
+class ApiClientsMiddleware(BaseMiddleware):
+    """
+    Прокидывает в хендлеры общие httpx.AsyncClient для API маркетплейсов
+    (data["wb_client"], data["ozon_client"]), чтобы обёртки WildberriesAPI/OzonAPI
+    переиспользовали keep-alive соединения вместо нового TCP+TLS на каждый вызов.
+    """
+    def __init__(self, wb_client: Any, ozon_client: Any) -> None:
+        self.wb_client = wb_client
+        self.ozon_client = ozon_client
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        data["wb_client"] = self.wb_client
+        data["ozon_client"] = self.ozon_client
+        return await handler(event, data)
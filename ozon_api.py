@@ -1,8 +1,13 @@
 """
-Версия файла: 1.2.0
+Версия файла: 1.3.0
 Описание: Клиент Ozon Seller API (заказы, остатки, товары, финансы, позиции). Устойчив к ошибкам сети/лимитам.
-Дата изменения: 2026-01-22
+Единственная реализация OzonAPI в проекте; все вызовы используют сигнатуру OzonAPI(client_id, api_key).
+Дата изменения: 2026-10-15
 Изменения:
+- Общий на процесс httpx.AsyncClient (keep-alive 60 с) вместо клиента на каждый запрос.
+- Параллельные запросы FBS/FBO, батчей info/list и страниц отчёта транзакций (с семафором).
+- Кэш и склейка одинаковых запросов (баланс, склады, каталог), общая пауза по 429, backoff с джиттером.
+- orjson для сериализации запросов и разбора ответов.
 - Переработан _make_request: единый AsyncClient, таймауты, ретраи с backoff, обработка 401/403/429/5xx.
 - Добавлены безопасные парсеры и нормализация данных (offer_id/article/price/date).
 - get_all_orders и get_daily_stats возвращают консистентный формат {'fbs': [...], 'fbo': [...]}.
@@ -14,15 +19,111 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
+import random
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple, Union
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import httpx
+import orjson
+
+from cache import SingleFlight, TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Пул соединений к api-seller.ozon.ru; keep-alive 60 с (меньше idle-таймаута nginx 75 с),
+# чтобы сокеты переживали паузы между страницами и интервалы опроса
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+
+# Общий на процесс клиент: все экземпляры OzonAPI без явного client переиспользуют
+# одни keep-alive соединения вместо TCP+TLS рукопожатия на каждый запрос
+_shared_client: Optional[httpx.AsyncClient] = None
+
+
+def get_shared_client() -> httpx.AsyncClient:
+    """Общий httpx.AsyncClient для Ozon API (создаётся лениво, пересоздаётся после закрытия)."""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        # HTTP/2: параллельные батчи мультиплексируются в одном соединении (нужен пакет h2)
+        _shared_client = httpx.AsyncClient(timeout=60.0, limits=_LIMITS, http2=True)
+    return _shared_client
+
+
+async def close_shared_client() -> None:
+    """Закрывает общий клиент (при остановке приложения)."""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
+
+# Нормализация числовых строк одним C-вызовом translate: "1 234,5" -> "1234.5"
+_FLOAT_TRANS = str.maketrans({",": ".", " ": "", "\u00a0": ""})
+
+
+def _safe_str(value: Any, max_len: int = 255, default: str = "") -> str:
+    s = str(value).strip() if value is not None else default
+    if not s:
+        s = default
+    return s[:max_len]
+
+
+def _safe_float(value: Any, default: float = 0.0) -> float:
+    try:
+        if value is None:
+            return default
+        if isinstance(value, str):
+            v = value.translate(_FLOAT_TRANS).strip()
+            if v == "":
+                return default
+            return float(v)
+        return float(value)
+    except Exception:
+        return default
+
+
+def _norm_article(value: Any) -> str:
+    return _safe_str(value, max_len=128, default="").upper()
+
+
+_get_present = itemgetter("present")
+
+
+def _sum_present(stocks: Dict[str, Any]) -> int:
+    """
+    Сумма present по складам из блока stocks карточки info/list.
+    Быстрый путь — itemgetter по числам из JSON; при пропусках/None/строках — поштучно с приведением.
+    """
+    inner = stocks.get("stocks")
+    if not isinstance(inner, list):
+        return int(stocks.get("present", 0) or 0)
+    try:
+        return int(sum(map(_get_present, inner)))
+    except (KeyError, TypeError):
+        # склады могут иметь present/reserved
+        return sum(int(s.get("present", 0) or 0) for s in inner if isinstance(s, dict))
+
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Разбивает последовательность на списки по size элементов (аналог itertools.batched из 3.12)."""
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+# Поля /v3/product/info/list, которые реально читают get_all_products и отчёты по остаткам
+INFO_ITEM_FIELDS = ("offer_id", "id", "product_id", "name", "stocks", "fbs_stocks", "fbo_stocks")
+
+
+def _slim_info_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Оставляет от карточки info/list только нужные поля: тяжёлые вложенные структуры
+    (images, commissions, prices и т.п.) освобождаются сразу после разбора батча.
+    """
+    return {k: item[k] for k in INFO_ITEM_FIELDS if k in item}
+
 
 class OzonAPI:
     """
@@ -34,6 +135,9 @@ class OzonAPI:
 
     BASE_URL = "https://api-seller.ozon.ru"
 
+    # Сколько независимых запросов (батчи info/list, страницы отчётов) держим в полёте одновременно
+    MAX_PARALLEL_REQUESTS = 5
+
     def __init__(
         self,
         client_id: str,
@@ -42,12 +146,27 @@ class OzonAPI:
         timeout: float = 30.0,
         max_retries: int = 3,
         debug: bool = False,
+        client: Optional[httpx.AsyncClient] = None,
     ):
+        """
+        client — httpx.AsyncClient с keep-alive пулом соединений к api-seller.ozon.ru.
+        Если не передан, используется общий клиент модуля (get_shared_client).
+        """
         self.client_id = str(client_id).strip()
         self.api_key = str(api_key).strip()
         self.timeout = float(timeout)
         self.max_retries = int(max_retries)
         self.debug = bool(debug)
+        self.client = client
+
+        # Ответы идемпотентных запросов (баланс, список складов): короткий TTL + склейка
+        # одновременных одинаковых запросов в один HTTP-вызов
+        self._response_cache = TTLCache(maxsize=64, ttl=30.0)
+        self._inflight = SingleFlight()
+
+        # Общая «заслонка» запросов клиента: закрывается на Retry-After при 429
+        self._rate_gate = asyncio.Event()
+        self._rate_gate.set()
 
         self.headers = {
             "Client-Id": self.client_id,
@@ -60,35 +179,14 @@ class OzonAPI:
     # Utils
     # -------------------------------------------------------------------------
 
-    def _safe_str(self, value: Any, max_len: int = 255, default: str = "") -> str:
-        s = str(value).strip() if value is not None else default
-        if not s:
-            s = default
-        return s[:max_len]
-
-    def _safe_float(self, value: Any, default: float = 0.0) -> float:
-        try:
-            if value is None:
-                return default
-            if isinstance(value, str):
-                v = value.strip().replace(" ", "").replace(",", ".")
-                if v == "":
-                    return default
-                return float(v)
-            return float(value)
-        except Exception:
-            return default
-
-    def _norm_article(self, value: Any) -> str:
-        return self._safe_str(value, max_len=128, default="").upper()
-
     def _fmt_dt_range(self, date_from: datetime, date_to: datetime) -> Tuple[str, str]:
         """
         Ozon ожидает ISO с Z.
         """
+        # date().isoformat() — без разбора шаблона strftime
         return (
-            date_from.strftime("%Y-%m-%dT00:00:00Z"),
-            date_to.strftime("%Y-%m-%dT23:59:59Z"),
+            f"{date_from.date().isoformat()}T00:00:00Z",
+            f"{date_to.date().isoformat()}T23:59:59Z",
         )
 
     # -------------------------------------------------------------------------
@@ -110,69 +208,132 @@ class OzonAPI:
         url = f"{self.base_url}{endpoint}"
         t = float(timeout) if timeout is not None else self.timeout
 
-        # Backoff: 1s, 2s, 4s ... (с потолком)
+        # Backoff с декоррелированным джиттером: sleep = uniform(base, prev*3) с потолком —
+        # параллельные запросы, получившие ошибку одновременно, не повторяют её синхронно
         base_sleep = 1.0
+        prev_sleep = base_sleep
 
-        limits = httpx.Limits(max_connections=20, max_keepalive_connections=10)
-        async with httpx.AsyncClient(headers=self.headers, timeout=t, limits=limits) as client:
-            for attempt in range(1, self.max_retries + 1):
-                try:
-                    resp = await client.request(method, url, json=payload)
+        def next_backoff(cap: float) -> float:
+            nonlocal prev_sleep
+            prev_sleep = min(cap, random.uniform(base_sleep, max(base_sleep, prev_sleep * 3)))
+            return prev_sleep
 
-                    # 200 OK
-                    if resp.status_code == 200:
-                        try:
-                            return resp.json()
-                        except Exception as e:
-                            logger.error(f"Ozon JSON decode error {endpoint}: {e}")
-                            return None
+        # Клиентом владеет приложение/модуль — здесь его не закрываем
+        client = self.client if self.client is not None else get_shared_client()
 
-                    # Auth errors - ретраить бессмысленно
-                    if resp.status_code in (401, 403):
-                        logger.error(
-                            f"Ozon auth error {endpoint}: {resp.status_code} - {resp.text[:300]}"
-                        )
+        # Тело сериализуем один раз (orjson) и переиспользуем во всех попытках;
+        # Content-Type: application/json уже есть в self.headers
+        body = orjson.dumps(payload) if payload is not None else None
+
+        for attempt in range(1, self.max_retries + 1):
+            # Ждём, если другой запрос этого клиента получил 429 и объявил паузу
+            await self._rate_gate.wait()
+            try:
+                resp = await client.request(method, url, content=body, headers=self.headers, timeout=t)
+
+                # 200 OK
+                if resp.status_code == 200:
+                    try:
+                        return orjson.loads(resp.content)
+                    except Exception as e:
+                        logger.error("Ozon JSON decode error %s: %s", endpoint, e)
                         return None
 
-                    # Rate limit / transient server errors
-                    if resp.status_code in (429, 500, 502, 503, 504):
-                        # Если Ozon отдаёт Retry-After — учитываем
-                        retry_after = resp.headers.get("Retry-After")
-                        if retry_after:
-                            try:
-                                sleep_s = max(1.0, float(retry_after))
-                            except Exception:
-                                sleep_s = base_sleep * (2 ** (attempt - 1))
-                        else:
-                            sleep_s = base_sleep * (2 ** (attempt - 1))
-
-                        sleep_s = min(sleep_s, 20.0)
-
-                        logger.warning(
-                            f"Ozon transient error {endpoint}: {resp.status_code}, attempt {attempt}/{self.max_retries}, sleep {sleep_s}s"
+                # Auth errors - ретраить бессмысленно
+                if resp.status_code in (401, 403):
+                    if logger.isEnabledFor(logging.ERROR):
+                        logger.error(
+                            "Ozon auth error %s: %s - %s", endpoint, resp.status_code, resp.text[:300]
                         )
-                        await asyncio.sleep(sleep_s)
-                        continue
-
-                    # Остальные коды — считаем ошибкой
-                    logger.error(
-                        f"Ozon API error {endpoint}: {resp.status_code} - {resp.text[:500]}"
-                    )
                     return None
 
-                except (httpx.TimeoutException, httpx.NetworkError) as e:
-                    sleep_s = min(base_sleep * (2 ** (attempt - 1)), 10.0)
+                # Rate limit / transient server errors
+                if resp.status_code in (429, 500, 502, 503, 504):
+                    # Если Ozon отдаёт Retry-After — учитываем
+                    retry_after = resp.headers.get("Retry-After")
+                    if retry_after:
+                        try:
+                            sleep_s = max(1.0, float(retry_after))
+                        except Exception:
+                            sleep_s = next_backoff(20.0)
+                    else:
+                        sleep_s = next_backoff(20.0)
+
+                    sleep_s = min(sleep_s, 20.0)
+
                     logger.warning(
-                        f"Ozon connection/timeout {endpoint}: {e} (attempt {attempt}/{self.max_retries}), sleep {sleep_s}s"
+                        "Ozon transient error %s: %s, attempt %d/%d, sleep %.2fs",
+                        endpoint, resp.status_code, attempt, self.max_retries, sleep_s,
                     )
-                    await asyncio.sleep(sleep_s)
+                    if resp.status_code == 429:
+                        # Лимит общий для ключа: ставим на паузу все параллельные запросы клиента,
+                        # а не только текущий (ожидание — в начале следующей попытки)
+                        self._pause_requests(sleep_s)
+                    else:
+                        await asyncio.sleep(sleep_s)
                     continue
-                except Exception as e:
-                    logger.error(f"Ozon unexpected error {endpoint}: {e}")
-                    return None
+
+                # Остальные коды — считаем ошибкой
+                if logger.isEnabledFor(logging.ERROR):
+                    logger.error(
+                        "Ozon API error %s: %s - %s", endpoint, resp.status_code, resp.text[:500]
+                    )
+                return None
+
+            except (httpx.TimeoutException, httpx.NetworkError) as e:
+                sleep_s = next_backoff(10.0)
+                logger.warning(
+                    "Ozon connection/timeout %s: %s (attempt %d/%d), sleep %.2fs",
+                    endpoint, e, attempt, self.max_retries, sleep_s,
+                )
+                await asyncio.sleep(sleep_s)
+                continue
+            except Exception as e:
+                logger.error("Ozon unexpected error %s: %s", endpoint, e)
+                return None
 
         return None
 
+    def _pause_requests(self, seconds: float) -> None:
+        """Закрывает заслонку на seconds секунд (повторный 429 во время паузы её не продлевает)."""
+        if not self._rate_gate.is_set():
+            return
+        self._rate_gate.clear()
+        asyncio.get_running_loop().call_later(seconds, self._rate_gate.set)
+
+    async def _cached(
+        self,
+        key: Any,
+        ttl: float,
+        factory: Callable[[], Awaitable[Any]],
+        cache_if: Callable[[Any], bool] = lambda r: r is not None,
+    ) -> Any:
+        """
+        Результат factory() с кэшированием на ttl секунд: свежее значение берётся из кэша,
+        одновременные одинаковые вызовы ждут один общий. Кэшируется только то, что прошло cache_if
+        (ошибки/пустые ответы не запоминаем). Возвращаемые объекты общие — не изменять.
+        """
+        cached = self._response_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = await self._inflight.run(key, factory)
+        if cache_if(result):
+            self._response_cache.set(key, result, ttl=ttl)
+        return result
+
+    async def _cached_request(self, endpoint: str, payload: dict, ttl: float) -> Optional[dict]:
+        """_make_request для идемпотентных эндпоинтов через _cached (ключ — эндпоинт + payload)."""
+        key = (endpoint, orjson.dumps(payload, option=orjson.OPT_SORT_KEYS))
+        return await self._cached(key, ttl, lambda: self._make_request(endpoint, payload))
+
+    def invalidate_cache(self) -> None:
+        """
+        Сбрасывает кэш ответов клиента. Вызывать после операций записи в Ozon
+        (сейчас клиент только читает данные).
+        """
+        self._response_cache.clear()
+
     # -------------------------------------------------------------------------
     # Public methods
     # -------------------------------------------------------------------------
@@ -187,7 +348,7 @@ class OzonAPI:
             "date_from": (now - timedelta(days=2)).strftime("%Y-%m-%d"),
             "date_to": now.strftime("%Y-%m-%d"),
         }
-        result = await self._make_request("/v1/finance/balance", payload)
+        result = await self._cached_request("/v1/finance/balance", payload, ttl=30.0)
         if not result:
             return 0.0
 
@@ -200,9 +361,14 @@ class OzonAPI:
 
     async def check_connection(self) -> Tuple[bool, float]:
         """
-        Быстрая проверка работоспособности ключей.
+        Быстрая проверка работоспособности ключей (успешный результат кэшируется на 60 с).
         """
-        wh_check = await self._make_request("/v1/warehouse/list", {})
+        return await self._cached(
+            "check_connection", 60.0, self._check_connection, cache_if=lambda r: bool(r[0])
+        )
+
+    async def _check_connection(self) -> Tuple[bool, float]:
+        wh_check = await self._cached_request("/v1/warehouse/list", {}, ttl=600.0)
         if wh_check and ("result" in wh_check or isinstance(wh_check, list)):
             balance = await self.get_balance()
             return True, balance
@@ -232,34 +398,7 @@ class OzonAPI:
             "with": {"financial_data": True},
         }
 
-        results: Dict[str, List[Dict[str, Any]]] = {"fbs": [], "fbo": []}
-
-        # FBS
-        fbs_res = await self._make_request("/v3/posting/fbs/list", payload)
-        if fbs_res:
-            postings = fbs_res.get("result", {}).get("postings", [])
-            if isinstance(postings, list):
-                for p in postings:
-                    if not isinstance(p, dict):
-                        continue
-                    results["fbs"].append(p)
-
-        # FBO
-        fbo_res = await self._make_request("/v2/posting/fbo/list", payload)
-        if fbo_res:
-            # В некоторых методах result может быть списком
-            data = fbo_res.get("result", fbo_res)
-            if isinstance(data, dict):
-                postings = data.get("postings") or data.get("result") or []
-            else:
-                postings = data
-            if isinstance(postings, list):
-                for p in postings:
-                    if not isinstance(p, dict):
-                        continue
-                    results["fbo"].append(p)
-
-        return results
+        return await self._fetch_fbs_fbo(payload)
 
     async def get_daily_stats(self, date_str: str) -> Dict[str, List[Dict[str, Any]]]:
         """
@@ -281,25 +420,50 @@ class OzonAPI:
             "with": {"financial_data": True},
         }
 
-        results: Dict[str, List[Dict[str, Any]]] = {"fbs": [], "fbo": []}
+        return await self._fetch_fbs_fbo(payload)
 
-        fbs_res = await self._make_request("/v3/posting/fbs/list", payload)
-        if fbs_res:
-            postings = fbs_res.get("result", {}).get("postings", [])
-            if isinstance(postings, list):
-                results["fbs"] = [p for p in postings if isinstance(p, dict)]
+    async def _fetch_fbs_fbo(self, payload: dict) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        FBS и FBO отправления по одному фильтру. Запросы независимы — выполняем параллельно;
+        ошибка одного из них не мешает второму (соответствующий список будет пустым).
+        """
+        fbs_res, fbo_res = await asyncio.gather(
+            self._make_request("/v3/posting/fbs/list", payload),
+            self._make_request("/v2/posting/fbo/list", payload),
+            return_exceptions=True,
+        )
 
-        fbo_res = await self._make_request("/v2/posting/fbo/list", payload)
-        if fbo_res:
-            data = fbo_res.get("result", fbo_res)
-            if isinstance(data, dict):
-                postings = data.get("postings") or data.get("result") or []
-            else:
-                postings = data
-            if isinstance(postings, list):
-                results["fbo"] = [p for p in postings if isinstance(p, dict)]
+        if isinstance(fbs_res, BaseException):
+            logger.error("Ozon FBS list error: %s", fbs_res)
+            fbs_res = None
+        if isinstance(fbo_res, BaseException):
+            logger.error("Ozon FBO list error: %s", fbo_res)
+            fbo_res = None
 
-        return results
+        return {
+            "fbs": self._extract_postings(fbs_res),
+            "fbo": self._extract_postings(fbo_res),
+        }
+
+    @staticmethod
+    def _extract_postings(
+        res: Optional[dict], key_candidates: Tuple[str, ...] = ("postings", "result")
+    ) -> List[Dict[str, Any]]:
+        """
+        Список записей из ответа Ozon: result может быть списком или dict с одним
+        из ключей key_candidates. Нестандартные элементы (не dict) отбрасываются.
+        """
+        if not res:
+            return []
+        data = res.get("result", res) if res.__class__ is dict else res
+        if data.__class__ is dict:
+            postings = next((data[k] for k in key_candidates if data.get(k).__class__ is list), [])
+        else:
+            postings = data
+        if postings.__class__ is not list:
+            return []
+        # JSON-парсер отдаёт ровно dict, подклассов не бывает — __class__ is дешевле isinstance
+        return [p for p in postings if p.__class__ is dict]
 
     async def get_stock_info(self) -> List[Dict[str, Any]]:
         """
@@ -307,18 +471,29 @@ class OzonAPI:
         1) /v3/product/list (получаем product_id)
         2) /v3/product/info/list (получаем stocks и прочее)
 
-        Возвращает список items (детальные структуры Ozon).
+        Возвращает список items, урезанных до полей INFO_ITEM_FIELDS (идентификаторы, название, остатки).
+        Каталог меняется медленно: непустой результат кэшируется на 5 минут.
         """
+        return await self._cached("stock_info", 300.0, self._fetch_stock_info, cache_if=bool)
+
+    async def _fetch_stock_info(self) -> List[Dict[str, Any]]:
         all_product_ids: List[int] = []
-        last_id: str = ""
 
-        # 1) Сбор product_id
-        while True:
+        def list_payload(last_id: str) -> Dict[str, Any]:
             payload: Dict[str, Any] = {"filter": {"visibility": "ALL"}, "limit": 1000}
             if last_id:
                 payload["last_id"] = last_id
+            return payload
 
-            list_res = await self._make_request("/v3/product/list", payload)
+        # 1) Сбор product_id. Страницы связаны через last_id, но следующую запрашиваем
+        # сразу, как только он известен, — параллельно с разбором текущей
+        last_id: str = ""
+        next_task: Optional[asyncio.Task] = asyncio.create_task(
+            self._make_request("/v3/product/list", list_payload(last_id))
+        )
+        while next_task is not None:
+            list_res = await next_task
+            next_task = None
             if not list_res:
                 logger.error("Ozon get_stock_info: /v3/product/list вернул None")
                 break
@@ -328,7 +503,15 @@ class OzonAPI:
                 items = []
 
             if self.debug:
-                logger.info(f"Ozon DEBUG: /v3/product/list items={len(items)} last_id={last_id}")
+                logger.info("Ozon DEBUG: /v3/product/list items=%d last_id=%s", len(items), last_id)
+
+            # Конец — когда Ozon не отдал курсор, вернул тот же или пустую страницу
+            # (короткая страница сама по себе концом не считается)
+            prev_last_id, last_id = last_id, list_res.get("result", {}).get("last_id", "")
+            if items and last_id and last_id != prev_last_id:
+                next_task = asyncio.create_task(
+                    self._make_request("/v3/product/list", list_payload(last_id))
+                )
 
             for p in items:
                 if not isinstance(p, dict):
@@ -340,49 +523,42 @@ class OzonAPI:
                     except Exception:
                         continue
 
-            last_id = list_res.get("result", {}).get("last_id", "")
-            if not last_id or len(items) < 1000:
-                break
-
-            await asyncio.sleep(0.1)
-
         if not all_product_ids:
             logger.warning("Ozon get_stock_info: product_id список пуст.")
             return []
 
-        # 2) Сбор деталей по батчам
-        all_details: List[Dict[str, Any]] = []
-        for i in range(0, len(all_product_ids), 100):
-            chunk = all_product_ids[i : i + 100]
-            info_payload = {"product_id": chunk}
+        # 2) Сбор деталей по батчам: несколько запросов одновременно, семафор ограничивает нагрузку
+        sem = asyncio.Semaphore(self.MAX_PARALLEL_REQUESTS)
 
-            if self.debug:
-                # ограничим размер лога
-                logger.info(f"Ozon DEBUG: /v3/product/info/list batch size={len(chunk)}")
+        async def fetch(chunk: List[int]) -> List[Dict[str, Any]]:
+            async with sem:
+                if self.debug:
+                    # ограничим размер лога
+                    logger.info("Ozon DEBUG: /v3/product/info/list batch size=%d", len(chunk))
+                info_res = await self._make_request("/v3/product/info/list", {"product_id": chunk})
 
-            info_res = await self._make_request("/v3/product/info/list", info_payload)
             if not info_res:
                 logger.error("Ozon get_stock_info: /v3/product/info/list вернул None")
-                await asyncio.sleep(0.2)
-                continue
+                return []
 
             res_data = info_res.get("result")
-            chunk_items: List[Dict[str, Any]] = []
-
             if isinstance(res_data, dict):
                 items = res_data.get("items", [])
                 if isinstance(items, list):
-                    chunk_items = [x for x in items if isinstance(x, dict)]
+                    return [_slim_info_item(x) for x in items if isinstance(x, dict)]
             elif isinstance(res_data, list):
-                chunk_items = [x for x in res_data if isinstance(x, dict)]
+                return [_slim_info_item(x) for x in res_data if isinstance(x, dict)]
             else:
                 # иногда API отдаёт result в неожиданном виде
                 if self.debug:
-                    logger.info(f"Ozon DEBUG: unexpected result type in info/list: {type(res_data)}")
+                    logger.info("Ozon DEBUG: unexpected result type in info/list: %s", type(res_data))
+            return []
 
-            all_details.extend(chunk_items)
-            await asyncio.sleep(0.2)
+        batches = await asyncio.gather(*(fetch(c) for c in _batched(all_product_ids, 100)))
 
+        all_details: List[Dict[str, Any]] = []
+        for chunk_items in batches:
+            all_details.extend(chunk_items)
         return all_details
 
     async def get_all_products(self) -> List[Dict[str, Any]]:
@@ -405,36 +581,35 @@ class OzonAPI:
             logger.error("Ozon get_all_products: детальная информация не получена.")
             return []
 
+        # Локальные ссылки: в цикле по тысячам товаров без поиска имён в глобалах/атрибутах
+        norm_article = _norm_article
+        safe_str = _safe_str
+        sum_present = _sum_present
+
         products: List[Dict[str, Any]] = []
+        append = products.append
         for item in details:
-            if not isinstance(item, dict):
+            if item.__class__ is not dict:
                 continue
+            item_get = item.get
 
-            offer_id = item.get("offer_id") or item.get("id") or item.get("product_id")
+            offer_id = item_get("offer_id") or item_get("id") or item_get("product_id")
             if not offer_id:
                 continue
 
             # Подсчёт остатков: Ozon может отдавать по разным структурам
-            total_stock = 0
-
-            stocks = item.get("stocks")
-            if isinstance(stocks, dict):
-                inner = stocks.get("stocks")
-                if isinstance(inner, list):
-                    # склады могут иметь present/reserved
-                    total_stock = sum(int(s.get("present", 0) or 0) for s in inner if isinstance(s, dict))
-                else:
-                    total_stock = int(stocks.get("present", 0) or 0)
-
-            # fallback
-            if total_stock == 0:
-                total_stock = int(item.get("fbs_stocks", 0) or 0) + int(item.get("fbo_stocks", 0) or 0)
-
-            products.append(
+            stocks = item_get("stocks")
+            if stocks.__class__ is dict:
+                total_stock = sum_present(stocks)
+            else:
+                # fallback — только если блока stocks нет совсем
+                total_stock = int(item_get("fbs_stocks", 0) or 0) + int(item_get("fbo_stocks", 0) or 0)
+
+            append(
                 {
                     "marketplace": "ozon",
-                    "article": self._norm_article(offer_id),
-                    "name": self._safe_str(item.get("name"), max_len=255, default=f"Ozon Product {offer_id}"),
+                    "article": norm_article(offer_id),
+                    "name": safe_str(item_get("name"), max_len=255, default=f"Ozon Product {offer_id}"),
                     "cost_price": 0.0,
                     "extra_costs": 0.0,
                     "tax_rate": 0.06,
@@ -442,7 +617,7 @@ class OzonAPI:
                 }
             )
 
-        logger.info(f"Ozon API: Итого подготовлено {len(products)} товаров.")
+        logger.info("Ozon API: Итого подготовлено %d товаров.", len(products))
         return products
 
     # -------------------------------------------------------------------------
@@ -451,8 +626,8 @@ class OzonAPI:
 
     async def search_product_position(self, keyword: str, target_article: str) -> int:
         endpoint = "/v1/product/search/list"
-        keyword = self._safe_str(keyword, max_len=200, default="")
-        target_article = self._norm_article(target_article)
+        keyword = _safe_str(keyword, max_len=200, default="")
+        target_article = _norm_article(target_article)
         if not keyword or not target_article:
             return 0
 
@@ -467,7 +642,7 @@ class OzonAPI:
             for index, item in enumerate(items):
                 if not isinstance(item, dict):
                     continue
-                if self._norm_article(item.get("offer_id", "")) == target_article:
+                if _norm_article(item.get("offer_id", "")) == target_article:
                     return (page * 100) + index + 1
             await asyncio.sleep(0.5)
 
@@ -475,12 +650,10 @@ class OzonAPI:
 
     async def get_transaction_report(self, date_from: datetime, date_to: datetime) -> List[Dict[str, Any]]:
         endpoint = "/v3/finance/transaction/list"
-        all_operations: List[Dict[str, Any]] = []
-        page = 1
+        from_s, to_s = self._fmt_dt_range(date_from, date_to)
 
-        while True:
-            from_s, to_s = self._fmt_dt_range(date_from, date_to)
-            payload = {
+        def page_payload(page: int) -> Dict[str, Any]:
+            return {
                 "filter": {
                     "date": {"from": from_s, "to": to_s},
                     "transaction_type": "all",
@@ -488,34 +661,45 @@ class OzonAPI:
                 "page": page,
                 "page_size": 1000,
             }
-            result = await self._make_request(endpoint, payload)
+
+        def page_ops(result: Optional[dict]) -> List[Dict[str, Any]]:
             if not result or "result" not in result:
-                break
+                return []
+            return self._extract_postings(result, ("operations",))
 
-            ops = result["result"].get("operations", [])
-            if not isinstance(ops, list) or not ops:
-                break
+        # Первая страница сообщает page_count, остальные запрашиваем параллельно
+        first = await self._make_request(endpoint, page_payload(1))
+        all_operations = page_ops(first)
+        if not all_operations:
+            return []
 
-            all_operations.extend([o for o in ops if isinstance(o, dict)])
+        page_count = int(first["result"].get("page_count", 1) or 1)
+        if page_count <= 1:
+            return all_operations
 
-            page_count = int(result["result"].get("page_count", 1) or 1)
-            if page >= page_count:
-                break
+        sem = asyncio.Semaphore(self.MAX_PARALLEL_REQUESTS)
 
-            page += 1
-            await asyncio.sleep(0.2)
+        async def fetch(page: int) -> List[Dict[str, Any]]:
+            async with sem:
+                return page_ops(await self._make_request(endpoint, page_payload(page)))
+
+        pages = await asyncio.gather(*(fetch(p) for p in range(2, page_count + 1)))
+        for ops in pages:
+            all_operations.extend(ops)
 
         return all_operations
 
     async def get_product_info(self, offer_id: str) -> Optional[Dict[str, Any]]:
-        offer_id = self._safe_str(offer_id, max_len=128, default="")
+        offer_id = _safe_str(offer_id, max_len=128, default="")
         if not offer_id:
             return None
         result = await self._make_request("/v2/product/info", {"offer_id": offer_id})
         return result.get("result") if result else None
 
     async def get_fbo_inventory(self) -> List[Dict[str, Any]]:
-        result = await self._make_request("/v2/analytics/stock_on_warehouses", {"limit": 1000, "offset": 0})
+        result = await self._cached_request(
+            "/v2/analytics/stock_on_warehouses", {"limit": 1000, "offset": 0}, ttl=120.0
+        )
         if not result:
             return []
         rows = result.get("result", {}).get("rows", [])
@@ -523,10 +707,26 @@ class OzonAPI:
 
     async def get_product_prices(self, offer_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         offer_ids = offer_ids or []
-        offer_ids = [self._safe_str(x, max_len=128, default="") for x in offer_ids if x]
-        payload = {"filter": {"offer_id": offer_ids, "visibility": "ALL"}, "limit": 1000}
-        result = await self._make_request("/v4/product/info/prices", payload)
-        if not result:
-            return []
-        items = result.get("result", {}).get("items", [])
-        return items if isinstance(items, list) else []
+        offer_ids = [_safe_str(x, max_len=128, default="") for x in offer_ids if x]
+
+        def page_items(result: Optional[dict]) -> List[Dict[str, Any]]:
+            if not result:
+                return []
+            items = result.get("result", {}).get("items", [])
+            return items if isinstance(items, list) else []
+
+        if not offer_ids:
+            # Без фильтра по offer_id — первая страница всех товаров (как раньше)
+            payload = {"filter": {"offer_id": [], "visibility": "ALL"}, "limit": 1000}
+            return page_items(await self._make_request("/v4/product/info/prices", payload))
+
+        # Явный список offer_id — батчами по 500 параллельно, чтобы ничего не обрезалось лимитом
+        sem = asyncio.Semaphore(self.MAX_PARALLEL_REQUESTS)
+
+        async def fetch(chunk: List[str]) -> List[Dict[str, Any]]:
+            payload = {"filter": {"offer_id": chunk, "visibility": "ALL"}, "limit": len(chunk)}
+            async with sem:
+                return page_items(await self._make_request("/v4/product/info/prices", payload))
+
+        batches = await asyncio.gather(*(fetch(c) for c in _batched(offer_ids, 500)))
+        return [item for batch in batches for item in batch]
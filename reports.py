@@ -14,32 +14,96 @@
 
 from __future__ import annotations
 
-import html
+import heapq
 import logging
+import sys
+from array import array
+from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple, Union
-
-from sqlalchemy import select
-
+from functools import lru_cache
+from itertools import chain, islice
+from operator import itemgetter
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+import numpy as np
+from sqlalchemy import and_, or_, select
+
+try:
+    # Необязательная зависимость: JIT-ядро итогов для очень больших отчётов
+    from numba import njit
+except ImportError:
+    njit = None
+
+from cache import cost_prices_cache
 from database import async_session, Product
 
 logger = logging.getLogger(__name__)
 
 TELEGRAM_TEXT_LIMIT = 4096
 
+# Статичные фрагменты отчётов собираются один раз на модуль
+_SEP = "──────────────────"
+
+_DAILY_EMPTY_TEMPLATE = (
+    "{emoji} <b>Отчет {mp}</b> за {period}\n"
+    f"{_SEP}\n"
+    "💳 Баланс: <b>{balance}</b>\n"
+    f"{_SEP}\n"
+    "Данные о продажах за {when} отсутствуют."
+)
+
+_DAILY_TEMPLATE = (
+    "{emoji} <b>Отчет {mp}</b> за {period}\n"
+    f"{_SEP}\n"
+    "💳 Текущий баланс: <b>{balance}</b>\n"
+    "💰 Выручка: <b>{revenue}</b>\n"
+    "📦 Продано: <b>{items_count} шт.</b>\n"
+    f"{_SEP}\n"
+    "📉 Себестоимость: <code>{cost}</code>\n"
+    "💸 Налоги: <code>{tax}</code>\n"
+    "📦 Доп. расходы: <code>{extra}</code>\n"
+    f"{_SEP}\n"
+    "💎 <b>Чистая прибыль: {profit}</b>\n"
+    "📈 ROI: <b>{roi:.1f}%</b>\n"
+    "\n<i>*Без учета комиссий и логистики МП</i>"
+)
+
 
 # =============================================================================
 # Форматирование
 # =============================================================================
 
+# Разделитель тысяч -> неразрывный пробел одним translate
+_CCY_TABLE = str.maketrans({",": "\u00A0"})
+
+
+@lru_cache(maxsize=1024)
+def _format_rub(rounded: int) -> str:
+    return format(rounded, ",").translate(_CCY_TABLE) + " ₽"
+
+
+# Экранирование для parse_mode=HTML одним проходом translate. Строки вставляются только
+# в текст между тегами (не в атрибуты), поэтому кавычки не экранируем — как html.escape(quote=False)
+_HTML_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+# Названия/артикулы в отчётах повторяются (один SKU продаётся много раз) — экранирование кэшируем
+@lru_cache(maxsize=1024)
+def _esc(s: str) -> str:
+    return s.translate(_HTML_ESC)
+
+
 def format_currency(value: float) -> str:
     """
     Превращает число в красивую строку: 12500.5 -> 12 501 ₽.
+    Результат зависит только от округлённого значения — кэшируется (цены в отчётах повторяются).
     """
     try:
         val = float(value) if value is not None else 0.0
-        return f"{val:,.0f}".replace(",", " ").replace(" ", "\u00A0") + " ₽"
-    except (ValueError, TypeError):
+        return _format_rub(round(val))
+    except (ValueError, TypeError, OverflowError):
         return "0 ₽"
 
 
@@ -57,6 +121,21 @@ def _safe_float(value: Any, default: float = 0.0) -> float:
         return default
 
 
+def _fast_float(value: Any, default: float = 0.0) -> float:
+    """
+    _safe_float с быстрым путём: цены в JSON WB/Ozon почти всегда уже int/float,
+    точная проверка типа дешевле try/except и разбора строки.
+    """
+    t = value.__class__
+    if t is float:
+        return value
+    if t is int:
+        return float(value)
+    if value is None:
+        return default
+    return _safe_float(value, default)
+
+
 def _safe_str(value: Any, default: str = "Н/Д", max_len: int = 255) -> str:
     s = str(value).strip() if value is not None else default
     if not s:
@@ -68,52 +147,144 @@ def _norm_article(value: Any) -> str:
     return _safe_str(value, default="Н/Д", max_len=128).strip().upper()
 
 
+def _norm_marketplace(value: Any) -> str:
+    """Канон маркетплейса как в БД ('wb' / 'ozon'): отчёты вызываются с "Wildberries"/"Ozon"."""
+    s = str(value or "").strip().lower()
+    if s in ("wildberries", "wb", "w"):
+        return "wb"
+    if s in ("ozon", "o3", "o"):
+        return "ozon"
+    return s
+
+
+_TRUNC_SUFFIX = sys.intern("\n…(сообщение сокращено)")
+
+
 def _truncate_text(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> str:
     if not text:
         return ""
     if len(text) <= limit:
         return text
-    return text[: limit - 20] + "\n…(сообщение сокращено)"
+    return text[: limit - 20] + _TRUNC_SUFFIX
 
 
 # =============================================================================
 # Данные из БД (юнит-экономика)
 # =============================================================================
 
-async def get_user_cost_prices(user_tg_id: int, marketplace: str) -> Dict[str, Dict[str, float]]:
+# NULL != x в SQL — не истина, так что NULL-поля тоже считаются «по умолчанию»
+_NON_DEFAULT_COSTS = or_(
+    Product.cost_price != 0,
+    Product.extra_costs != 0,
+    and_(Product.tax_rate != 0, Product.tax_rate != 0.06),
+)
+
+# Сколько tg_id передавать в один IN (...) (лимит параметров SQLite — 999)
+_COSTS_IN_CHUNK = 500
+
+
+def _cost_entry(cost: Any, tax: Any, extra: Any) -> Dict[str, float]:
+    return {
+        "cost": float(cost or 0.0),
+        "tax": float(tax or 0.06),
+        "extra": float(extra or 0.0),
+    }
+
+
+async def get_user_cost_prices(user_tg_id: int, marketplace: str) -> Mapping[str, Dict[str, float]]:
     """
     Загружает юнит-экономику товаров пользователя из БД.
-    Возвращает: {ARTICLE: {"cost":..., "tax":..., "extra":...}}
+    Возвращает: {ARTICLE: {"cost":..., "tax":..., "extra":...}} (только для чтения).
     Важно: article в БД обычно хранится как upper/strip.
+    Товары с юнит-экономикой по умолчанию (0 / 6% / 0) не выбираются — для них
+    отчёты и так берут _DEFAULT_COST.
+    Результат кэшируется на 60 секунд (см. cache.invalidate_cost_prices).
     """
-    mp = str(marketplace or "").lower().strip()
+    mp = _norm_marketplace(marketplace)
+
+    cached = cost_prices_cache.get((user_tg_id, mp))
+    if cached is not None:
+        return cached
 
     async with async_session() as session:
         try:
-            result = await session.execute(
-                select(Product.article, Product.cost_price, Product.tax_rate, Product.extra_costs).where(
-                    Product.user_tg_id == user_tg_id,
-                    Product.marketplace == mp,
-                )
+            stmt = select(Product.article, Product.cost_price, Product.tax_rate, Product.extra_costs).where(
+                Product.user_tg_id == user_tg_id,
+                Product.marketplace == mp,
+                _NON_DEFAULT_COSTS,
             )
+            result = await session.stream(stmt.execution_options(yield_per=500))
             out: Dict[str, Dict[str, float]] = {}
-            for row in result.all():
-                article = _norm_article(row[0])
-                out[article] = {
-                    "cost": float(row[1] or 0.0),
-                    "tax": float(row[2] or 0.06),
-                    "extra": float(row[3] or 0.0),
-                }
-            return out
+            async for row in result:
+                out[_norm_article(row[0])] = _cost_entry(row[1], row[2], row[3])
+            # Словарь общий для всех читателей кэша — отдаём read-only представление
+            costs = MappingProxyType(out)
+            cost_prices_cache.set((user_tg_id, mp), costs)
+            return costs
         except Exception as e:
             logger.error(f"Ошибка БД при получении себестоимости user={user_tg_id} mp={mp}: {e}")
             return {}
 
 
+async def get_many_users_cost_prices(
+    user_ids: Iterable[int], marketplace: str
+) -> Dict[int, Mapping[str, Dict[str, float]]]:
+    """
+    Юнит-экономика сразу для многих пользователей одним SELECT ... IN (...) на пачку
+    вместо запроса на каждого (рассылка планировщика).
+    Возвращает {tg_id: {ARTICLE: {...}}} для всех переданных id (пустой словарь, если товаров нет);
+    результаты кладутся в тот же кэш, что и у get_user_cost_prices.
+    """
+    mp = _norm_marketplace(marketplace)
+
+    out: Dict[int, Mapping[str, Dict[str, float]]] = {}
+    missing: List[int] = []
+    for uid in dict.fromkeys(user_ids):
+        cached = cost_prices_cache.get((uid, mp))
+        if cached is not None:
+            out[uid] = cached
+        else:
+            missing.append(uid)
+
+    if not missing:
+        return out
+
+    by_user: Dict[int, Dict[str, Dict[str, float]]] = defaultdict(dict)
+    async with async_session() as session:
+        try:
+            for i in range(0, len(missing), _COSTS_IN_CHUNK):
+                stmt = select(
+                    Product.user_tg_id, Product.article, Product.cost_price, Product.tax_rate, Product.extra_costs
+                ).where(
+                    Product.user_tg_id.in_(missing[i : i + _COSTS_IN_CHUNK]),
+                    Product.marketplace == mp,
+                    _NON_DEFAULT_COSTS,
+                )
+                result = await session.stream(stmt.execution_options(yield_per=500))
+                async for row in result:
+                    by_user[row[0]][_norm_article(row[1])] = _cost_entry(row[2], row[3], row[4])
+        except Exception as e:
+            logger.error(f"Ошибка БД при пакетной загрузке себестоимости mp={mp} users={len(missing)}: {e}")
+            # Отдаём то, что было в кэше; остальные догрузятся по одному в generate_daily_report_text
+            return out
+
+    for uid in missing:
+        costs = MappingProxyType(by_user.get(uid, {}))
+        cost_prices_cache.set((uid, mp), costs)
+        out[uid] = costs
+    return out
+
+
 # =============================================================================
 # Парсинг данных WB/Ozon в единый формат строк продаж
 # =============================================================================
 
+# Порядок ключей — по частоте в реальных ответах WB: /sales почти всегда содержит finishedPrice и nmId
+_WB_PRICE_KEYS = ("finishedPrice", "priceWithDisc", "forPay", "totalPrice", "price")
+_WB_ARTICLE_KEYS = ("nmId", "nmID", "supplierArticle", "article", "vendorCode")
+_BAD_ARTICLES = frozenset((None, "", "Н/Д"))
+
+
 def _extract_price_from_wb_sale(item: Dict[str, Any]) -> float:
     """
     WB sales API может возвращать:
@@ -121,10 +292,13 @@ def _extract_price_from_wb_sale(item: Dict[str, Any]) -> float:
     - priceWithDisc
     - forPay
     - totalPrice
+    Один get на ключ, выход на первом непустом значении.
     """
-    for key in ("finishedPrice", "priceWithDisc", "forPay", "totalPrice", "price"):
-        if key in item:
-            return _safe_float(item.get(key), 0.0)
+    item_get = item.get
+    for key in _WB_PRICE_KEYS:
+        v = item_get(key)
+        if v is not None:
+            return _fast_float(v)
     return 0.0
 
 
@@ -136,9 +310,15 @@ def _extract_article_from_wb(item: Dict[str, Any]) -> str:
     - article (FBS orders/new в твоей логике)
     - vendorCode (cards)
     """
-    for key in ("nmId", "nmID", "supplierArticle", "article", "vendorCode"):
-        v = item.get(key)
-        if v not in (None, "", "Н/Д"):
+    item_get = item.get
+    bad = _BAD_ARTICLES
+    for key in _WB_ARTICLE_KEYS:
+        v = item_get(key)
+        # nmId — int: strip/upper для числа ничего не меняют
+        if v.__class__ is int:
+            return str(v)
+        # в множество строк-заглушек лезем только для строк
+        if v is not None and (v.__class__ is not str or v not in bad):
             return _norm_article(v)
     return "Н/Д"
 
@@ -151,100 +331,231 @@ def _extract_name_from_wb(item: Dict[str, Any]) -> str:
     return "Товар"
 
 
-def _flatten_ozon_postings(postings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+# Строка продажи/заказа: (article, name, price); article нормализован, price — float
+SaleRow = Tuple[str, str, float]
+
+
+_is_dict = dict.__instancecheck__
+
+
+def _iter_dicts(data: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Элементы-словари из list или из dict {"fbs": [...], "fbo": [...]} без промежуточных списков.
+    Фильтрация идёт в C (filter + chain), без Python-цикла на элемент.
+    """
+    if isinstance(data, dict):
+        fbs = data.get("fbs")
+        fbo = data.get("fbo")
+        return filter(
+            _is_dict,
+            chain(fbs if isinstance(fbs, list) else (), fbo if isinstance(fbo, list) else ()),
+        )
+    if isinstance(data, list):
+        return filter(_is_dict, data)
+    return iter(())
+
+
+def _iter_ozon_posting_rows(postings: Iterable[Dict[str, Any]]) -> Iterator[SaleRow]:
     """
     Ozon postings: каждый posting содержит products[].
-    Для финансовых отчётов удобнее привести к списку строк по товару:
-    [{"article":..., "name":..., "price":...}, ...]
+    Для финансовых отчётов удобнее привести к строкам по товару.
     """
-    rows: List[Dict[str, Any]] = []
     for p in postings:
-        if not isinstance(p, dict):
-            continue
         products = p.get("products", [])
         if not isinstance(products, list):
             continue
         for prod in products:
             if not isinstance(prod, dict):
                 continue
-            article = _norm_article(prod.get("offer_id") or prod.get("sku") or "Н/Д")
-            name = _safe_str(prod.get("name"), default="Товар", max_len=255)
-            price = _safe_float(prod.get("price"), 0.0)
-            rows.append({"article": article, "name": name, "price": price})
-    return rows
+            yield (
+                _norm_article(prod.get("offer_id") or prod.get("sku") or "Н/Д"),
+                _safe_str(prod.get("name"), default="Товар", max_len=255),
+                _fast_float(prod.get("price")),
+            )
 
 
-def _unify_daily_data(marketplace: str, data: Union[list, dict]) -> List[Dict[str, Any]]:
+def _iter_rows(marketplace: str, data: Any, prefer_item_name: bool = False) -> Iterator[SaleRow]:
     """
-    Приводит входные данные разных маркетплейсов к единому плоскому списку:
-    [{"article":..., "name":..., "price":...}, ...]
+    Приводит входные данные разных маркетплейсов к единому потоку строк (article, name, price).
+    prefer_item_name — для WB брать name/item_name раньше subject/brand (список заказов).
     """
     mp = str(marketplace or "").lower().strip()
-    unified: List[Dict[str, Any]] = []
 
-    # Ozon: может прийти dict {"fbs": [postings], "fbo": [postings]}
+    # Ozon: dict {"fbs": [postings], "fbo": [postings]} или список
     if mp == "ozon":
-        if isinstance(data, dict):
-            fbs = data.get("fbs", [])
-            fbo = data.get("fbo", [])
-            postings = []
-            if isinstance(fbs, list):
-                postings.extend([x for x in fbs if isinstance(x, dict)])
-            if isinstance(fbo, list):
-                postings.extend([x for x in fbo if isinstance(x, dict)])
-            unified = _flatten_ozon_postings(postings)
-        elif isinstance(data, list):
-            # иногда могли передать уже плоский список
-            # попробуем распознать:
-            # - если элементы похожи на posting (есть products) -> flatten
-            if data and isinstance(data[0], dict) and "products" in data[0]:
-                unified = _flatten_ozon_postings([x for x in data if isinstance(x, dict)])
-            else:
-                for x in data:
-                    if not isinstance(x, dict):
-                        continue
-                    article = _norm_article(x.get("article") or x.get("offer_id") or x.get("sku") or "Н/Д")
-                    name = _safe_str(x.get("name") or x.get("item_name"), default="Товар", max_len=255)
-                    price = _safe_float(x.get("price"), 0.0)
-                    unified.append({"article": article, "name": name, "price": price})
-        return unified
-
-    # WB: утренний отчет берёт sales list (get_sales_report -> list)
-    # Но иногда может быть dict {"fbs":..., "fbo":...} — тоже поддержим.
-    if isinstance(data, dict):
-        fbs = data.get("fbs", [])
-        fbo = data.get("fbo", [])
-        items = []
-        if isinstance(fbs, list):
-            items.extend([x for x in fbs if isinstance(x, dict)])
-        if isinstance(fbo, list):
-            items.extend([x for x in fbo if isinstance(x, dict)])
-    elif isinstance(data, list):
-        items = [x for x in data if isinstance(x, dict)]
-    else:
-        items = []
-
-    for item in items:
-        article = _extract_article_from_wb(item)
-        name = _extract_name_from_wb(item)
-        price = _extract_price_from_wb_sale(item)
-        unified.append({"article": article, "name": name, "price": price})
-
-    return unified
+        if isinstance(data, list) and not (data and isinstance(data[0], dict) and "products" in data[0]):
+            # уже плоский список строк
+            for x in _iter_dicts(data):
+                yield (
+                    _norm_article(x.get("article") or x.get("offer_id") or x.get("sku") or "Н/Д"),
+                    _safe_str(x.get("name") or x.get("item_name"), default="Товар", max_len=255),
+                    _fast_float(x.get("price")),
+                )
+        else:
+            yield from _iter_ozon_posting_rows(_iter_dicts(data))
+        return
+
+    # WB: утренний отчет берёт sales list (get_sales_report -> list),
+    # но может быть и dict {"fbs":..., "fbo":...}
+    for item in _iter_dicts(data):
+        if prefer_item_name:
+            name = _safe_str(
+                item.get("name") or item.get("item_name") or _extract_name_from_wb(item),
+                default="Товар",
+                max_len=255,
+            )
+        else:
+            name = _extract_name_from_wb(item)
+        yield (_extract_article_from_wb(item), name, _extract_price_from_wb_sale(item))
+
+
+def _count_rows(marketplace: str, data: Any) -> int:
+    """
+    Число строк, которое выдал бы _iter_rows, без разбора артикулов/названий/цен.
+    """
+    mp = str(marketplace or "").lower().strip()
+    if mp == "ozon" and not (
+        isinstance(data, list) and not (data and isinstance(data[0], dict) and "products" in data[0])
+    ):
+        total = 0
+        for p in _iter_dicts(data):
+            products = p.get("products")
+            if isinstance(products, list):
+                total += len(products)
+        return total
+    return sum(1 for _ in _iter_dicts(data))
+
+
+@dataclass
+class UnifiedBatch:
+    """
+    Строки продаж поколоночно (struct-of-arrays): три параллельных столбца вместо списка словарей.
+    prices — array('d'), непрерывный буфер double без отдельного float-объекта на строку.
+    """
+
+    articles: List[str] = field(default_factory=list)
+    names: List[str] = field(default_factory=list)
+    prices: array = field(default_factory=lambda: array("d"))
+
+    def __len__(self) -> int:
+        return len(self.articles)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[SaleRow]) -> "UnifiedBatch":
+        batch = cls()
+        add_article = batch.articles.append
+        add_name = batch.names.append
+        add_price = batch.prices.append
+        for article, name, price in rows:
+            add_article(article)
+            add_name(name)
+            add_price(price)
+        return batch
 
 
 # =============================================================================
 # Дневной финансовый отчет
 # =============================================================================
 
+# Юнит-экономика товара, которого нет в БД
+_DEFAULT_COST: Dict[str, float] = {"cost": 0.0, "tax": 0.06, "extra": 0.0}
+
+# С какого числа артикулов считать итоги через NumPy (на малых объёмах накладные расходы выше выигрыша)
+_VECTORIZE_MIN_ROWS = 256
+
+
+def _totals_kernel(
+    sums: np.ndarray, counts: np.ndarray, costs: np.ndarray, taxes: np.ndarray, extras: np.ndarray
+) -> Tuple[float, float, float, float]:
+    """Итоги по столбцам артикулов одним проходом (компилируется numba, если она установлена)."""
+    revenue = 0.0
+    cost = 0.0
+    tax = 0.0
+    extra = 0.0
+    for i in range(sums.shape[0]):
+        revenue += sums[i]
+        cost += costs[i] * counts[i]
+        tax += sums[i] * taxes[i]
+        extra += extras[i] * counts[i]
+    return revenue, cost, tax, extra
+
+
+def _totals_numpy(
+    sums: np.ndarray, counts: np.ndarray, costs: np.ndarray, taxes: np.ndarray, extras: np.ndarray
+) -> Tuple[float, float, float, float]:
+    return (
+        float(sums.sum()),
+        float(np.dot(costs, counts)),
+        float(np.dot(sums, taxes)),
+        float(np.dot(extras, counts)),
+    )
+
+
+# Без numba чистый Python-цикл по массивам медленнее np.dot — берём NumPy-вариант
+_totals = njit(cache=True, fastmath=True)(_totals_kernel) if njit is not None else _totals_numpy
+
+
+def _aggregate_totals(
+    batch: UnifiedBatch, user_costs: Mapping[str, Dict[str, float]]
+) -> Tuple[float, float, float, float]:
+    """
+    Итоги (выручка, себестоимость, налог, доп.расходы) по строкам продаж.
+    Строки из _iter_rows: article уже нормализован, price — float;
+    значения себестоимости из get_user_cost_prices — float. Повторно не приводим.
+    ВАЖНО: себестоимость/extra берём как per-item, т.е. на каждую строку.
+
+    Сначала группируем строки по артикулу (сумма цен и число строк), затем один поиск
+    юнит-экономики на артикул: один SKU обычно продаётся много раз.
+    """
+    price_sum: Dict[str, float] = defaultdict(float)
+    row_count: Dict[str, int] = defaultdict(int)
+    for article, price in zip(batch.articles, batch.prices):
+        price_sum[article] += price
+        row_count[article] += 1
+
+    get_costs = user_costs.get
+    default_costs = _DEFAULT_COST
+    n = len(price_sum)
+
+    if n > _VECTORIZE_MIN_ROWS:
+        # Поколоночно по артикулам: суммы в C-циклах NumPy
+        articles = list(price_sum)
+        costs = [get_costs(a) or default_costs for a in articles]
+        sums = np.fromiter((price_sum[a] for a in articles), dtype=np.float64, count=n)
+        counts = np.fromiter((row_count[a] for a in articles), dtype=np.float64, count=n)
+        cost_arr = np.fromiter((c["cost"] for c in costs), dtype=np.float64, count=n)
+        extra_arr = np.fromiter((c["extra"] for c in costs), dtype=np.float64, count=n)
+        tax_arr = np.fromiter((c["tax"] or 0.06 for c in costs), dtype=np.float64, count=n)
+        revenue, cost, tax, extra = _totals(sums, counts, cost_arr, tax_arr, extra_arr)
+        return float(revenue), float(cost), float(tax), float(extra)
+
+    total_revenue = 0.0
+    total_cost_price = 0.0
+    total_tax = 0.0
+    total_extra = 0.0
+    for article, subsum in price_sum.items():
+        p_data = get_costs(article) or default_costs
+        qty = row_count[article]
+        total_revenue += subsum
+        total_cost_price += p_data["cost"] * qty
+        total_extra += p_data["extra"] * qty
+        total_tax += subsum * (p_data["tax"] or 0.06)
+    return total_revenue, total_cost_price, total_tax, total_extra
+
+
 async def generate_daily_report_text(
     marketplace: str,
     data: Union[list, dict],
     user_tg_id: int,
     balance: float = 0.0,
+    period_label: Optional[str] = None,
+    user_costs: Optional[Mapping[str, Dict[str, float]]] = None,
 ) -> str:
     """
     Генерация финансового отчета за сутки.
+    period_label — подпись периода в заголовке (например "7 дн."); по умолчанию вчерашняя дата.
+    user_costs — заранее загруженная юнит-экономика (get_many_users_cost_prices);
+    если не передана, загружается по user_tg_id.
 
     ВАЖНО:
     - Ozon: postings -> products -> суммирование по товарным строкам
@@ -252,70 +563,47 @@ async def generate_daily_report_text(
     """
     mp = str(marketplace or "").strip()
     mp_key = mp.lower().strip()
-    yesterday_str = (datetime.now() - timedelta(days=1)).strftime("%d.%m.%Y")
+    period_str = period_label or (datetime.now() - timedelta(days=1)).strftime("%d.%m.%Y")
 
     header_emoji = "🔵" if mp_key == "ozon" else "🟣"
 
-    unified_data = _unify_daily_data(mp_key, data)
+    batch = UnifiedBatch.from_rows(_iter_rows(mp_key, data))
 
-    if not unified_data:
-        text = (
-            f"{header_emoji} <b>Отчет {html.escape(mp)}</b> за {yesterday_str}\n"
-            f"──────────────────\n"
-            f"💳 Баланс: <b>{format_currency(balance)}</b>\n"
-            f"──────────────────\n"
-            f"Данные о продажах за вчера отсутствуют."
+    if not batch:
+        return _truncate_text(
+            _DAILY_EMPTY_TEMPLATE.format(
+                emoji=header_emoji,
+                mp=_esc(mp),
+                period=_esc(period_str),
+                balance=format_currency(balance),
+                when="период" if period_label else "вчера",
+            )
         )
-        return _truncate_text(text)
 
     # Загружаем юнит-экономику из БД
-    user_costs = await get_user_cost_prices(user_tg_id, mp_key)
-
-    total_revenue = 0.0
-    total_cost_price = 0.0
-    total_tax = 0.0
-    total_extra = 0.0
-    items_count = 0
-
-    for row in unified_data:
-        if not isinstance(row, dict):
-            continue
-
-        price = _safe_float(row.get("price"), 0.0)
-        article = _norm_article(row.get("article") or "Н/Д")
+    if user_costs is None:
+        user_costs = await get_user_cost_prices(user_tg_id, mp_key)
 
-        p_data = user_costs.get(article)
-        if not p_data:
-            # попытка совпадения без upper не нужна — _norm_article уже upper
-            p_data = {"cost": 0.0, "tax": 0.06, "extra": 0.0}
-
-        # ВАЖНО: себестоимость/extra берём как per-item, умножаем на количество строк
-        total_revenue += price
-        total_cost_price += float(p_data.get("cost", 0.0) or 0.0)
-        total_extra += float(p_data.get("extra", 0.0) or 0.0)
-        total_tax += (price * float(p_data.get("tax", 0.06) or 0.06))
-        items_count += 1
+    total_revenue, total_cost_price, total_tax, total_extra = _aggregate_totals(batch, user_costs)
+    items_count = len(batch)
 
     net_profit = total_revenue - total_cost_price - total_tax - total_extra
     roi = (net_profit / total_cost_price * 100) if total_cost_price > 0 else 0.0
 
-    report_lines = [
-        f"{header_emoji} <b>Отчет {html.escape(mp)}</b> за {yesterday_str}",
-        "──────────────────",
-        f"💳 Текущий баланс: <b>{format_currency(balance)}</b>",
-        f"💰 Выручка: <b>{format_currency(total_revenue)}</b>",
-        f"📦 Продано: <b>{items_count} шт.</b>",
-        "──────────────────",
-        f"📉 Себестоимость: <code>{format_currency(total_cost_price)}</code>",
-        f"💸 Налоги: <code>{format_currency(total_tax)}</code>",
-        f"📦 Доп. расходы: <code>{format_currency(total_extra)}</code>",
-        "──────────────────",
-        f"💎 <b>Чистая прибыль: {format_currency(net_profit)}</b>",
-        f"📈 ROI: <b>{roi:.1f}%</b>",
-        "\n<i>*Без учета комиссий и логистики МП</i>",
-    ]
-
-    return _truncate_text("\n".join(report_lines))
+    text = _DAILY_TEMPLATE.format(
+        emoji=header_emoji,
+        mp=_esc(mp),
+        period=_esc(period_str),
+        balance=format_currency(balance),
+        revenue=format_currency(total_revenue),
+        items_count=items_count,
+        cost=format_currency(total_cost_price),
+        tax=format_currency(total_tax),
+        extra=format_currency(total_extra),
+        profit=format_currency(net_profit),
+        roi=roi,
+    )
+    return _truncate_text(text)
 
 
 # =============================================================================
@@ -335,71 +623,25 @@ async def generate_combined_orders_report(marketplace: str, orders_data: Any) ->
     mp_key = mp.lower().strip()
     header_emoji = "🔵" if mp_key == "ozon" else "🟣"
 
-    # Приводим к плоскому списку строк: [{"article","name","price"}]
-    final_rows: List[Dict[str, Any]] = []
-
-    if mp_key == "ozon":
-        if isinstance(orders_data, dict):
-            postings: List[Dict[str, Any]] = []
-            fbs = orders_data.get("fbs", [])
-            fbo = orders_data.get("fbo", [])
-            if isinstance(fbs, list):
-                postings.extend([x for x in fbs if isinstance(x, dict)])
-            if isinstance(fbo, list):
-                postings.extend([x for x in fbo if isinstance(x, dict)])
-            final_rows = _flatten_ozon_postings(postings)
-        elif isinstance(orders_data, list):
-            if orders_data and isinstance(orders_data[0], dict) and "products" in orders_data[0]:
-                final_rows = _flatten_ozon_postings([x for x in orders_data if isinstance(x, dict)])
-            else:
-                for x in orders_data:
-                    if not isinstance(x, dict):
-                        continue
-                    final_rows.append(
-                        {
-                            "article": _norm_article(x.get("article") or x.get("offer_id") or x.get("sku") or "Н/Д"),
-                            "name": _safe_str(x.get("name") or x.get("item_name"), default="Товар", max_len=255),
-                            "price": _safe_float(x.get("price"), 0.0),
-                        }
-                    )
-    else:
-        # WB
-        items: List[Dict[str, Any]] = []
-        if isinstance(orders_data, dict):
-            fbs = orders_data.get("fbs", [])
-            fbo = orders_data.get("fbo", [])
-            if isinstance(fbs, list):
-                items.extend([x for x in fbs if isinstance(x, dict)])
-            if isinstance(fbo, list):
-                items.extend([x for x in fbo if isinstance(x, dict)])
-        elif isinstance(orders_data, list):
-            items = [x for x in orders_data if isinstance(x, dict)]
-
-        for item in items:
-            final_rows.append(
-                {
-                    "article": _extract_article_from_wb(item),
-                    "name": _safe_str(item.get("name") or item.get("item_name") or _extract_name_from_wb(item), default="Товар", max_len=255),
-                    "price": _extract_price_from_wb_sale(item),
-                }
-            )
+    # Разбираем только первые 10 строк; остаток считаем по размерам списков, без разбора строк
+    shown = list(islice(_iter_rows(mp_key, orders_data, prefer_item_name=True), 10))
 
-    if not final_rows:
-        return _truncate_text(f"{header_emoji} <b>{html.escape(mp)}:</b> Новых заказов нет.")
+    if not shown:
+        return _truncate_text(f"{header_emoji} <b>{_esc(mp)}:</b> Новых заказов нет.")
 
-    lines = [f"{header_emoji} <b>Последние заказы {html.escape(mp)}:</b>", "──────────────────"]
+    rest = _count_rows(mp_key, orders_data) - len(shown) if len(shown) == 10 else 0
 
-    # Последние 10 строк
-    for o in final_rows[:10]:
-        name = o.get("name") or "Товар"
-        safe_name = html.escape(str(name))
-        price = format_currency(o.get("price", 0.0))
-        article = o.get("article") or "Н/Д"
+    lines = [f"{header_emoji} <b>Последние заказы {_esc(mp)}:</b>", _SEP]
 
-        lines.append(f"📦 {safe_name}\n└ <code>{html.escape(str(article))}</code> — <b>{price}</b>")
+    # Последние 10 строк
+    for article, name, price in shown:
+        safe_name = _esc(name or "Товар")
+        lines.append(
+            f"📦 {safe_name}\n└ <code>{_esc(article or 'Н/Д')}</code> — <b>{format_currency(price)}</b>"
+        )
 
-    if len(final_rows) > 10:
-        lines.append(f"\n<i>...и еще {len(final_rows) - 10} позиций</i>")
+    if rest:
+        lines.append(f"\n<i>...и еще {rest} позиций</i>")
 
     return _truncate_text("\n".join(lines))
 
@@ -408,70 +650,91 @@ async def generate_combined_orders_report(marketplace: str, orders_data: Any) ->
 # Отчет по низким остаткам
 # =============================================================================
 
-async def generate_stock_report(marketplace: str, items: list, threshold: int = 10) -> str:
-    """
-    Формирует список товаров с низким остатком.
-    items:
-    - WB: список stocks из statistics-api (/supplier/stocks): quantity, nmId
-    - Ozon: список items из /v3/product/info/list: stocks может быть dict или list (и внутри stocks.stocks)
-    """
-    mp = str(marketplace or "").strip()
-    mp_key = mp.lower().strip()
+_get_present = itemgetter("present")
 
-    if not isinstance(items, list) or not items:
-        return ""
 
+def _sum_present(stocks: List[Any]) -> int:
+    """
+    Сумма present по складам Ozon.
+    Быстрый путь — itemgetter в C по числам из JSON; при пропусках/None/строках — поштучно с приведением.
+    """
     try:
-        threshold_int = int(threshold)
-    except Exception:
-        threshold_int = 10
+        return int(sum(map(_get_present, stocks)))
+    except (KeyError, TypeError, ValueError):
+        return sum(int(s.get("present", 0) or 0) for s in filter(_is_dict, stocks))
 
-    low_stock_lines: List[str] = []
 
-    for item in items:
-        if not isinstance(item, dict):
-            continue
+# Сколько позиций показываем в отчете по остаткам
+_STOCK_REPORT_LIMIT = 20
+
 
-        if mp_key == "ozon":
+def _iter_low_stock(mp_key: str, items: List[Any], threshold: int) -> Iterator[Tuple[int, int, Any]]:
+    """
+    Товары с остатком <= threshold: (остаток, позиция во входном списке, сырой артикул).
+    Артикул не нормализуем здесь — только для попавших в отчет строк.
+    """
+    is_ozon = mp_key == "ozon"
+    for idx, item in enumerate(filter(_is_dict, items)):
+        if is_ozon:
             # Возможные форматы:
             # item['stocks'] = {'stocks': [{'present':..}, ...]} или {'present':..}
             # item['offer_id']
-            article = _norm_article(item.get("offer_id") or item.get("id") or item.get("product_id") or "Н/Д")
-
-            total_qty = 0
             stocks = item.get("stocks")
 
             if isinstance(stocks, dict):
                 inner = stocks.get("stocks")
                 if isinstance(inner, list):
-                    total_qty = sum(int(s.get("present", 0) or 0) for s in inner if isinstance(s, dict))
+                    total_qty = _sum_present(inner)
                 else:
                     total_qty = int(stocks.get("present", 0) or 0)
             elif isinstance(stocks, list):
-                total_qty = sum(int(s.get("present", 0) or 0) for s in stocks if isinstance(s, dict))
+                total_qty = _sum_present(stocks)
             else:
                 total_qty = int(item.get("fbs_stocks", 0) or 0) + int(item.get("fbo_stocks", 0) or 0)
 
+            if total_qty <= threshold:
+                yield total_qty, idx, item.get("offer_id") or item.get("id") or item.get("product_id") or "Н/Д"
         else:
             # WB: quantity и nmId
-            article = _norm_article(item.get("nmId") or item.get("article") or "Н/Д")
             total_qty = int(item.get("quantity", 0) or 0)
+            if total_qty <= threshold:
+                yield total_qty, idx, item.get("nmId") or item.get("article") or "Н/Д"
 
-        if total_qty <= threshold_int:
-            low_stock_lines.append(f"🔻 <code>{html.escape(str(article))}</code>: <b>{total_qty} шт.</b>")
 
-    if not low_stock_lines:
+async def generate_stock_report(marketplace: str, items: list, threshold: int = 10) -> str:
+    """
+    Формирует список товаров с низким остатком (до 20 самых критичных — с наименьшим остатком).
+    items:
+    - WB: список stocks из statistics-api (/supplier/stocks): quantity, nmId
+    - Ozon: список items из /v3/product/info/list: stocks может быть dict или list (и внутри stocks.stocks)
+    """
+    mp = str(marketplace or "").strip()
+    mp_key = mp.lower().strip()
+
+    if not isinstance(items, list) or not items:
+        return ""
+
+    try:
+        threshold_int = int(threshold)
+    except Exception:
+        threshold_int = 10
+
+    # Куча на 20 элементов вместо полного списка: O(N log 20) и O(20) памяти;
+    # позиция во входе — вторичный ключ, чтобы при равном остатке сохранялся исходный порядок
+    top = heapq.nsmallest(_STOCK_REPORT_LIMIT, _iter_low_stock(mp_key, items, threshold_int))
+
+    if not top:
         return ""
 
-    header = [
-        f"⚠️ <b>Дефицит {html.escape(mp)}</b>",
-        "──────────────────",
+    lines = [
+        f"⚠️ <b>Дефицит {_esc(mp)}</b>",
+        _SEP,
         f"Остаток ниже {threshold_int} шт.:",
     ]
+    for total_qty, _idx, article in top:
+        lines.append(f"🔻 <code>{_esc(_norm_article(article))}</code>: <b>{total_qty} шт.</b>")
 
-    # Ограничиваем список 20 позициями
-    text = "\n".join(header) + "\n" + "\n".join(low_stock_lines[:20])
-    return _truncate_text(text)
+    return _truncate_text("\n".join(lines))
 
 
 # =============================================================================
@@ -487,9 +750,10 @@ async def generate_api_check_report(marketplace: str, is_valid: bool, balance: f
     status_text = "Подключено" if is_valid else "Ошибка (проверьте токены)"
 
     text = (
-        f"🔌 <b>Статус {html.escape(mp)}</b>\n"
-        f"──────────────────\n"
+        f"🔌 <b>Статус {_esc(mp)}</b>\n"
+        f"{_SEP}\n"
         f"Состояние: {status_emoji} <b>{status_text}</b>\n"
         f"💰 Доступно к выводу: <b>{format_currency(balance)}</b>"
     )
-    return _truncate_text(text)
+    # Длина ограничена шаблоном и названием маркетплейса — обрезка не нужна
+    return text
@@ -1,32 +1,40 @@
 """
-Версия файла: 1.3.1
+Версия файла: 1.4.0
 Описание: Планировщик задач (уведомления/отчеты/остатки) для Telegram-бота аналитики WB/Ozon.
-Дата изменения: 2026-01-22
+Дата изменения: 2026-10-15
 Изменения:
-- Приведено в полную совместимость с обновленным db_functions.py:
-  * is_order_new(..., user_tg_id=...) учитывает пользователя (tg_id) и предотвращает коллизии
-  * bulk_save_orders() сохраняет дату в Order.order_date, поэтому используем ключ order_date
-- Удалены TypeError-fallback блоки (они больше не нужны и маскируют реальные ошибки).
-- Упрощена логика дедупликации: if not await is_order_new(...): continue
-- Пакетное сохранение заказов (bulk_save_orders) оставлено для снижения нагрузки на БД.
+- В модуле одна реализация каждой задачи (safe_send_message, check_new_orders_task,
+  _process_wb_orders/_process_ozon_orders, send_morning_report, check_low_stock_task):
+  с нарезкой сообщений > 4096, дедупликацией заказов в проходе и ценой WB через wb_price_to_rub.
+- Новизна заказов определяется одной вставкой: bulk_save_orders() возвращает id реально
+  вставленных строк (ON CONFLICT DO NOTHING), уведомления уходят только по ним.
+- Дата заказа передаётся ключом order_date (сохраняется в Order.created_at).
+- Пользователи читаются из БД пачками (keyset по id, короткая сессия на пачку) с фильтром
+  notifications_enabled и обрабатываются пулом воркеров.
 - Улучшена стабильность: проверки типов, безопасные парсеры, безопасная нарезка сообщений > 4096.
-- Уважение notifications_enabled во всех уведомляющих задачах.
 """
 
 from __future__ import annotations
 
 import asyncio
-import html
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import Any, List, Tuple
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import httpx
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+from aiolimiter import AsyncLimiter
 from sqlalchemy import select
 
+from cache import TTLCache, api_wrappers
+# Приведения типов для полей заказов — в отдельном модуле, который можно скомпилировать mypyc
+from fast_helpers import first as _first, safe_float as _safe_float, safe_str as _safe_str, wb_price_to_rub as _wb_price_to_rub
 from database import async_session, User
-from ozon_api import OzonAPI
+from ozon_api import OzonAPI, get_shared_client as get_ozon_client
 from wb_api import WildberriesAPI
 
 import db_functions as dbf
@@ -34,153 +42,395 @@ import reports
 
 logger = logging.getLogger(__name__)
 
-# Ограничитель одновременных отправок/запросов (защита от перегрузки и Flood Limit)
-SEM_LIMIT = 5
-sem = asyncio.Semaphore(SEM_LIMIT)
+T = TypeVar("T")
+
+# Общий лимит отправки бота подстраивается под реальные ответы Telegram (адаптивный token bucket):
+# реальные лимиты не документированы, поэтому скорость растёт на успехах и падает на 429.
+SEND_RATE_START = 20.0  # сообщений/с на старте
+SEND_RATE_MIN = 1.0
+SEND_RATE_MAX = 30.0  # официальный ориентир Telegram для рассылок
+SEND_RATE_ALPHA = 0.01  # мультипликативный прирост на успехе
+SEND_RATE_DELTA = 0.1  # аддитивный прирост на успехе
+SEND_RATE_BETA = 0.5  # во сколько раз снижаем скорость на TelegramRetryAfter
+
+# Не чаще 1 сообщения в секунду в один чат
+CHAT_SEND_RATE = 1
+# Лимитеры чатов живут, пока чату что-то шлём (LRU + TTL вместо вечно растущего словаря)
+_chat_limiters = TTLCache(maxsize=10_000, ttl=60.0)
+
+# Отдельный ограничитель одновременных пользователей, обрабатываемых в задачах планировщика
+# (HTTP-запросы к API маркетплейсов), чтобы параллельный проход не упирался в лимиты WB/Ozon
+API_SEM_LIMIT = 10
+api_sem = asyncio.Semaphore(API_SEM_LIMIT)
+
+# Потоковая обработка пользователей: размер пачки из БД и число воркеров прохода
+USER_BATCH_SIZE = 100
+USER_WORKERS = 20
 
 TELEGRAM_TEXT_LIMIT = 4096
-DEFAULT_SLEEP_BETWEEN_SEND = 0.05  # 50ms
 
+# Шаблоны уведомлений о заказах (поля подставляются уже экранированными)
+WB_FBS_TMPL = (
+    "🚀 <b>Новый заказ Wildberries (FBS)!</b>\n\n"
+    "📦 Номер: <code>{oid}</code>\n"
+    "🔢 Артикул: <code>{art}</code>\n"
+    "💰 К оплате: <b>{price} ₽</b>"
+)
+WB_FBO_TMPL = (
+    "📦 <b>Продажа Wildberries (FBO)!</b>\n\n"
+    "📦 Номер: <code>{oid}</code>\n"
+    "🔢 Артикул: <code>{art}</code>\n"
+    "💰 Сумма: <b>{price} ₽</b>"
+)
+OZON_FBS_TMPL = (
+    "🚀 <b>Новый заказ Ozon (FBS)!</b>\n\n"
+    "📦 Номер: <code>{oid}</code>\n"
+    "🔢 Артикул: <code>{art}</code>\n"
+    "📦 Товар: <b>{name}</b>\n"
+    "💰 Сумма: <b>{price} ₽</b>"
+)
 
-# =============================================================================
-# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
-# =============================================================================
+# Экранирование HTML одним проходом str.translate (те же замены, что у html.escape)
+_HTML_TBL = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
 
-def _safe_str(value: Any, max_len: int = 255, default: str = "Н/Д") -> str:
-    """Безопасное приведение к строке."""
-    s = str(value).strip() if value is not None else default
-    if not s:
-        s = default
-    return s[:max_len]
 
+def _esc(s: str) -> str:
+    return s.translate(_HTML_TBL)
+
+
+# Рендер уведомлений — чистые функции от полей заказа: одинаковый заказ у нескольких
+# пользователей (общий кабинет) собирается и экранируется один раз
+@lru_cache(maxsize=4096)
+def _wb_fbs_msg(order_id: str, article: str, price: float) -> str:
+    return WB_FBS_TMPL.format_map({"oid": _esc(order_id), "art": _esc(article), "price": f"{price:,.2f}"})
+
+
+@lru_cache(maxsize=4096)
+def _wb_fbo_msg(order_id: str, article: str, price: float) -> str:
+    return WB_FBO_TMPL.format_map({"oid": _esc(order_id), "art": _esc(article), "price": f"{price:,.2f}"})
 
-def _safe_float(value: Any, default: float = 0.0) -> float:
-    """Безопасное приведение к float."""
-    try:
-        if value is None:
-            return default
-        if isinstance(value, str):
-            v = value.strip().replace(" ", "").replace(",", ".")
-            if v == "":
-                return default
-            return float(v)
-        return float(value)
-    except Exception:
-        return default
 
+@lru_cache(maxsize=4096)
+def _ozon_fbs_msg(order_id: str, article: str, name: str, price: float) -> str:
+    return OZON_FBS_TMPL.format_map(
+        {
+            "oid": _esc(order_id),
+            "art": _esc(article),
+            "name": _esc(name),
+            "price": f"{price:,.2f}",
+        }
+    )
 
-def _wb_price_to_rub(value: Any) -> float:
+
+# Общий HTTP-клиент WB приложения (задаётся в main.py); без него WildberriesAPI открывает
+# новое соединение на каждый запрос
+_wb_http_client: Optional[httpx.AsyncClient] = None
+
+
+def set_wb_http_client(client: Optional[httpx.AsyncClient]) -> None:
+    """Передаёт задачам планировщика общий httpx-клиент WB (keep-alive пул соединений)."""
+    global _wb_http_client
+    _wb_http_client = client
+
+
+class AdaptiveTokenBucket:
     """
-    WB может отдавать цену:
-    - в копейках (int)
-    - в рублях (float)
-    - строкой
-
-    Логика:
-    - если значение похоже на "копейки" (большое число), делим на 100
-    - иначе считаем рублями
+    Token bucket с подстройкой скорости: on_success() ускоряет (rate += δ + α·rate, до rate_max),
+    on_fail(retry_after) замедляет (rate *= β, до rate_min), обнуляет токены и
+    приостанавливает выдачу на retry_after секунд.
+    Рассчитан на один event loop, как и весь бот.
     """
-    v = _safe_float(value, 0.0)
-    if v <= 0:
-        return 0.0
 
-    # Частый кейс WB: цена в копейках (например 129900 = 1299.00)
-    # Порог 50000: уменьшает риск неверного деления для "рублевых" значений.
-    if v >= 50000:
-        return v / 100.0
+    def __init__(self, rate: float, rate_min: float, rate_max: float) -> None:
+        self.rate = float(rate)
+        self.rate_min = float(rate_min)
+        self.rate_max = float(rate_max)
+        self.tokens = self.rate
+        self.last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        # ёмкость ведра = секунда трафика на текущей скорости
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self) -> None:
+        # lock: ожидающие получают токены по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.rate_max, self.rate + SEND_RATE_DELTA + SEND_RATE_ALPHA * self.rate)
+
+    def on_fail(self, retry_after: float = 0.0) -> None:
+        self.rate = max(self.rate_min, self.rate * SEND_RATE_BETA)
+        self.tokens = 0.0
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + max(0.0, float(retry_after)))
+        # за время паузы токены не копятся — после неё стартуем с пустого ведра
+        self.last_refill = max(now, self._paused_until)
+
+
+global_limiter = AdaptiveTokenBucket(SEND_RATE_START, SEND_RATE_MIN, SEND_RATE_MAX)
 
-    return v
 
+# =============================================================================
+# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# =============================================================================
 
 def _split_long_message(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> List[str]:
-    """Разбивает длинное сообщение на части, пытается резать по границам строк."""
+    """
+    Разбивает длинное сообщение на части, пытается резать по границам строк.
+    Граница каждой части — последний перевод строки в окне limit (str.rfind в C),
+    строки по одной не перебираются; без перевода строки в окне режем ровно по limit.
+    """
     if not text:
         return [""]
 
-    if len(text) <= limit:
+    n = len(text)
+    if n <= limit:
         return [text]
 
     parts: List[str] = []
-    chunk = ""
-    for line in text.splitlines(keepends=True):
-        if len(chunk) + len(line) <= limit:
-            chunk += line
-        else:
-            if chunk:
-                parts.append(chunk)
-            while len(line) > limit:
-                parts.append(line[:limit])
-                line = line[limit:]
-            chunk = line
-
-    if chunk:
-        parts.append(chunk)
+    start = 0
+    while start < n:
+        end = start + limit
+        if end >= n:
+            parts.append(text[start:])
+            break
+        nl = text.rfind("\n", start, end)
+        cut = nl + 1 if nl >= 0 else end
+        parts.append(text[start:cut])
+        start = cut
 
     return parts
 
 
+def _chat_limiter(chat_id: int) -> AsyncLimiter:
+    limiter = _chat_limiters.get(chat_id)
+    if limiter is None:
+        limiter = AsyncLimiter(CHAT_SEND_RATE, 1)
+    # set и для существующего — продлевает TTL активного чата
+    _chat_limiters.set(chat_id, limiter)
+    return limiter
+
+
+async def async_antiflood(
+    factory: Callable[[], Awaitable[T]],
+    retries: int = 5,
+    chat_id: Optional[int] = None,
+) -> T:
+    """
+    Выполняет вызов Telegram API с повтором на TelegramRetryAfter (flood limit).
+    factory создаёт новую корутину на каждую попытку. Каждая пауза также замедляет
+    общий ограничитель global_limiter. После retries попыток исключение пробрасывается.
+    """
+    attempt = 1
+    while True:
+        try:
+            return await factory()
+        except TelegramRetryAfter as e:
+            retry_after = int(getattr(e, "retry_after", 1) or 1)
+            global_limiter.on_fail(retry_after)
+            logger.warning(f"Flood limit: sleep {retry_after}s (user={chat_id}, attempt={attempt})")
+            if attempt >= retries:
+                raise
+            attempt += 1
+            await asyncio.sleep(retry_after + 0.1)
+
+
+async def _send_part(bot: Bot, chat_id: int, text: str, parse_mode: str, chat_limiter: AsyncLimiter) -> None:
+    async with chat_limiter:
+        await global_limiter.acquire()
+        await bot.send_message(chat_id, text, parse_mode=parse_mode)
+    global_limiter.on_success()
+
+
 async def safe_send_message(
     bot: Bot,
     chat_id: int,
     text: str,
     parse_mode: str = "HTML",
-    _attempt: int = 1,
-    _max_attempts: int = 5,
+    max_attempts: int = 5,
 ) -> None:
     """
     Безопасная отправка сообщений:
-    - semaphore
-    - backoff на TelegramRetryAfter
-    - защита от бесконечной рекурсии
+    - token bucket: общий адаптивный лимит бота + лимит на чат (вместо семафора и фиксированной паузы)
+    - backoff на TelegramRetryAfter (async_antiflood): повторяется только текущая часть,
+      уже отправленные не дублируются; не более max_attempts попыток на часть
     - разбиение >4096
     """
     if not text:
         return
 
-    parts = _split_long_message(text, TELEGRAM_TEXT_LIMIT)
+    chat_limiter = _chat_limiter(chat_id)
+
+    for part in _split_long_message(text, TELEGRAM_TEXT_LIMIT):
+        try:
+            await async_antiflood(
+                lambda p=part: _send_part(bot, chat_id, p, parse_mode, chat_limiter),
+                retries=max_attempts,
+                chat_id=chat_id,
+            )
+        except TelegramRetryAfter:
+            logger.error(f"Flood limit: max attempts reached (user={chat_id})")
+            return
+        except TelegramForbiddenError:
+            logger.info(f"Бот заблокирован пользователем {chat_id}. Пропускаем отправку.")
+            return
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения пользователю {chat_id}: {e}")
+            return
+
+
+async def _save_and_notify(bot: Bot, chat_id: int, to_save: List[dict], messages: Dict[str, str]) -> None:
+    """
+    Сохраняет заказы (ON CONFLICT DO NOTHING) и уведомляет только о реально вставленных:
+    проверка «новый ли заказ» совмещена с записью — один запрос к БД вместо двух.
+    """
+    if not to_save:
+        return
+    inserted = await dbf.bulk_save_orders(to_save)
+    await _send_all(bot, chat_id, [msg for oid, msg in messages.items() if oid in inserted])
+
+
+async def _run_group(stage: str, coros: List[Awaitable[Any]]) -> None:
+    """
+    Конкурентный запуск группы корутин со структурированной отменой (аналог asyncio.TaskGroup,
+    которого нет в Python 3.10): ошибки каждой задачи логируются, а при отмене внешней задачи
+    (остановка планировщика) все дочерние отменяются и дожидаются — без «висящих» запросов и записей.
+    """
+    if not coros:
+        return
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    except asyncio.CancelledError:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    for res in results:
+        if isinstance(res, Exception):
+            logger.error(f"{stage}: {res}")
+
+
+async def _send_all(bot: Bot, chat_id: int, messages: List[str]) -> None:
+    """
+    Отправляет пачку уведомлений одному чату конкурентно; темп задают ограничители safe_send_message.
+    """
+    await _run_group(f"Отправка уведомлений (user={chat_id})", [safe_send_message(bot, chat_id, m) for m in messages])
 
-    async with sem:
-        for part in parts:
-            try:
-                await bot.send_message(chat_id, part, parse_mode=parse_mode)
-                await asyncio.sleep(DEFAULT_SLEEP_BETWEEN_SEND)
-            except TelegramRetryAfter as e:
-                retry_after = int(getattr(e, "retry_after", 1) or 1)
-                logger.warning(f"Flood limit: sleep {retry_after}s (user={chat_id}, attempt={_attempt})")
-                if _attempt >= _max_attempts:
-                    logger.error(f"Flood limit: max attempts reached (user={chat_id})")
-                    return
-                await asyncio.sleep(retry_after)
-                return await safe_send_message(
-                    bot=bot,
-                    chat_id=chat_id,
-                    text=text,
-                    parse_mode=parse_mode,
-                    _attempt=_attempt + 1,
-                    _max_attempts=_max_attempts,
-                )
-            except TelegramForbiddenError:
-                logger.info(f"Бот заблокирован пользователем {chat_id}. Пропускаем отправку.")
-                return
-            except Exception as e:
-                logger.error(f"Ошибка отправки сообщения пользователю {chat_id}: {e}")
-                return
 
+async def _iter_user_batches(
+    batch_size: int = USER_BATCH_SIZE, only_with_notifications: bool = True
+) -> AsyncIterator[List[User]]:
+    """
+    Пользователи для фоновых задач пачками по batch_size — keyset-пагинацией по первичному ключу
+    (WHERE id > последний ORDER BY id LIMIT batch_size), без загрузки всей таблицы в память.
+    Каждая пачка читается в своей короткой сессии, закрытой до передачи пользователей воркерам:
+    незавершённый курсор чтения держал бы SHARED-блокировку SQLite (журнал без WAL), и COMMIT
+    воркеров (bulk_save_orders) падал бы с «database is locked».
+    only_with_notifications — фильтр notifications_enabled IS TRUE в SQL (NULL — выключено, как и раньше),
+    пользователи с выключенными уведомлениями даже не загружаются.
+    """
+    stmt = select(User).order_by(User.id).limit(batch_size)
+    if only_with_notifications:
+        stmt = stmt.where(User.notifications_enabled.is_(True))
 
-async def _load_users_for_tasks() -> List[User]:
-    """Загружает пользователей для фоновых задач."""
-    async with async_session() as session:
+    last_id = 0
+    while True:
         try:
-            res = await session.execute(select(User))
-            return list(res.scalars().all())
+            async with async_session() as session:
+                batch = list((await session.scalars(stmt.where(User.id > last_id))).all())
         except Exception as e:
             logger.error(f"Ошибка загрузки пользователей: {e}")
-            return []
+            return
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield batch
+        if len(batch) < batch_size:
+            return
+
+
+def _get_wb(user: User) -> Optional[WildberriesAPI]:
+    """
+    Обёртка WB пользователя из общего кэша api_wrappers (тот же, что у хендлеров):
+    пересоздаётся только при смене токена или HTTP-клиента.
+    """
+    token = (user.wb_token or "").strip()
+    if not token:
+        return None
+    wb = api_wrappers.get((user.tg_id, "wb"))
+    if wb is None or wb.token != token or wb.client is not _wb_http_client:
+        wb = WildberriesAPI(token, client=_wb_http_client)
+        api_wrappers.set((user.tg_id, "wb"), wb)
+    return wb
+
+
+def _get_ozon(user: User) -> Optional[OzonAPI]:
+    """Обёртка Ozon пользователя из общего кэша; клиент — общий клиент модуля ozon_api."""
+    client_id = (user.ozon_client_id or "").strip()
+    api_key = (user.ozon_api_key or "").strip()
+    if not client_id or not api_key:
+        return None
+    http_client = get_ozon_client()
+    ozon = api_wrappers.get((user.tg_id, "ozon"))
+    if ozon is None or ozon.client_id != client_id or ozon.api_key != api_key or ozon.client is not http_client:
+        ozon = OzonAPI(client_id, api_key, client=http_client)
+        api_wrappers.set((user.tg_id, "ozon"), ozon)
+    return ozon
+
+
+async def _user_worker(stage: str, queue: "asyncio.Queue[User]", handler: Callable[[User], Awaitable[None]]) -> None:
+    while True:
+        user = await queue.get()
+        try:
+            await handler(user)
+        except Exception as e:
+            logger.error(f"{stage}: ошибка обработки пользователя {user.tg_id}: {e}")
+        finally:
+            queue.task_done()
 
 
-def _notifications_enabled(user: User) -> bool:
-    """Проверяет флаг уведомлений пользователя."""
-    return bool(getattr(user, "notifications_enabled", True))
+async def _run_for_users(
+    stage: str,
+    handler: Callable[[User], Awaitable[None]],
+    prepare: Optional[Callable[[List[User]], Awaitable[None]]] = None,
+) -> None:
+    """
+    Проход по пользователям с включенными уведомлениями (фильтр в SQL): пачки из БД идут в ограниченную очередь,
+    её разбирают USER_WORKERS воркеров. Память — O(очередь), первые отправки — сразу после первой пачки.
+    prepare(batch) вызывается перед постановкой пачки в очередь (например, предзагрузка данных из БД).
+    Ошибка одного пользователя не прерывает проход — она логируется.
+    Сессия чтения пользователей в воркеры не передаётся (AsyncSession не потокобезопасна
+    для конкурентных задач) и закрывается до их работы: вызовы db_functions открывают
+    собственные короткие сессии из пула, а записи не ждут блокировку чтения.
+    """
+    queue: "asyncio.Queue[User]" = asyncio.Queue(maxsize=USER_WORKERS * 2)
+    workers = [asyncio.create_task(_user_worker(stage, queue, handler)) for _ in range(USER_WORKERS)]
+    try:
+        async for batch in _iter_user_batches():
+            if prepare is not None:
+                await prepare(batch)
+            for user in batch:
+                await queue.put(user)
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 
 # =============================================================================
@@ -191,77 +441,82 @@ async def check_new_orders_task(bot: Bot) -> None:
     """
     Периодическая проверка новых заказов на маркетплейсах.
     """
-    users = await _load_users_for_tasks()
-    if not users:
-        return
+    # Одна отметка времени на весь тик: точность order_date — минуты, а не микросекунды
+    tick_now = datetime.now()
+    await _run_for_users("Новые заказы", lambda u: _handle_user_orders(bot, u, tick_now))
 
-    for user in users:
-        if not _notifications_enabled(user):
-            continue
 
-        tasks = []
+async def _handle_user_orders(bot: Bot, user: User, now: Optional[datetime] = None) -> None:
+    """Заказы одного пользователя: WB и Ozon параллельно, каждый — под api_sem."""
+    tasks = []
+
+    wb_token = (user.wb_token or "").strip()
+    if wb_token:
+        tasks.append(_with_api_sem(_process_wb_orders(bot, user, now=now)))
+
+    ozon_client_id = (user.ozon_client_id or "").strip()
+    ozon_api_key = (user.ozon_api_key or "").strip()
+    if ozon_client_id and ozon_api_key:
+        tasks.append(_with_api_sem(_process_ozon_orders(bot, user, now=now)))
 
-        wb_token = (user.wb_token or "").strip()
-        if wb_token:
-            tasks.append(_process_wb_orders(bot, user))
+    await _run_group(f"Новые заказы (user={user.tg_id})", tasks)
 
-        ozon_client_id = (user.ozon_client_id or "").strip()
-        ozon_api_key = (user.ozon_api_key or "").strip()
-        if ozon_client_id and ozon_api_key:
-            tasks.append(_process_ozon_orders(bot, user))
 
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+async def _with_api_sem(coro: Awaitable[Any]) -> Any:
+    async with api_sem:
+        return await coro
 
 
-async def _process_wb_orders(bot: Bot, user: User) -> None:
-    """Обработка WB заказов (FBS+FBO)."""
+async def _process_wb_orders(bot: Bot, user: User, now: Optional[datetime] = None) -> None:
+    """Обработка WB заказов (FBS+FBO). now — время тика планировщика (по умолчанию текущее)."""
     try:
-        token = (user.wb_token or "").strip()
-        if not token:
+        wb = _get_wb(user)
+        if wb is None:
             return
 
-        wb = WildberriesAPI(token)
         all_wb = await wb.get_all_orders(days=1)
         if not isinstance(all_wb, dict):
             logger.error(f"WB API: некорректный формат (ожидался dict) user={user.tg_id}")
             return
 
         to_save: List[dict] = []
+        # order_id -> текст уведомления; повтор заказа в выдаче не даёт второго уведомления
+        messages: Dict[str, str] = {}
+        # одно время и tg_id на все заказы прохода
+        if now is None:
+            now = datetime.now()
+        uid = user.tg_id
+
+        fbs_list = all_wb.get("fbs", [])
+        fbo_list = all_wb.get("fbo", [])
+        if not isinstance(fbs_list, list):
+            fbs_list = []
+        if not isinstance(fbo_list, list):
+            fbo_list = []
 
         # -------------------------
         # FBS
         # -------------------------
-        fbs_list = all_wb.get("fbs", [])
-        if isinstance(fbs_list, list):
+        if fbs_list:
             for order in fbs_list:
                 if not isinstance(order, dict):
                     continue
 
                 order_id = _safe_str(order.get("id"), max_len=128, default="")
-                if not order_id:
-                    continue
-
-                # ВАЖНО: дедупликация с учетом пользователя
-                if not await dbf.is_order_new(order_id, "wb", user_tg_id=user.tg_id):
+                if not order_id or order_id in messages:
                     continue
 
-                article_raw = order.get("article") or order.get("nmId") or order.get("supplierArticle") or "Н/Д"
-                article_msg = html.escape(_safe_str(article_raw, max_len=128, default="Н/Д"))
+                article_raw = _first(order, "article", "nmId", "supplierArticle", default="Н/Д")
 
                 raw_price = order.get("convertedPrice")
                 if raw_price is None:
-                    raw_price = order.get("price") or order.get("totalPrice") or 0
+                    raw_price = _first(order, "price", "totalPrice", default=0)
 
                 price = _wb_price_to_rub(raw_price)
 
-                msg = (
-                    f"🚀 <b>Новый заказ Wildberries (FBS)!</b>\n\n"
-                    f"📦 Номер: <code>{html.escape(order_id)}</code>\n"
-                    f"🔢 Артикул: <code>{article_msg}</code>\n"
-                    f"💰 К оплате: <b>{price:,.2f} ₽</b>"
+                messages[order_id] = _wb_fbs_msg(
+                    order_id, _safe_str(article_raw, max_len=128, default="Н/Д"), price
                 )
-                await safe_send_message(bot, user.tg_id, msg)
 
                 to_save.append(
                     {
@@ -269,39 +524,30 @@ async def _process_wb_orders(bot: Bot, user: User) -> None:
                         "marketplace": "wb",
                         "amount": price,
                         "item_name": _safe_str(article_raw, 255, "Н/Д"),
-                        "user_id": user.tg_id,
-                        "order_date": datetime.now(),
+                        "user_id": uid,
+                        "order_date": now,
                     }
                 )
 
         # -------------------------
         # FBO
         # -------------------------
-        fbo_list = all_wb.get("fbo", [])
-        if isinstance(fbo_list, list):
+        if fbo_list:
             for order in fbo_list:
                 if not isinstance(order, dict):
                     continue
 
-                order_id = _safe_str(order.get("gNumber") or order.get("orderId"), max_len=128, default="")
-                if not order_id:
+                order_id = _safe_str(_first(order, "gNumber", "orderId"), max_len=128, default="")
+                if not order_id or order_id in messages:
                     continue
 
-                if not await dbf.is_order_new(order_id, "wb", user_tg_id=user.tg_id):
-                    continue
-
-                article_raw = order.get("supplierArticle") or order.get("nmId") or order.get("article") or "Н/Д"
-                article_msg = html.escape(_safe_str(article_raw, max_len=128, default="Н/Д"))
+                article_raw = _first(order, "supplierArticle", "nmId", "article", default="Н/Д")
 
                 price = _safe_float(order.get("totalPrice"), 0.0)
 
-                msg = (
-                    f"📦 <b>Продажа Wildberries (FBO)!</b>\n\n"
-                    f"📦 Номер: <code>{html.escape(order_id)}</code>\n"
-                    f"🔢 Артикул: <code>{article_msg}</code>\n"
-                    f"💰 Сумма: <b>{price:,.2f} ₽</b>"
+                messages[order_id] = _wb_fbo_msg(
+                    order_id, _safe_str(article_raw, max_len=128, default="Н/Д"), price
                 )
-                await safe_send_message(bot, user.tg_id, msg)
 
                 to_save.append(
                     {
@@ -309,21 +555,20 @@ async def _process_wb_orders(bot: Bot, user: User) -> None:
                         "marketplace": "wb",
                         "amount": price,
                         "item_name": _safe_str(article_raw, 255, "Н/Д"),
-                        "user_id": user.tg_id,
-                        "order_date": datetime.now(),
+                        "user_id": uid,
+                        "order_date": now,
                     }
                 )
 
-        if to_save:
-            await dbf.bulk_save_orders(to_save)
+        await _save_and_notify(bot, uid, to_save, messages)
 
     except Exception as e:
         logger.error(f"WB task error (user={user.tg_id}): {e}")
 
 
-async def _process_ozon_orders(bot: Bot, user: User) -> None:
+async def _process_ozon_orders(bot: Bot, user: User, now: Optional[datetime] = None) -> None:
     """
-    Обработка Ozon заказов.
+    Обработка Ozon заказов. now — время тика планировщика (по умолчанию текущее).
 
     Ожидается, что ozon_api.get_all_orders(days=1) возвращает dict:
       {
@@ -335,18 +580,22 @@ async def _process_ozon_orders(bot: Bot, user: User) -> None:
       }
     """
     try:
-        client_id = (user.ozon_client_id or "").strip()
-        api_key = (user.ozon_api_key or "").strip()
-        if not client_id or not api_key:
+        ozon = _get_ozon(user)
+        if ozon is None:
             return
 
-        ozon = OzonAPI(client_id, api_key)
         all_ozon = await ozon.get_all_orders(days=1)
         if not isinstance(all_ozon, dict):
             logger.error(f"Ozon API: некорректный формат (ожидался dict) user={user.tg_id}")
             return
 
         to_save: List[dict] = []
+        # order_id -> текст уведомления; повтор заказа в выдаче не даёт второго уведомления
+        messages: Dict[str, str] = {}
+        # одно время и tg_id на все заказы прохода
+        if now is None:
+            now = datetime.now()
+        uid = user.tg_id
 
         fbs_orders = all_ozon.get("fbs", [])
         if isinstance(fbs_orders, list):
@@ -355,24 +604,16 @@ async def _process_ozon_orders(bot: Bot, user: User) -> None:
                     continue
 
                 order_id = _safe_str(o.get("order_id"), max_len=128, default="")
-                if not order_id:
-                    continue
-
-                if not await dbf.is_order_new(order_id, "ozon", user_tg_id=user.tg_id):
+                if not order_id or order_id in messages:
                     continue
 
                 article_raw = o.get("article") or "Н/Д"
                 name_raw = o.get("name") or "Товар"
                 price = _safe_float(o.get("price"), 0.0)
 
-                msg = (
-                    f"🚀 <b>Новый заказ Ozon (FBS)!</b>\n\n"
-                    f"📦 Номер: <code>{html.escape(order_id)}</code>\n"
-                    f"🔢 Артикул: <code>{html.escape(_safe_str(article_raw, 128, 'Н/Д'))}</code>\n"
-                    f"📦 Товар: <b>{html.escape(_safe_str(name_raw, 180, 'Товар'))}</b>\n"
-                    f"💰 Сумма: <b>{price:,.2f} ₽</b>"
+                messages[order_id] = _ozon_fbs_msg(
+                    order_id, _safe_str(article_raw, 128, "Н/Д"), _safe_str(name_raw, 180, "Товар"), price
                 )
-                await safe_send_message(bot, user.tg_id, msg)
 
                 to_save.append(
                     {
@@ -380,15 +621,14 @@ async def _process_ozon_orders(bot: Bot, user: User) -> None:
                         "marketplace": "ozon",
                         "amount": price,
                         "item_name": _safe_str(article_raw, 255, "Н/Д"),
-                        "user_id": user.tg_id,
-                        "order_date": datetime.now(),
+                        "user_id": uid,
+                        "order_date": now,
                     }
                 )
 
         # Если позже добавишь FBO для Ozon — обработай all_ozon["fbo"] аналогично.
 
-        if to_save:
-            await dbf.bulk_save_orders(to_save)
+        await _save_and_notify(bot, uid, to_save, messages)
 
     except Exception as e:
         logger.error(f"Ozon task error (user={user.tg_id}): {e}")
@@ -396,30 +636,56 @@ async def _process_ozon_orders(bot: Bot, user: User) -> None:
 
 async def send_morning_report(bot: Bot) -> None:
     """Рассылка финансовых итогов за прошедшие сутки (по расписанию)."""
-    users = await _load_users_for_tasks()
-    if not users:
-        return
-
     yesterday = datetime.now() - timedelta(days=1)
     date_human = yesterday.strftime("%d.%m.%Y")
     date_iso = yesterday.strftime("%Y-%m-%d")
 
-    for user in users:
-        if not _notifications_enabled(user):
-            continue
+    wb_costs: Dict[int, Any] = {}
+    ozon_costs: Dict[int, Any] = {}
+
+    async def prefetch_costs(batch: List[User]) -> None:
+        # Юнит-экономика пачки получателей — одним запросом на маркетплейс, а не по запросу на пользователя
+        wb_users = [u.tg_id for u in batch if (u.wb_token or "").strip()]
+        ozon_users = [u.tg_id for u in batch if (u.ozon_client_id or "").strip() and (u.ozon_api_key or "").strip()]
+        if wb_users:
+            wb_costs.update(await reports.get_many_users_cost_prices(wb_users, "wb"))
+        if ozon_users:
+            ozon_costs.update(await reports.get_many_users_cost_prices(ozon_users, "ozon"))
+
+    await _run_for_users(
+        "Утренний отчет",
+        lambda u: _send_user_morning_report(bot, u, date_human, date_iso, wb_costs, ozon_costs),
+        prepare=prefetch_costs,
+    )
+
 
-        report_parts: List[str] = [f"🌅 <b>Отчет за {date_human}</b>\n"]
-        has_data = False
+async def _send_user_morning_report(
+    bot: Bot,
+    user: User,
+    date_human: str,
+    date_iso: str,
+    wb_costs: Dict[int, Any],
+    ozon_costs: Dict[int, Any],
+) -> None:
+    """Утренний отчет одного пользователя: запросы к API под api_sem, отправка — вне его."""
+    report_parts: List[str] = [f"🌅 <b>Отчет за {date_human}</b>\n"]
+    has_data = False
 
+    async with api_sem:
         # WB
-        wb_token = (user.wb_token or "").strip()
-        if wb_token:
+        wb = _get_wb(user)
+        if wb is not None:
             try:
-                wb = WildberriesAPI(wb_token)
-                sales = await wb.get_sales_report(days=1)
+                # Продажи и баланс — независимые запросы, ждём их одновременно
+                sales, balance = await asyncio.gather(
+                    wb.get_sales_report(days=1), wb.get_balance(), return_exceptions=True
+                )
+                if isinstance(sales, BaseException):
+                    raise sales
 
                 if isinstance(sales, list) and sales:
-                    balance = await wb.get_balance()
+                    if isinstance(balance, BaseException):
+                        logger.error(f"Ошибка баланса WB (user={user.tg_id}): {balance}")
                     bal_val = balance if isinstance(balance, (int, float)) else 0.0
 
                     report_wb = await reports.generate_daily_report_text(
@@ -427,6 +693,7 @@ async def send_morning_report(bot: Bot) -> None:
                         sales,
                         user_tg_id=user.tg_id,
                         balance=bal_val,
+                        user_costs=wb_costs.get(user.tg_id),
                     )
                     report_parts.append(report_wb)
                     has_data = True
@@ -434,15 +701,18 @@ async def send_morning_report(bot: Bot) -> None:
                 logger.error(f"Ошибка утреннего отчета WB (user={user.tg_id}): {e}")
 
         # OZON
-        ozon_client_id = (user.ozon_client_id or "").strip()
-        ozon_api_key = (user.ozon_api_key or "").strip()
-        if ozon_client_id and ozon_api_key:
+        ozon = _get_ozon(user)
+        if ozon is not None:
             try:
-                ozon = OzonAPI(ozon_client_id, ozon_api_key)
-                stats = await ozon.get_daily_stats(date_iso)
+                stats, balance = await asyncio.gather(
+                    ozon.get_daily_stats(date_iso), ozon.get_balance(), return_exceptions=True
+                )
+                if isinstance(stats, BaseException):
+                    raise stats
 
                 if stats and (isinstance(stats, list) or isinstance(stats, dict)):
-                    balance = await ozon.get_balance()
+                    if isinstance(balance, BaseException):
+                        logger.error(f"Ошибка баланса Ozon (user={user.tg_id}): {balance}")
                     bal_val = balance if isinstance(balance, (int, float)) else 0.0
 
                     report_ozon = await reports.generate_daily_report_text(
@@ -450,49 +720,48 @@ async def send_morning_report(bot: Bot) -> None:
                         stats,
                         user_tg_id=user.tg_id,
                         balance=bal_val,
+                        user_costs=ozon_costs.get(user.tg_id),
                     )
                     report_parts.append(report_ozon)
                     has_data = True
             except Exception as e:
                 logger.error(f"Ошибка утреннего отчета Ozon (user={user.tg_id}): {e}")
 
-        if has_data:
-            await safe_send_message(bot, user.tg_id, "\n\n".join(report_parts))
+    if has_data:
+        await safe_send_message(bot, user.tg_id, "\n\n".join(report_parts))
 
 
 async def check_low_stock_task(bot: Bot) -> None:
     """Проверка остатков и уведомления при остатке <= threshold."""
-    users = await _load_users_for_tasks()
-    if not users:
-        return
+    await _run_for_users("Остатки", lambda u: _check_user_low_stock(bot, u))
 
-    for user in users:
-        if not _notifications_enabled(user):
-            continue
 
-        threshold = getattr(user, "stock_threshold", 5) or 5
-        try:
-            threshold = int(threshold)
-        except Exception:
-            threshold = 5
+async def _check_user_low_stock(bot: Bot, user: User) -> None:
+    """Остатки одного пользователя: запросы к API под api_sem, отправка — вне его."""
+    threshold = getattr(user, "stock_threshold", 5) or 5
+    try:
+        threshold = int(threshold)
+    except Exception:
+        threshold = 5
 
-        sources: List[Tuple[str, Any, List[Any]]] = [
-            ("Wildberries", WildberriesAPI, [(user.wb_token or "").strip()]),
-            ("Ozon", OzonAPI, [(user.ozon_client_id or "").strip(), (user.ozon_api_key or "").strip()]),
-        ]
+    sources: List[Tuple[str, Callable[[User], Any]]] = [
+        ("Wildberries", _get_wb),
+        ("Ozon", _get_ozon),
+    ]
 
-        for mp_name, api_class, args in sources:
-            if not all(args):
-                continue
+    for mp_name, get_api in sources:
+        api = get_api(user)
+        if api is None:
+            continue
 
-            try:
-                api = api_class(*args)
+        try:
+            async with api_sem:
                 stocks = await api.get_stock_info()
 
-                if stocks and isinstance(stocks, list):
-                    report_text = await reports.generate_stock_report(mp_name, stocks, threshold=threshold)
-                    if report_text:
-                        await safe_send_message(bot, user.tg_id, report_text)
+            if stocks and isinstance(stocks, list):
+                report_text = await reports.generate_stock_report(mp_name, stocks, threshold=threshold)
+                if report_text:
+                    await safe_send_message(bot, user.tg_id, report_text)
 
-            except Exception as e:
-                logger.error(f"Ошибка проверки остатков {mp_name} (user={user.tg_id}): {e}")
+        except Exception as e:
+            logger.error(f"Ошибка проверки остатков {mp_name} (user={user.tg_id}): {e}")
@@ -1,9 +1,11 @@
 import logging
 
+import numpy as np
+
 # Настройка логгера для отслеживания ошибок в расчетах
 logger = logging.getLogger(__name__)
 
-async def calculate_profit(
+def calculate_profit(
     marketplace: str, 
     price: float, 
     cost_price: float, 
@@ -13,6 +15,7 @@ async def calculate_profit(
 ):
     """
     Универсальный расчет чистой прибыли с одной единицы товара.
+    Функция синхронная: внутри нет ожиданий, вызывается без await.
     
     :param marketplace: Название площадки (WB/Ozon)
     :param price: Цена продажи (фактическая, со всеми скидками)
@@ -65,4 +68,61 @@ async def calculate_profit(
         # Возвращаем нулевые показатели в случае ошибки, чтобы бот не «падал»
         return {
             "net_profit": 0, "roi": 0, "margin": 0, "tax": 0, "marketplace_fees": 0, "extra_costs": 0
-        }
\ No newline at end of file
+        }
+
+
+def calculate_profit_batch(
+    prices: np.ndarray,
+    costs: np.ndarray,
+    tax_rate: float,
+    commissions: np.ndarray,
+    logistics: np.ndarray,
+    storage: np.ndarray,
+    ads: np.ndarray,
+    extras: np.ndarray,
+) -> dict:
+    """
+    Та же формула, что у calculate_profit, но сразу для пачки товаров (по одному элементу на SKU).
+
+    :param prices: Цены продажи
+    :param costs: Себестоимости
+    :param tax_rate: Ставка налога (общая для пачки)
+    :param commissions: Комиссии маркетплейса в процентах
+    :param logistics: Логистика
+    :param storage: Хранение
+    :param ads: Рекламные расходы
+    :param extras: Доп. расходы
+    :return: dict с массивами net_profit / roi / margin / tax / marketplace_fees / extra_costs
+    """
+    try:
+        prices = np.asarray(prices, dtype=np.float64)
+        costs = np.asarray(costs, dtype=np.float64)
+        extras = np.asarray(extras, dtype=np.float64)
+
+        tax = prices * tax_rate
+        m_comm = prices * (np.asarray(commissions, dtype=np.float64) / 100)
+        m_fees = m_comm + np.asarray(logistics, dtype=np.float64) + np.asarray(storage, dtype=np.float64) + np.asarray(ads, dtype=np.float64)
+
+        net = prices - (costs + tax + m_fees + extras)
+
+        # Деление только там, где знаменатель положительный (без предупреждений numpy)
+        roi = np.divide(net * 100, costs, out=np.zeros_like(net), where=costs > 0)
+        margin = np.divide(net * 100, prices, out=np.zeros_like(net), where=prices > 0)
+
+        return {
+            "net_profit": np.round(net, 2),
+            "roi": np.round(roi, 1),
+            "margin": np.round(margin, 1),
+            "tax": np.round(tax, 2),
+            "marketplace_fees": np.round(m_fees, 2),
+            "extra_costs": np.round(extras, 2),
+        }
+
+    except Exception as e:
+        logger.error(f"Ошибка в пакетном расчете unit_economics: {e}")
+        shape = np.shape(prices)
+        # Отдельный массив на каждый ключ: запись в один результат не должна менять остальные
+        return {
+            key: np.zeros(shape, dtype=np.float64)
+            for key in ("net_profit", "roi", "margin", "tax", "marketplace_fees", "extra_costs")
+        }
@@ -1,8 +1,30 @@
 """
-Версия файла: 1.2.0
+Версия файла: 1.3.0
 Описание: Клиент Wildberries API (заказы, продажи, остатки, финансы, карточки, SEO-позиции). Устойчив к ошибкам и лимитам.
-Дата изменения: 2026-01-22
+Дата изменения: 2026-10-15
 Изменения:
+- Общий на процесс httpx.AsyncClient (HTTP/2, keep-alive 60 с) вместо клиента на каждый запрос.
+- Параллельные запросы FBS/FBO в get_all_orders и карточек/остатков в get_all_products.
+- search_product_position: страницы выдачи запрашиваются одновременно (семафор на 5), без пауз,
+  через общий клиент; при раннем попадании оставшиеся запросы отменяются.
+- Единый backoff ретраев с джиттером (до 30 с); Retry-After понимается и в секундах, и как HTTP-date.
+- Клиентский token bucket на хост (и токен продавца): частота ниже квоты WB, 429 и заголовки
+  X-Ratelimit-Remaining/Reset притормаживают ведро.
+- iter_cards: потоковый обход карточек; get_all_products собирает товары по мере загрузки страниц.
+- iter_cards: страницы качает фоновая задача в очередь (до 4 впрок), без паузы 0.7 с между ними.
+- orjson и для разбора ответов, и для сериализации тел POST.
+- Кэш баланса (10 с), цен (60 с) и складов (10 мин) на экземпляр и проверки токена по токену
+  (300 с, неудача — 30 с), сброс при 401/403.
+- Circuit breaker на хост: после 5 сбоев подряд запросы 30 с не выполняются, затем
+  полуоткрытое состояние с одним пробным запросом.
+- AIMD-ограничение одновременных запросов на хост/токен (+0.5 на быстрый успех, ×0.5 на 429/5xx).
+- POST-запросы несут X-Request-ID, общий для всех повторов (идемпотентность записи).
+- Одновременные одинаковые GET склеиваются в один HTTP-запрос (single-flight).
+- search_product_positions: позиции нескольких артикулов по одному запросу за один обход выдачи.
+- dateFrom для заказов, продаж и остатков кэшируется по (дни, минута) вместо strftime на каждый вызов.
+- Подробные логи (сырые тела, расчёт баланса) — уровень DEBUG, строки не собираются при INFO и выше.
+- Ретраятся только сетевые сбои (таймауты, NetworkError, RemoteProtocolError); отмена задачи
+  пробрасывается сразу, прочие исключения и 4xx (кроме 429) — без повторов.
 - Переработан _make_request: единый AsyncClient, таймауты, ретраи с backoff, обработка 401/403/429/5xx.
 - Снижено шумное логирование: сырой ответ баланса логируется только в debug-режиме.
 - Нормализованы форматы marketplace и article: marketplace='wb', article=nmID/vendorCode/offerId -> строка, upper/strip где нужно.
@@ -10,20 +32,403 @@
 - get_cards_list: исправлена логика пагинации по cursor (ориентируемся на returned cards и наличие cursor полей), защита от бесконечного цикла.
 - get_all_products: связка карточек+остатков с устойчивым подсчётом quantity, marketplace='wb' (критично для БД/аналитики).
 - search_product_position: безопасные ретраи и ограничение страниц, защита от пустых ответов.
-- Добавлены util-функции _safe_str/_safe_float/_norm_article и параметр debug.
+- Добавлены util-функции _safe_str/_safe_float/_norm_article (уровня модуля) и параметр debug.
 """
 
 from __future__ import annotations
 
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+import random
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
 
 import httpx
+import orjson
+
+from cache import SingleFlight, TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Пул соединений к хостам API WB; keep-alive 60 с (меньше типичного idle-таймаута балансировщиков),
+# чтобы сокеты переживали паузы между страницами и интервалы опроса
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+
+# Общий на процесс клиент: все экземпляры WildberriesAPI без явного client переиспользуют
+# одни keep-alive соединения вместо TCP+TLS рукопожатия на каждый запрос
+_shared_client: Optional[httpx.AsyncClient] = None
+
+# Backoff ретраев: base * 2^(attempt-1), не больше cap, с джиттером до +50% —
+# одновременные воркеры не повторяют запросы синхронно
+_BACKOFF_BASE = 1.0
+_BACKOFF_CAP = 30.0
+_BACKOFF_JITTER = 0.5
+
+# Сетевые сбои, после которых запрос имеет смысл повторить: таймауты, обрыв/сброс соединения и
+# RemoteProtocolError (сервер закрыл соединение посреди ответа, GOAWAY в HTTP/2) — последний
+# не наследует NetworkError. Прочие исключения (битый URL, ошибки кода) не повторяются
+_RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах: delta-seconds или HTTP-date; None, если заголовка нет или он битый."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        dt = parsedate_to_datetime(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return (dt - datetime.now(tz=timezone.utc)).total_seconds()
+    except Exception:
+        return None
+
+
+class _TokenBucket:
+    """
+    Клиентский token bucket: держит частоту запросов ниже квоты WB, чтобы не получать 429.
+    penalize(seconds) — реакция на 429: выдача приостанавливается на seconds,
+    после чего ещё столько же времени скорость вдвое ниже.
+    Дополнительно скользящее окно 60 с: всплеск burst не выводит за минутную квоту (rate * 60).
+    Рассчитан на один event loop, как и весь бот.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._slow_until = 0.0
+        self._lock = asyncio.Lock()
+        self.per_minute = max(1, int(self.rate * 60))
+        self._window: Deque[float] = deque()
+
+    def _current_rate(self, now: float) -> float:
+        return self.rate * 0.5 if now < self._slow_until else self.rate
+
+    async def acquire(self) -> None:
+        # lock: ожидающие получают токены по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                rate = self._current_rate(now)
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+                self.last_refill = now
+                # скользящее окно: ждём, пока самая старая отметка выйдет за 60 с
+                window = self._window
+                while window and window[0] <= now - 60.0:
+                    window.popleft()
+                if len(window) >= self.per_minute:
+                    await asyncio.sleep(window[0] + 60.0 - now)
+                    continue
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    window.append(now)
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / rate)
+
+    def update_from_headers(self, headers: Any) -> None:
+        """
+        Подстройка по заголовкам квоты WB (X-Ratelimit-Remaining / X-Ratelimit-Reset):
+        токенов не больше, чем осталось на сервере; при исчерпании — пауза до сброса окна.
+        """
+        remaining_raw = headers.get("X-Ratelimit-Remaining")
+        if remaining_raw is None:
+            return
+        try:
+            remaining = float(remaining_raw)
+        except ValueError:
+            return
+        self.tokens = min(self.tokens, max(0.0, remaining))
+        if remaining < 1:
+            reset = _parse_retry_after(headers.get("X-Ratelimit-Reset"))
+            if reset is not None and reset > 0:
+                now = time.monotonic()
+                self._paused_until = max(self._paused_until, now + min(reset, _BACKOFF_CAP))
+                self.last_refill = max(now, self._paused_until)
+
+    def penalize(self, seconds: float) -> None:
+        now = time.monotonic()
+        seconds = max(0.0, float(seconds))
+        self.tokens = 0.0
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._slow_until = max(self._slow_until, self._paused_until + seconds)
+        # за время паузы токены не копятся
+        self.last_refill = max(now, self._paused_until)
+
+
+class _AIMDLimiter:
+    """
+    Ограничение одновременных запросов с AIMD-подстройкой: успешный ответ быстрее latency_target
+    увеличивает лимит на 0.5, 429/5xx/сетевой сбой — уменьшает вдвое (в пределах min..max).
+    Так параллельные вызовы (FBS+FBO, карточки+остатки) держатся у реальной ёмкости API WB.
+    """
+
+    def __init__(
+        self,
+        initial: float = 4.0,
+        min_limit: float = 1.0,
+        max_limit: float = 16.0,
+        latency_target: float = 2.0,
+    ) -> None:
+        self.limit = float(initial)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.latency_target = float(latency_target)
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self) -> "_AIMDLimiter":
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        if latency <= self.latency_target:
+            self.limit = min(self.max_limit, self.limit + 0.5)
+
+    def on_overload(self) -> None:
+        self.limit = max(self.min_limit, self.limit * 0.5)
+
+
+# Квоты по хостам: (запросов в секунду, размер всплеска). Для API продавца квота считается
+# на токен, поэтому ведро ключуется (хост, токен); публичный поиск — общий на процесс
+_DEFAULT_RATE: Tuple[float, int] = (100 / 60, 10)
+_HOST_RATES: Dict[str, Tuple[float, int]] = {
+    "search.wb.ru": (5.0, 5),
+}
+_buckets = TTLCache(maxsize=20_000, ttl=3600.0)
+
+
+_limiters = TTLCache(maxsize=20_000, ttl=3600.0)
+
+
+def _get_limiter(url: str, token: str = "") -> _AIMDLimiter:
+    """AIMD-ограничитель параллельности с тем же ключом (хост, токен), что и у ведра."""
+    key = (urlsplit(url).netloc, token)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _AIMDLimiter()
+        _limiters.set(key, limiter)
+    return limiter
+
+
+def _get_bucket(url: str, token: str = "") -> _TokenBucket:
+    """Ведро для хоста url (и токена продавца); создаётся при первом обращении."""
+    host = urlsplit(url).netloc
+    key = (host, token)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _TokenBucket(*_HOST_RATES.get(host, _DEFAULT_RATE))
+        _buckets.set(key, bucket)
+    return bucket
+
+
+# -----------------------------------------------------------------------------
+# Utils (функции модуля, а не методы: вызываются в циклах по карточкам/остаткам)
+# -----------------------------------------------------------------------------
+
+def _safe_str(value: Any, max_len: int = 255, default: str = "") -> str:
+    s = str(value).strip() if value is not None else default
+    if not s:
+        s = default
+    return s[:max_len]
+
+
+def _safe_float(value: Any, default: float = 0.0) -> float:
+    # быстрый путь: числа из JSON приходят уже int/float — без строковых операций
+    if value.__class__ is float or value.__class__ is int:
+        return float(value)
+    try:
+        if value is None:
+            return default
+        if isinstance(value, str):
+            v = value.strip().replace(" ", "").replace(",", ".")
+            if v == "":
+                return default
+            return float(v)
+        return float(value)
+    except Exception:
+        return default
+
+
+def _norm_article(value: Any) -> str:
+    # Для WB article часто nmId (int) -> строка
+    return _safe_str(value, max_len=128, default="")
+
+
+# Постоянные поля товара WB для db_functions.bulk_update_products (значения по умолчанию модели Product)
+_WB_PRODUCT_TEMPLATE: Dict[str, Any] = {
+    "marketplace": "wb",  # КРИТИЧНО: единый идентификатор для БД и аналитики
+    "article": "",
+    "name": "",
+    "cost_price": 0.0,
+    "extra_costs": 0.0,
+    "tax_rate": 0.06,
+    "stock": 0,
+}
+
+# C-уровневая проверка «это dict» для filter() вместо isinstance в генераторах
+_is_dict = dict.__instancecheck__
+
+
+@lru_cache(maxsize=256)
+def _build_url(base_url: str, endpoint: str) -> httpx.URL:
+    """Разобранный URL эндпоинта: конкатенация и парсинг строки — один раз на пару (хост, путь)."""
+    return httpx.URL(f"{base_url}{endpoint}")
+
+
+_DATE_FMT_DT = "%Y-%m-%dT00:00:00Z"
+_DATE_FMT_DAY = "%Y-%m-%d"
+
+
+@lru_cache(maxsize=8)
+def _date_from(days: int, minute_bucket: int, fmt: str = _DATE_FMT_DT) -> str:
+    """
+    Строка dateFrom «N дней назад» (локальное время).
+    minute_bucket = int(time.time() // 60): в пределах минуты строка берётся из кэша,
+    а не собирается заново через datetime/strftime на каждый запрос.
+    """
+    return (datetime.fromtimestamp(minute_bucket * 60) - timedelta(days=days)).strftime(fmt)
+
+
+def _body_head(resp: httpx.Response, limit: int) -> str:
+    """Начало тела ответа для логов: декодируется только срез байтов, а не весь (многомегабайтный) ответ."""
+    return resp.content[:limit].decode("utf-8", errors="replace")
+
+
+def _to_int_safe(value: Any) -> int:
+    """Безопасное приведение к int (пустое/битое значение -> 0)."""
+    try:
+        return int(value or 0)
+    except Exception:
+        return 0
+
+
+# Content API v2 /content/v2/get/cards/list: максимум карточек на страницу по документации WB
+# (больше сервер не отдаёт и отвечает 400) — берём максимум, чтобы страниц было минимум
+_CARDS_PAGE_LIMIT = 100
+# Постоянная часть payload запроса карточек (только читается, между запросами не меняется)
+_CARDS_FILTER: Dict[str, Any] = {"withPhoto": -1}
+# Сколько страниц карточек может быть загружено впрок, пока потребитель обрабатывает текущие
+_CARDS_PREFETCH = 4
+
+class _CircuitBreaker:
+    """
+    Размыкатель цепи для хоста WB: после fail_threshold сбоев подряд (5xx, таймауты, сеть)
+    запросы к хосту open_seconds не выполняются. После паузы цепь полуоткрыта: пропускается
+    ровно один пробный запрос, остальные по-прежнему отклоняются, пока проба не завершится.
+    Сбой пробы снова размыкает цепь, успех — замыкает и сбрасывает счётчик.
+    Проба без вердикта (429, отмена, неожиданная ошибка) освобождается release_probe(); зависшая
+    дольше open_seconds перестаёт блокировать — следующий вызов становится новой пробой.
+    """
+
+    def __init__(self, fail_threshold: int = 5, open_seconds: float = 30.0) -> None:
+        self.fail_threshold = int(fail_threshold)
+        self.open_seconds = float(open_seconds)
+        self.consec_fail = 0
+        self.opened_until = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    def is_open(self) -> bool:
+        """
+        True — запрос выполнять нельзя. Первый вызов после паузы получает False
+        и становится пробным запросом (полуоткрытое состояние).
+        """
+        if self.opened_until == 0.0:
+            return False
+        now = time.monotonic()
+        if now < self.opened_until:
+            return True
+        if self._probing and now - self._probe_started < self.open_seconds:
+            return True
+        self._probing = True
+        self._probe_started = now
+        return False
+
+    def release_probe(self) -> None:
+        """Завершает пробу без вердикта: цепь остаётся полуоткрытой для следующего вызова."""
+        self._probing = False
+
+    def record_success(self) -> None:
+        self.consec_fail = 0
+        self.opened_until = 0.0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consec_fail += 1
+        self._probing = False
+        if self.consec_fail >= self.fail_threshold:
+            self.opened_until = time.monotonic() + self.open_seconds
+            logger.warning(f"WB circuit breaker: {self.consec_fail} сбоев подряд, пауза {self.open_seconds:.0f}s")
+
+
+# Размыкатели по хостам: сбой хоста общий для всех пользователей (хостов WB единицы)
+_breakers: Dict[str, _CircuitBreaker] = {}
+
+
+def _get_breaker(url: str) -> _CircuitBreaker:
+    host = urlsplit(url).netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = _CircuitBreaker()
+    return breaker
+
+
+# Время жизни кэша экземпляра (с): баланс, цены, склады продавца
+_BALANCE_TTL = 10.0
+_PRICES_TTL = 60.0
+_WAREHOUSES_TTL = 600.0
+
+# Результаты проверки токена (/ping) по самому токену, общие для всех экземпляров
+# (обработчики создают WildberriesAPI на каждое действие). Отрицательный результат живёт
+# недолго, чтобы исправленный на стороне WB токен быстро заработал
+_PING_TTL = 300.0
+_PING_FAIL_TTL = 30.0
+_token_checks = TTLCache(maxsize=10_000, ttl=_PING_TTL)
+
+# SEO-поиск: число страниц выдачи (по 100 товаров) и одновременных запросов к search.wb.ru
+_SEO_PAGES = 10
+_SEO_CONCURRENCY = 5
+_SEO_TIMEOUT = 20.0
+
+
+def get_shared_client() -> httpx.AsyncClient:
+    """Общий httpx.AsyncClient для WB API (создаётся лениво, пересоздаётся после закрытия)."""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        # HTTP/2: параллельные запросы к одному хосту мультиплексируются в одном соединении (нужен пакет h2)
+        _shared_client = httpx.AsyncClient(timeout=60.0, limits=_LIMITS, http2=True)
+    return _shared_client
+
+
+async def close_shared_client() -> None:
+    """Закрывает общий клиент (при остановке приложения)."""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
 
 class WildberriesAPI:
     def __init__(
@@ -33,21 +438,37 @@ class WildberriesAPI:
         timeout: float = 60.0,
         max_retries: int = 3,
         debug: bool = False,
+        client: Optional[httpx.AsyncClient] = None,
     ):
         """
         Инициализация клиента Wildberries.
         Удаляем лишние пробелы из токена для предотвращения ошибок авторизации.
+        client — общий httpx.AsyncClient приложения (keep-alive пул соединений к API WB).
+        Если не передан, используется общий клиент модуля (get_shared_client).
         """
         self.token = str(token or "").strip()
         self.timeout = float(timeout)
         self.max_retries = int(max_retries)
         self.debug = bool(debug)
+        self.client = client
+
+        # Короткоживущий кэш ответов /ping и баланса: отчёты и проверки ключей
+        # часто запрашивают их несколько раз за секунды
+        self._cache = TTLCache(maxsize=8, ttl=_BALANCE_TTL)
+        self._flight = SingleFlight()
+        # Эндпоинты, последний ответ которых — 401/403: отличает отказ в авторизации
+        # от таймаута/5xx/429, после которых _make_request тоже возвращает None
+        self._auth_failed: set = set()
 
         self.headers = {
             "Authorization": self.token,
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
+        # Клиент общий для всех токенов, поэтому авторизация идёт с запросом; заголовки
+        # нормализуются в httpx.Headers один раз на экземпляр. GET без тела — без Content-Type
+        self._get_headers = httpx.Headers({"Authorization": self.token, "Accept": "application/json"})
+        self._post_headers = httpx.Headers(self.headers)
 
         # Разделение базовых URL по функциональным сегментам API WB
         self.common_url = "https://common-api.wildberries.ru"
@@ -59,37 +480,38 @@ class WildberriesAPI:
         # Публичный поиск (SEO)
         self.search_url = "https://search.wb.ru/exactmatch/ru/common/v4/search"
 
-    # -------------------------------------------------------------------------
-    # Utils
-    # -------------------------------------------------------------------------
-
-    def _safe_str(self, value: Any, max_len: int = 255, default: str = "") -> str:
-        s = str(value).strip() if value is not None else default
-        if not s:
-            s = default
-        return s[:max_len]
+    async def _cached(self, key: str, ttl: float, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Ответ из кэша экземпляра либо результат factory(); одновременные вызовы склеиваются.
+        None (ошибка запроса) не кэшируется — следующий вызов повторит запрос.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            return value
 
-    def _safe_float(self, value: Any, default: float = 0.0) -> float:
-        try:
-            if value is None:
-                return default
-            if isinstance(value, str):
-                v = value.strip().replace(" ", "").replace(",", ".")
-                if v == "":
-                    return default
-                return float(v)
-            return float(value)
-        except Exception:
-            return default
+        async def load() -> Any:
+            result = await factory()
+            if result is not None:
+                self._cache.set(key, result, ttl=ttl)
+            return result
 
-    def _norm_article(self, value: Any) -> str:
-        # Для WB article часто nmId (int) -> строка
-        return self._safe_str(value, max_len=128, default="").strip()
+        return await self._flight.run(key, load)
 
     # -------------------------------------------------------------------------
     # HTTP request
     # -------------------------------------------------------------------------
 
+    @staticmethod
+    def _compute_backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Пауза перед повтором: Retry-After сервера (если есть), иначе экспоненциальный backoff.
+        Оба варианта ограничены _BACKOFF_CAP и получают случайную добавку (джиттер).
+        """
+        if retry_after is not None:
+            return min(_BACKOFF_CAP, max(1.0, retry_after)) + random.uniform(0, _BACKOFF_JITTER)
+        delay = min(_BACKOFF_CAP, _BACKOFF_BASE * (2 ** (attempt - 1)))
+        return delay * (1 + random.uniform(0, _BACKOFF_JITTER))
+
     async def _make_request(
         self,
         base_url: str,
@@ -99,72 +521,160 @@ class WildberriesAPI:
         params: Optional[dict] = None,
         json_data: Optional[dict] = None,
         timeout: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> Optional[Any]:
+        """
+        Точка входа запросов к API. Одинаковые GET (эндпоинт + параметры), выполняющиеся
+        одновременно, склеиваются в один HTTP-запрос — все вызывающие получают его результат.
+        """
+        if method.upper() == "GET":
+            try:
+                key = ("GET", base_url, endpoint, tuple(sorted((params or {}).items())))
+                hash(key)
+            except TypeError:
+                key = None
+            if key is not None:
+                return await self._flight.run(
+                    key, lambda: self._request(base_url, endpoint, params=params, timeout=timeout)
+                )
+        return await self._request(
+            base_url,
+            endpoint,
+            method=method,
+            params=params,
+            json_data=json_data,
+            timeout=timeout,
+            idempotency_key=idempotency_key,
+        )
+
+    async def _request(
+        self,
+        base_url: str,
+        endpoint: str,
+        *,
+        method: str = "GET",
+        params: Optional[dict] = None,
+        json_data: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
     ) -> Optional[Any]:
         """
         Универсальный метод для выполнения HTTP-запросов с ретраями и обработкой лимитов.
-        Возвращает response.json() или None.
+        Возвращает распарсенный JSON ответа или None.
+        idempotency_key — X-Request-ID запроса на запись; для не-GET генерируется, если не задан,
+        и один и тот же уходит во всех повторах (повтор не дублирует операцию).
         """
-        url = f"{base_url}{endpoint}"
+        url = _build_url(base_url, endpoint)
         t = float(timeout) if timeout is not None else self.timeout
-        base_sleep = 1.0
-
-        limits = httpx.Limits(max_connections=20, max_keepalive_connections=10)
-        async with httpx.AsyncClient(headers=self.headers, timeout=t, limits=limits) as client:
-            for attempt in range(1, self.max_retries + 1):
-                try:
-                    if method.upper() == "GET":
-                        resp = await client.get(url, params=params)
-                    else:
-                        resp = await client.post(url, json=json_data, params=params)
-
-                    # 200 OK
-                    if resp.status_code == 200:
-                        try:
-                            return resp.json()
-                        except Exception as e:
-                            logger.error(f"WB JSON decode error {endpoint}: {e}")
-                            if self.debug:
-                                logger.info(f"WB raw body: {resp.text[:500]}")
-                            return None
-
-                    # Auth errors
-                    if resp.status_code in (401, 403):
-                        logger.error(f"WB auth error {endpoint}: {resp.status_code} - {resp.text[:300]}")
-                        return None
-
-                    # Rate limit / transient
-                    if resp.status_code in (429, 500, 502, 503, 504):
-                        retry_after = resp.headers.get("Retry-After")
-                        if retry_after:
-                            try:
-                                sleep_s = max(1.0, float(retry_after))
-                            except Exception:
-                                sleep_s = base_sleep * (2 ** (attempt - 1))
+        # Тело POST сериализуем один раз (orjson), а не на каждой попытке; Content-Type — в _post_headers
+        body = orjson.dumps(json_data) if json_data is not None else None
+        post_headers = self._post_headers
+        if method.upper() != "GET":
+            post_headers = httpx.Headers(post_headers)
+            post_headers["X-Request-ID"] = idempotency_key or uuid.uuid4().hex
+
+        # Клиент общий (приложения или модуля) и не закрывается здесь
+        client = self.client if self.client is not None else get_shared_client()
+        bucket = _get_bucket(base_url, self.token)
+        breaker = _get_breaker(base_url)
+        limiter = _get_limiter(base_url, self.token)
+
+        for attempt in range(1, self.max_retries + 1):
+            # Хост недоступен (серия 5xx/таймаутов) — не ждём ещё один таймаут, сразу отдаём None
+            if breaker.is_open():
+                logger.warning(f"WB circuit open {endpoint}: хост временно недоступен, запрос пропущен")
+                return None
+            try:
+                await bucket.acquire()
+                async with limiter:
+                    started = time.monotonic()
+                    try:
+                        if method.upper() == "GET":
+                            resp = await client.get(url, params=params, headers=self._get_headers, timeout=t)
                         else:
-                            # WB часто жёстко режет — делаем более длинный backoff
-                            sleep_s = min(30.0, (10.0 * attempt))
-
-                        sleep_s = min(sleep_s, 60.0)
-                        logger.warning(
-                            f"WB transient error {endpoint}: {resp.status_code}, attempt {attempt}/{self.max_retries}, sleep {sleep_s}s"
-                        )
-                        await asyncio.sleep(sleep_s)
-                        continue
+                            resp = await client.post(
+                                url, content=body, params=params, headers=post_headers, timeout=t
+                            )
+                    except _RETRYABLE_ERRORS:
+                        limiter.on_overload()
+                        raise
+
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    limiter.on_overload()
+                else:
+                    limiter.on_success(time.monotonic() - started)
+
+                # 5xx — сбой хоста; любой другой ответ значит, что хост жив (429 — квота токена, не сбой)
+                if resp.status_code >= 500:
+                    breaker.record_failure()
+                elif resp.status_code != 429:
+                    breaker.record_success()
+                else:
+                    # проба получила 429: хост отвечает, но вердикта нет — пробу может взять следующий
+                    breaker.release_probe()
+                # темп следующих запросов — по остатку квоты, который сообщил сервер
+                bucket.update_from_headers(resp.headers)
+
+                # 200 OK
+                if resp.status_code == 200:
+                    self._auth_failed.discard(endpoint)
+                    try:
+                        return orjson.loads(resp.content)
+                    except Exception as e:
+                        logger.error(f"WB JSON decode error {endpoint}: {e}")
+                        if self.debug and logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(f"WB raw body: {_body_head(resp, 500)}")
+                        return None
 
-                    # Other errors
-                    logger.error(f"WB API error {resp.status_code} {endpoint}: {resp.text[:500]}")
+                # Auth errors
+                if resp.status_code in (401, 403):
+                    logger.error(f"WB auth error {endpoint}: {resp.status_code} - {_body_head(resp, 300)}")
+                    # токен больше не действует — закэшированные ответы тоже
+                    self._cache.clear()
+                    _token_checks.pop(self.token)
+                    self._auth_failed.add(endpoint)
                     return None
 
-                except (httpx.TimeoutException, httpx.NetworkError) as e:
-                    sleep_s = min(base_sleep * (2 ** (attempt - 1)), 10.0)
+                # Rate limit / transient
+                if resp.status_code in (429, 500, 502, 503, 504):
+                    sleep_s = self._compute_backoff(attempt, _parse_retry_after(resp.headers.get("Retry-After")))
+                    if resp.status_code == 429:
+                        # остальные запросы этого хоста/токена тоже ждут, а не ловят 429 следом
+                        bucket.penalize(sleep_s)
+                    if attempt >= self.max_retries:
+                        # попытки кончились — пауза перед возвратом None ничего не даст
+                        logger.warning(f"WB transient error {endpoint}: {resp.status_code}, attempts exhausted")
+                        return None
                     logger.warning(
-                        f"WB connection/timeout {endpoint}: {e} (attempt {attempt}/{self.max_retries}), sleep {sleep_s}s"
+                        f"WB transient error {endpoint}: {resp.status_code}, attempt {attempt}/{self.max_retries}, sleep {sleep_s:.1f}s"
                     )
                     await asyncio.sleep(sleep_s)
                     continue
-                except Exception as e:
-                    logger.error(f"WB unexpected error {endpoint}: {e}")
+
+                # Other errors
+                logger.error(f"WB API error {resp.status_code} {endpoint}: {_body_head(resp, 500)}")
+                return None
+
+            except asyncio.CancelledError:
+                # отмена (остановка бота, отмена задачи) — не ошибка запроса: без ретраев и логов
+                breaker.release_probe()
+                raise
+            except _RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if attempt >= self.max_retries:
+                    logger.warning(f"WB connection/timeout {endpoint}: {e}, attempts exhausted")
                     return None
+                sleep_s = self._compute_backoff(attempt)
+                logger.warning(
+                    f"WB connection/timeout {endpoint}: {e} (attempt {attempt}/{self.max_retries}), sleep {sleep_s:.1f}s"
+                )
+                await asyncio.sleep(sleep_s)
+                continue
+            except Exception as e:
+                # неустранимая ошибка — повтор дал бы тот же результат
+                breaker.release_probe()
+                logger.error(f"WB unexpected error {endpoint}: {e}")
+                return None
 
         return None
 
@@ -176,21 +686,25 @@ class WildberriesAPI:
         """
         Получение баланса (доступно к выводу или текущий баланс).
         """
-        result = await self._make_request(self.finance_url, "/api/v1/account/balance")
+        result = await self._cached(
+            "balance", _BALANCE_TTL, lambda: self._make_request(self.finance_url, "/api/v1/account/balance")
+        )
         if not isinstance(result, dict):
             return 0.0
 
-        if self.debug:
-            logger.info(f"WB Balance Raw Response (dict keys): {list(result.keys())}")
+        if self.debug and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"WB Balance Raw Response (dict keys): {list(result.keys())}")
 
         try:
-            for_withdraw = self._safe_float(result.get("for_withdraw"), 0.0)
-            current = self._safe_float(result.get("current"), 0.0)
+            for_withdraw = _safe_float(result.get("for_withdraw"), 0.0)
+            current = _safe_float(result.get("current"), 0.0)
 
             # Приоритет: к выводу, если 0 — текущий
             final_balance = for_withdraw if for_withdraw > 0 else current
 
-            logger.info(f"WB Balance calculated: {final_balance} (Withdraw={for_withdraw}, Current={current})")
+            # баланс запрашивается на каждый /check_api и /profit — строка лога собирается только в DEBUG
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"WB Balance calculated: {final_balance} (Withdraw={for_withdraw}, Current={current})")
             return float(final_balance)
         except Exception:
             return 0.0
@@ -198,9 +712,21 @@ class WildberriesAPI:
     async def validate_token(self) -> bool:
         """
         Проверка работоспособности токена через /ping.
+        Отрицательный результат кэшируется только при отказе WB в авторизации (401/403):
+        таймаут, 5xx, 429 или открытый circuit breaker возвращают False без кэширования,
+        чтобы временный сбой WB не помечал рабочие токены недействительными.
         """
-        result = await self._make_request(self.common_url, "/ping")
-        return result is not None
+        ok = _token_checks.get(self.token)
+        if ok is not None:
+            return ok
+
+        result = await self._cached("ping", _PING_TTL, lambda: self._make_request(self.common_url, "/ping"))
+        if result is not None:
+            _token_checks.set(self.token, True, ttl=_PING_TTL)
+            return True
+        if "/ping" in self._auth_failed:
+            _token_checks.set(self.token, False, ttl=_PING_FAIL_TTL)
+        return False
 
     # -------------------------------------------------------------------------
     # Orders / sales / stocks
@@ -217,22 +743,29 @@ class WildberriesAPI:
         """
         data: Dict[str, List[Dict[str, Any]]] = {"fbs": [], "fbo": []}
 
-        # 1) FBS - новые сборочные задания
-        fbs_res = await self._make_request(self.marketplace_url, "/api/v3/orders/new")
-        if isinstance(fbs_res, dict):
+        # FBS (новые сборочные задания) и FBO (статистические заказы за период) — разные хосты,
+        # запросы независимы и выполняются одновременно
+        date_from = _date_from(int(days), int(time.time() // 60))
+        fbs_res, fbo_res = await asyncio.gather(
+            self._make_request(self.marketplace_url, "/api/v3/orders/new"),
+            self._make_request(
+                self.statistics_url,
+                "/api/v1/supplier/orders",
+                params={"dateFrom": date_from},
+            ),
+            return_exceptions=True,
+        )
+        if isinstance(fbs_res, BaseException):
+            logger.error(f"WB get_all_orders FBS error: {fbs_res}")
+        elif isinstance(fbs_res, dict):
             orders = fbs_res.get("orders", [])
             if isinstance(orders, list):
-                data["fbs"] = [o for o in orders if isinstance(o, dict)]
+                data["fbs"] = list(filter(_is_dict, orders))
 
-        # 2) FBO - статистические заказы за период
-        date_from = (datetime.now() - timedelta(days=int(days))).strftime("%Y-%m-%dT00:00:00Z")
-        fbo_res = await self._make_request(
-            self.statistics_url,
-            "/api/v1/supplier/orders",
-            params={"dateFrom": date_from},
-        )
-        if isinstance(fbo_res, list):
-            data["fbo"] = [o for o in fbo_res if isinstance(o, dict)]
+        if isinstance(fbo_res, BaseException):
+            logger.error(f"WB get_all_orders FBO error: {fbo_res}")
+        elif isinstance(fbo_res, list):
+            data["fbo"] = list(filter(_is_dict, fbo_res))
 
         return data
 
@@ -240,7 +773,7 @@ class WildberriesAPI:
         """
         Получение актуальных остатков товаров на складах WB.
         """
-        date_from = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+        date_from = _date_from(30, int(time.time() // 60), _DATE_FMT_DAY)
         result = await self._make_request(
             self.statistics_url,
             "/api/v1/supplier/stocks",
@@ -266,7 +799,7 @@ class WildberriesAPI:
         """
         Получение данных о продажах (выкупах) за период.
         """
-        date_from = (datetime.now() - timedelta(days=int(days))).strftime("%Y-%m-%dT00:00:00Z")
+        date_from = _date_from(int(days), int(time.time() // 60))
         result = await self._make_request(
             self.statistics_url,
             "/api/v1/supplier/sales",
@@ -288,134 +821,202 @@ class WildberriesAPI:
     async def search_product_position(self, keyword: str, target_article: str) -> int:
         """
         Поиск позиции товара в выдаче WB по ключевому слову.
-        В target_article обычно nmId (число строкой).
+        В target_article обычно nmId (число строкой). 0 — товар не найден в топ-1000.
         """
-        keyword = self._safe_str(keyword, max_len=200, default="")
-        target_article = self._safe_str(target_article, max_len=64, default="").strip()
-
-        if not keyword or not target_article:
+        target_article = _safe_str(target_article, max_len=64, default="").strip()
+        if not target_article:
             return 0
+        positions = await self.search_product_positions(keyword, {target_article})
+        return positions.get(target_article, 0)
 
-        logger.info(f"WB SEO: Поиск артикула {target_article} по запросу '{keyword}'")
-
-        limits = httpx.Limits(max_connections=10, max_keepalive_connections=5)
-        async with httpx.AsyncClient(timeout=20.0, limits=limits) as client:
-            # WB: до 100 товаров на страницу, максимум 10 страниц = топ-1000
-            for page in range(1, 11):
-                params = {
-                    "appType": 1,
-                    "curr": "rub",
-                    "dest": -1257744,  # Москва
-                    "query": keyword,
-                    "resultset": "catalog",
-                    "sort": "popular",
-                    "page": page,
-                }
-
-                try:
-                    resp = await client.get(self.search_url, params=params)
-                    if resp.status_code != 200:
-                        # 429/5xx — подождём и попробуем продолжить
-                        if resp.status_code in (429, 500, 502, 503, 504):
-                            sleep_s = min(2.0 * page, 10.0)
-                            logger.warning(f"WB SEO transient {resp.status_code}, sleep {sleep_s}s (page={page})")
-                            await asyncio.sleep(sleep_s)
-                            continue
-
-                        logger.error(f"WB Search Error: {resp.status_code} - {resp.text[:200]}")
-                        break
+    async def search_product_positions(self, keyword: str, target_articles: Set[str]) -> Dict[str, int]:
+        """
+        Позиции нескольких товаров в выдаче WB по одному ключевому слову.
+        Каждая страница выдачи запрашивается один раз на все артикулы.
+        Возвращает {артикул: позиция} только для найденных товаров.
+        """
+        keyword = _safe_str(keyword, max_len=200, default="")
+        remaining = {_safe_str(a, max_len=64, default="").strip() for a in (target_articles or ())}
+        remaining.discard("")
+
+        results: Dict[str, int] = {}
+        if not keyword or not remaining:
+            return results
+
+        logger.info(f"WB SEO: Поиск артикулов ({len(remaining)} шт.) по запросу '{keyword}'")
+
+        # WB: до 100 товаров на страницу, максимум 10 страниц = топ-1000.
+        # Страницы запрашиваются одновременно (не более _SEO_CONCURRENCY сразу), затем
+        # просматриваются по порядку — для каждого артикула берётся самая ранняя позиция
+        sem = asyncio.Semaphore(_SEO_CONCURRENCY)
+        bucket = _get_bucket(self.search_url)
+
+        # Общие параметры запроса; у страниц отличается только page
+        base_params = {
+            "appType": 1,
+            "curr": "rub",
+            "dest": -1257744,  # Москва
+            "query": keyword,
+            "resultset": "catalog",
+            "sort": "popular",
+        }
 
-                    data = resp.json()
-                    products = data.get("data", {}).get("products", [])
-                    if not isinstance(products, list) or not products:
-                        break
+        async def fetch_page(client: httpx.AsyncClient, page: int) -> Optional[List[Any]]:
+            """Товары страницы; [] — конец выдачи или ошибка, None — страница недоступна (пропускаем)."""
+            params = {**base_params, "page": page}
+            try:
+                for attempt in range(1, 4):
+                    async with sem:
+                        await bucket.acquire()
+                        resp = await client.get(self.search_url, params=params, timeout=_SEO_TIMEOUT)
 
-                    for index, product in enumerate(products):
-                        if not isinstance(product, dict):
-                            continue
-                        if str(product.get("id")) == target_article:
-                            position = ((page - 1) * 100) + index + 1
-                            logger.info(f"WB SEO: Товар {target_article} найден на {position} месте")
-                            return position
+                    if resp.status_code == 200:
+                        data = orjson.loads(resp.content)
+                        products = data.get("data", {}).get("products", [])
+                        return products if isinstance(products, list) else []
 
-                except Exception as e:
-                    logger.error(f"Ошибка WB SEO (page={page}): {e}")
-                    break
+                    # 429/5xx — подождём и повторим только эту страницу
+                    if resp.status_code in (429, 500, 502, 503, 504):
+                        retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                        sleep_s = min(max(retry_after, 1.0), 10.0) if retry_after is not None else min(2.0 * attempt, 10.0)
+                        if resp.status_code == 429:
+                            bucket.penalize(sleep_s)
+                        if attempt == 3:
+                            logger.warning(f"WB SEO transient {resp.status_code}, страница пропущена (page={page})")
+                            return None
+                        logger.warning(f"WB SEO transient {resp.status_code}, sleep {sleep_s}s (page={page})")
+                        await asyncio.sleep(sleep_s)
+                        continue
 
-                await asyncio.sleep(0.3)
+                    logger.error(f"WB Search Error: {resp.status_code} - {_body_head(resp, 200)}")
+                    return []
+                return None
+            except asyncio.CancelledError:
+                raise
+            except _RETRYABLE_ERRORS as e:
+                # сетевой сбой одной страницы не обрывает весь обход выдачи — страница пропускается
+                logger.warning(f"WB SEO network error, страница пропущена (page={page}): {e}")
+                return None
+            except Exception as e:
+                logger.error(f"Ошибка WB SEO (page={page}): {e}")
+                return []
+
+        # Общий клиент (HTTP/2, keep-alive): соединение с search.wb.ru переживает вызов, а страницы
+        # выдачи идут потоками одного TLS-соединения. Заголовков авторизации у клиента нет —
+        # токен продавца в публичный поиск не уходит
+        client = self.client if self.client is not None else get_shared_client()
+        tasks = [asyncio.create_task(fetch_page(client, page)) for page in range(1, _SEO_PAGES + 1)]
+
+        # Страницы разбираются по порядку по мере готовности: когда найдены все артикулы
+        # (или кончилась выдача), оставшиеся запросы отменяются, а не дожидаются
+        try:
+            for page, task in enumerate(tasks, 1):
+                products = await task
+                if products is None:
+                    continue
+                if not products:
+                    break
 
-        logger.info(f"WB SEO: Товар {target_article} не найден в топ-1000")
-        return 0
+                for index, product in enumerate(products):
+                    # EAFP: в нормальной выдаче все элементы — dict, проверка типа не нужна
+                    try:
+                        product_id = str(product.get("id"))
+                    except AttributeError:
+                        continue
+                    if product_id in remaining:
+                        position = ((page - 1) * 100) + index + 1
+                        logger.info(f"WB SEO: Товар {product_id} найден на {position} месте")
+                        results[product_id] = position
+                        remaining.discard(product_id)
+                        if not remaining:
+                            return results
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if remaining:
+            logger.info(f"WB SEO: Не найдены в топ-1000: {', '.join(sorted(remaining))}")
+        return results
 
     # -------------------------------------------------------------------------
     # Content API v2 (cards)
     # -------------------------------------------------------------------------
 
-    async def get_cards_list(self) -> List[Dict[str, Any]]:
+    async def iter_cards(self) -> AsyncIterator[Dict[str, Any]]:
         """
-        Получение списка карточек товаров через Content API v2.
+        Карточки товаров через Content API v2 — по одной, по мере загрузки страниц.
         Пагинация через cursor (updatedAt, nmID).
         """
         endpoint = "/content/v2/get/cards/list"
 
-        payload: Dict[str, Any] = {
-            "settings": {
-                "cursor": {"limit": 100},
-                "filter": {"withPhoto": -1},
-            }
-        }
-
-        all_cards: List[Dict[str, Any]] = []
-        seen_pages = 0
         max_pages = 200  # защита от бесконечного цикла
 
-        while True:
-            seen_pages += 1
-            if seen_pages > max_pages:
-                logger.error("WB get_cards_list: достигнут лимит страниц, прерываем (защита от бесконечного цикла).")
-                break
-
-            result = await self._make_request(
-                self.content_url,
-                endpoint,
-                method="POST",
-                json_data=payload,
-                timeout=90.0,
-            )
-
-            if not isinstance(result, dict):
-                logger.error("WB get_cards_list: ответ не dict или пустой.")
-                break
-
-            cards = result.get("cards", [])
-            if not isinstance(cards, list):
-                cards = []
+        # Страницы качает отдельная задача и складывает в очередь (до _CARDS_PREFETCH впереди
+        # потребителя): сеть не простаивает, пока вызывающий код обрабатывает уже полученные карточки.
+        # None в очереди — конец обхода
+        pages: "asyncio.Queue[Optional[Any]]" = asyncio.Queue(maxsize=_CARDS_PREFETCH)
 
-            if not cards:
-                # пустая страница — конец
-                break
-
-            all_cards.extend([c for c in cards if isinstance(c, dict)])
-
-            cursor = result.get("cursor", {})
-            if not isinstance(cursor, dict):
-                break
-
-            # Документация: курсор должен содержать nmID и updatedAt для следующей страницы
-            nm_id = cursor.get("nmID")
-            updated_at = cursor.get("updatedAt")
+        async def produce() -> None:
+            cursor: Dict[str, Any] = {}
+            fetched = 0
+            try:
+                for _ in range(max_pages):
+                    # на каждый запрос новый только курсор; фильтр — общий неизменяемый шаблон
+                    payload = {"settings": {"cursor": {"limit": _CARDS_PAGE_LIMIT, **cursor}, "filter": _CARDS_FILTER}}
+                    result = await self._make_request(
+                        self.content_url, endpoint, method="POST", json_data=payload, timeout=90.0
+                    )
 
-            if nm_id is None or updated_at is None:
-                # если курсора нет — это последняя страница
-                break
+                    if not isinstance(result, dict):
+                        logger.error("WB get_cards_list: ответ не dict или пустой.")
+                        break
 
-            payload["settings"]["cursor"]["nmID"] = nm_id
-            payload["settings"]["cursor"]["updatedAt"] = updated_at
+                    # один проход: пустая/отсутствующая страница — конец, не-dict элементы отсеет filter
+                    cards = result.get("cards") or ()
+                    if not cards:
+                        break
+                    await pages.put(cards)
+                    fetched += len(cards)
 
-            # Лимиты API (примерно 100 запросов/мин) — выдержим паузу
-            await asyncio.sleep(0.7)
+                    # Документация: курсор должен содержать nmID и updatedAt для следующей страницы;
+                    # если курсора нет — это последняя страница. Частоту запросов держит token bucket
+                    next_cursor = result.get("cursor", {})
+                    if not isinstance(next_cursor, dict):
+                        break
+                    # Неполная страница (total < limit по документации WB) — последняя:
+                    # лишний запрос за пустой страницей не нужен
+                    total = next_cursor.get("total")
+                    if len(cards) < _CARDS_PAGE_LIMIT or (isinstance(total, int) and total < _CARDS_PAGE_LIMIT):
+                        logger.debug(f"WB get_cards_list: fetched={fetched}, reported_total={total}")
+                        break
+                    nm_id = next_cursor.get("nmID")
+                    updated_at = next_cursor.get("updatedAt")
+                    if nm_id is None or updated_at is None:
+                        break
+                    cursor = {"nmID": nm_id, "updatedAt": updated_at}
+                else:
+                    logger.error("WB get_cards_list: достигнут лимит страниц, прерываем (защита от бесконечного цикла).")
+            except Exception as e:
+                logger.error(f"WB get_cards_list: ошибка загрузки страниц: {e}")
+            await pages.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                cards = await pages.get()
+                if cards is None:
+                    break
+                for c in filter(_is_dict, cards):
+                    yield c
+        finally:
+            # потребитель прервал обход — незачем качать следующие страницы
+            producer.cancel()
 
-        return all_cards
+    async def get_cards_list(self) -> List[Dict[str, Any]]:
+        """
+        Получение списка карточек товаров через Content API v2 (все страницы iter_cards).
+        """
+        return [c async for c in self.iter_cards()]
 
     async def get_all_products(self) -> List[Dict[str, Any]]:
         """
@@ -423,47 +1024,45 @@ class WildberriesAPI:
         Связывает карточки (Content API) с актуальными остатками (Statistics API).
         Возвращает список словарей в формате проекта (для db_functions.bulk_update_products).
         """
-        cards = await self.get_cards_list()
-        stocks = await self.get_stock_info()
-
-        # В stocks структура может отличаться; чаще есть nmId и quantity
-        stock_map: Dict[str, int] = {}
-        for s in stocks:
-            if not isinstance(s, dict):
-                continue
-            nm_id = s.get("nmId")
-            qty = s.get("quantity")
-            if nm_id is None:
-                continue
-            try:
-                stock_map[str(nm_id)] = int(qty or 0)
-            except Exception:
-                stock_map[str(nm_id)] = 0
+        # Остатки (Statistics API) грузятся параллельно с постраничным обходом карточек;
+        # товары собираются по мере прихода страниц, остаток проставляется в конце
+        stocks_task = asyncio.create_task(self.get_stock_info())
 
+        safe_str = _safe_str
+        template = _WB_PRODUCT_TEMPLATE
         products: List[Dict[str, Any]] = []
-        for card in cards:
-            if not isinstance(card, dict):
-                continue
+        keys: List[str] = []
+        try:
+            async for card in self.iter_cards():
+                nm_id = card.get("nmID") or card.get("nmId") or card.get("nm_id")
+                if not nm_id:
+                    continue
 
-            nm_id = card.get("nmID") or card.get("nmId") or card.get("nm_id")
-            vendor_code = card.get("vendorCode") or card.get("vendor_code")
+                # строковый ключ считаем один раз: он же идёт в stock_map и в article
+                key = str(nm_id)
+                vendor_code = card.get("vendorCode") or card.get("vendor_code")
+                title = card.get("title") or card.get("name") or f"WB: {vendor_code or nm_id}"
 
-            if not nm_id:
-                continue
+                # копия шаблона с постоянными полями дешевле сборки dict из литерала
+                product = template.copy()
+                product["article"] = key.strip().upper()
+                product["name"] = safe_str(title, max_len=255, default=f"WB Product {key}")
+                products.append(product)
+                keys.append(key)
+        except BaseException:
+            stocks_task.cancel()
+            raise
 
-            title = card.get("title") or card.get("name") or f"WB: {vendor_code or nm_id}"
+        stocks = await stocks_task
 
-            products.append(
-                {
-                    "marketplace": "wb",  # КРИТИЧНО: единый идентификатор для БД и аналитики
-                    "article": str(nm_id).strip().upper(),
-                    "name": self._safe_str(title, max_len=255, default=f"WB Product {nm_id}"),
-                    "cost_price": 0.0,
-                    "extra_costs": 0.0,
-                    "tax_rate": 0.06,
-                    "stock": int(stock_map.get(str(nm_id), 0)),
-                }
-            )
+        # В stocks структура может отличаться; чаще есть nmId и quantity
+        stock_map: Dict[str, int] = {
+            str(s["nmId"]): _to_int_safe(s.get("quantity"))
+            for s in filter(_is_dict, stocks)
+            if s.get("nmId") is not None
+        }
+        for product, key in zip(products, keys):
+            product["stock"] = stock_map.get(key, 0)
 
         logger.info(f"WB API: подготовлено {len(products)} товаров.")
         return products
@@ -476,11 +1075,15 @@ class WildberriesAPI:
         """
         Получение информации о ценах, скидках и промокодах.
         """
-        result = await self._make_request(
-            self.marketplace_url,
-            "/api/v2/list/goods/filter",
-            params={"limit": 1000},
-            timeout=90.0,
+        result = await self._cached(
+            "prices",
+            _PRICES_TTL,
+            lambda: self._make_request(
+                self.marketplace_url,
+                "/api/v2/list/goods/filter",
+                params={"limit": 1000},
+                timeout=90.0,
+            ),
         )
         if isinstance(result, dict) and "data" in result and isinstance(result["data"], dict):
             items = result["data"].get("listGoods", [])
@@ -491,5 +1094,7 @@ class WildberriesAPI:
         """
         Получение списка складов продавца (FBS).
         """
-        result = await self._make_request(self.marketplace_url, "/api/v3/warehouses")
+        result = await self._cached(
+            "warehouses", _WAREHOUSES_TTL, lambda: self._make_request(self.marketplace_url, "/api/v3/warehouses")
+        )
         return result if isinstance(result, list) else []